@@ -13,6 +13,19 @@ class MailSendError(AutomationError):
     pass
 
 
+class PartialDeliveryError(MailSendError):
+    """Raised when a message was delivered but some CC/BCC recipients were refused."""
+
+    def __init__(self, message: str, refused=None):
+        super().__init__(message)
+        self.refused = refused or {}
+
+
+class DeliveryUnknownError(MailSendError):
+    """Raised when the connection failed after the message data was handed over; it may have been delivered."""
+    pass
+
+
 class TemplateNotFoundError(AutomationError):
     """Raised when a template is not found."""
     pass
@@ -23,6 +36,16 @@ class FileProcessingError(AutomationError):
     pass
 
 
+class ArchiveLimitError(FileProcessingError):
+    """Raised when an uploaded archive exceeds the extraction budget."""
+    pass
+
+
+class RecipientListLimitError(FileProcessingError):
+    """Raised when a recipient list exceeds the configured row or cell budget."""
+    pass
+
+
 class ReportGenerationError(AutomationError):
     """Raised when report generation fails."""
     pass
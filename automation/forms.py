@@ -53,10 +53,37 @@ class SignupForm(forms.Form):
         return user
 
 
+class MultipleFileInput(forms.ClearableFileInput):
+    allow_multiple_selected = True
+
+
+class MultipleFileField(forms.FileField):
+    """File field that accepts several files; cleans to a list."""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("widget", MultipleFileInput())
+        super().__init__(*args, **kwargs)
+
+    def clean(self, data, initial=None):
+        single_file_clean = super().clean
+        if isinstance(data, (list, tuple)):
+            return [single_file_clean(d, initial) for d in data]
+        cleaned = single_file_clean(data, initial)
+        return [cleaned] if cleaned else []
+
+
 class MailAutomationForm(forms.Form):
-    excel_file = forms.FileField(required=False, help_text="Upload an .xlsx file")
+    excel_file = forms.FileField(required=False, help_text="Upload an .xlsx, .csv or .parquet file")
     template = forms.ChoiceField(choices=[], required=True)
-    attachment = forms.FileField(required=False, help_text="Upload any file to attach to all emails (PDF, DOC, ZIP, etc.)")
+    attachment = MultipleFileField(required=False, help_text="Upload any files to attach to all emails (PDF, DOC, ZIP, RAR, TAR.GZ, 7Z, etc.)")
+    bcc_fanout = forms.BooleanField(
+        required=False,
+        help_text="Send identical messages once, with their recipients in BCC"
+    )
+    link_attachments = forms.BooleanField(
+        required=False,
+        help_text="Upload each attachment once to OneDrive and send sharing links instead of files"
+    )
 
     def __init__(self, *args, **kwargs):
         user = kwargs.pop('user', None)
@@ -94,6 +121,25 @@ class TemplateEditForm(forms.Form):
     name = forms.CharField(max_length=100, required=True)
     subject = forms.CharField(max_length=200, required=False)
     body = forms.CharField(widget=forms.Textarea, required=True)
+    engine = forms.ChoiceField(
+        choices=[("format", "Basit ({alan})"), ("jinja", "Jinja2 (koşul ve döngü)")],
+        required=False,
+        initial="format",
+        help_text="Jinja2 templates support {% if %} and {% for %} (requires jinja2)"
+    )
+
+    def clean_engine(self):
+        return self.cleaned_data.get("engine") or "format"
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get("engine") == "jinja" and "body" in cleaned_data:
+            from .services.jinja_render import validate_jinja
+            try:
+                validate_jinja(cleaned_data.get("subject") or "", cleaned_data["body"])
+            except ValueError as e:
+                raise forms.ValidationError(f"Jinja2 şablonu geçersiz: {e}")
+        return cleaned_data
 
 
 
@@ -5,6 +5,9 @@ from pathlib import Path
 from django.core.management.base import BaseCommand
 from django.conf import settings
 
+from automation.services.attachment_library import iter_libraries
+from automation.services.datasets import iter_dataset_stores
+
 
 class Command(BaseCommand):
     help = 'Clean up old temporary files from upload processing'
@@ -23,6 +26,9 @@ class Command(BaseCommand):
         )
 
     def handle(self, *args, **options):
+        self.collect_library_garbage(options['hours'], options['dry_run'])
+        self.collect_dataset_garbage(options['hours'], options['dry_run'])
+
         temp_dir = getattr(settings, 'FILE_UPLOAD_TEMP_DIR', None)
         if not temp_dir or not os.path.exists(temp_dir):
             self.stdout.write(
@@ -92,3 +98,37 @@ class Command(BaseCommand):
             self.stdout.write(
                 self.style.SUCCESS("No old files found to clean up")
             )
+
+    def collect_library_garbage(self, hours, dry_run):
+        """Remove attachment library blobs no campaign references any more."""
+        deleted_count = 0
+        total_size = 0
+        for library in iter_libraries():
+            deleted, freed = library.collect_garbage(min_age_hours=hours, dry_run=dry_run)
+            deleted_count += deleted
+            total_size += freed
+
+        if deleted_count > 0:
+            action = "Would delete" if dry_run else "Deleted"
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"{action} {deleted_count} unreferenced library blobs ({total_size / (1024 * 1024):.2f} MB)"
+                )
+            )
+
+    def collect_dataset_garbage(self, hours, dry_run):
+        """Remove cached recipient datasets nobody loaded for the given hours."""
+        deleted_count = 0
+        total_size = 0
+        for store in iter_dataset_stores():
+            deleted, freed = store.collect_garbage(min_age_hours=hours, dry_run=dry_run)
+            deleted_count += deleted
+            total_size += freed
+
+        if deleted_count > 0:
+            action = "Would delete" if dry_run else "Deleted"
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"{action} {deleted_count} cached datasets ({total_size / (1024 * 1024):.2f} MB)"
+                )
+            )
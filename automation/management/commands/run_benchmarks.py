@@ -0,0 +1,440 @@
+"""
+Django management command to benchmark the mail automation hot paths.
+
+Each suite builds its own synthetic input in a temp directory, so the
+command is safe to run anywhere:
+
+    python manage.py run_benchmarks --suite archives
+"""
+import io
+import logging
+import os
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pandas as pd
+import requests
+from openpyxl import Workbook
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+
+from automation.services.attach_matcher import collect_files_from_upload
+from automation.services.extractors import SEVEN_ZIP_SUPPORT, ExtractionBudget
+from automation.services.graph_http import HTTP2_SUPPORT, Http2HttpClient, LatencyStats, PooledHttpClient
+from automation.services.graph_payload import AttachmentSource
+from automation.services.mailer import build_message_payload
+from automation.services.recipient_reader import (
+    CALAMINE_SUPPORT,
+    PARQUET_SUPPORT,
+    ReadBudget,
+    read_recipients,
+    read_xlsx,
+)
+from automation.services.template_render import CompiledSubjectBody, render_subject_body
+from automation.services.transports import FileSinkTransport, SMTPTransport
+
+try:
+    from aiosmtpd.controller import Controller as SMTPController
+    AIOSMTPD_SUPPORT = True
+except ImportError:
+    AIOSMTPD_SUPPORT = False
+
+
+def _timed(func, repeat: int):
+    """Run func repeat times and return (best_seconds, last_result)."""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+class Command(BaseCommand):
+    help = 'Benchmark attachment ingestion, rendering and sending paths'
+
+    suites = ("archives", "transports", "graph_http", "parse", "xlsx_engines", "render")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--suite',
+            choices=self.suites + ("all",),
+            default="all",
+            help='Benchmark suite to run (default: all)'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='Runs per measurement; the best run is reported (default: 3)'
+        )
+        parser.add_argument(
+            '--files',
+            type=int,
+            default=200,
+            help='Number of synthetic attachment files per archive (default: 200)'
+        )
+        parser.add_argument(
+            '--file-kb',
+            type=int,
+            default=256,
+            help='Size of each synthetic attachment in KB (default: 256)'
+        )
+        parser.add_argument(
+            '--messages',
+            type=int,
+            default=200,
+            help='Messages per transport measurement (default: 200)'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=16,
+            help='Concurrent requests in the graph_http suite (default: 16)'
+        )
+        parser.add_argument(
+            '--http-url',
+            default=None,
+            help='Endpoint for the graph_http suite, e.g. an HTTP/2 test server '
+                 '(default: a local HTTP/1.1 sink)'
+        )
+        parser.add_argument(
+            '--rows',
+            type=int,
+            default=20000,
+            help='Recipient rows in the parse suite (default: 20000)'
+        )
+        parser.add_argument(
+            '--sizes',
+            default="10000,100000,500000",
+            help='Comma-separated workbook row counts for the xlsx_engines suite (default: 10000,100000,500000)'
+        )
+        parser.add_argument(
+            '--render-rows',
+            type=int,
+            default=100000,
+            help='Rows rendered in the render suite (default: 100000)'
+        )
+
+    def handle(self, *args, **options):
+        suites = self.suites if options['suite'] == "all" else (options['suite'],)
+        # Per-file debug logging would dominate the timings
+        logging.getLogger("automation").setLevel(logging.WARNING)
+        with tempfile.TemporaryDirectory(prefix="bench_") as tmp:
+            for suite in suites:
+                self.stdout.write(self.style.SUCCESS(f"\n=== {suite} ==="))
+                getattr(self, f"bench_{suite}")(Path(tmp), options)
+
+    # -------------------- archives --------------------
+
+    def _build_archives(self, options) -> dict:
+        """Build the same synthetic payload in every archive format we can write."""
+        files = [
+            (f"company_{i:04d}_invoice.pdf", os.urandom(options['file_kb'] * 512) * 2)
+            for i in range(options['files'])
+        ]
+        archives = {}
+
+        buff = io.BytesIO()
+        with zipfile.ZipFile(buff, "w", zipfile.ZIP_DEFLATED) as zf:
+            for name, data in files:
+                zf.writestr(name, data)
+        archives["zip"] = ("invoices.zip", buff.getvalue())
+
+        for mode, suffix in (("w", "tar"), ("w:gz", "tar.gz")):
+            buff = io.BytesIO()
+            with tarfile.open(fileobj=buff, mode=mode) as tf:
+                for name, data in files:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    tf.addfile(info, io.BytesIO(data))
+            archives[suffix] = (f"invoices.{suffix}", buff.getvalue())
+
+        if SEVEN_ZIP_SUPPORT:
+            import py7zr
+
+            buff = io.BytesIO()
+            with py7zr.SevenZipFile(buff, "w") as archive:
+                for name, data in files:
+                    archive.writestr(data, name)
+            archives["7z"] = ("invoices.7z", buff.getvalue())
+        else:
+            self.stdout.write(self.style.WARNING("py7zr not installed, skipping 7z"))
+        self.stdout.write(self.style.WARNING("RAR archives can't be written without the rar tool, skipping rar"))
+
+        payload_mb = sum(len(data) for _, data in files) / (1024 * 1024)
+        return {"archives": archives, "payload_mb": payload_mb}
+
+    def bench_archives(self, tmp: Path, options):
+        built = self._build_archives(options)
+        archives, payload_mb = built["archives"], built["payload_mb"]
+        budget_kwargs = {"max_total_bytes": 1 << 40, "max_files": 1 << 20}
+        self.stdout.write(f"Payload: {options['files']} files, {payload_mb:.1f} MB per archive")
+
+        for fmt, (name, data) in archives.items():
+            def extract():
+                upload = SimpleUploadedFile(name, data)
+                return collect_files_from_upload([upload], tmp, budget=ExtractionBudget(**budget_kwargs))
+
+            seconds, (files, _) = _timed(extract, options['repeat'])
+            self.stdout.write(
+                f"  {fmt:<7} {len(files):>5} files  {seconds * 1000:8.1f} ms  {payload_mb / seconds:8.1f} MB/s"
+            )
+
+        if "zip" in archives:
+            name, data = archives["zip"]
+            seconds, (files, _) = _timed(
+                lambda: collect_files_from_upload(
+                    [SimpleUploadedFile(name, data)], tmp, lazy_zip=True, budget=ExtractionBudget(**budget_kwargs)
+                ),
+                options['repeat']
+            )
+            self.stdout.write(f"  zip (lazy catalogue) {len(files):>5} files  {seconds * 1000:8.1f} ms")
+
+        uploads = list(archives.values())
+        for workers in (1, 4):
+            seconds, (files, _) = _timed(
+                lambda: collect_files_from_upload(
+                    [SimpleUploadedFile(name, data) for name, data in uploads],
+                    tmp,
+                    budget=ExtractionBudget(**budget_kwargs),
+                    max_workers=workers
+                ),
+                options['repeat']
+            )
+            self.stdout.write(
+                f"  {len(uploads)} archives, {workers} worker(s): {seconds * 1000:8.1f} ms "
+                f"({len(files)} files, {payload_mb * len(uploads) / seconds:.1f} MB/s)"
+            )
+
+    # -------------------- transports --------------------
+
+    def _send_all(self, transport, messages: int, attachment: AttachmentSource) -> None:
+        for n in range(messages):
+            payload = build_message_payload(f"user{n}@example.com", "Fatura", f"<p>Merhaba {n}</p>")
+            transport.send(payload, [attachment])
+
+    def bench_transports(self, tmp: Path, options):
+        messages = options['messages']
+        path = tmp / "brochure.pdf"
+        path.write_bytes(os.urandom(options['file_kb'] * 1024))
+        attachment = AttachmentSource.from_path(str(path), "application/pdf")
+        self.stdout.write(f"Payload: {messages} messages, one {options['file_kb']} KB attachment each")
+
+        sink = FileSinkTransport(tmp / "outbox")
+        seconds, _ = _timed(lambda: self._send_all(sink, messages, attachment), options['repeat'])
+        self.stdout.write(f"  file sink          {seconds * 1000:8.1f} ms  {messages / seconds:8.1f} msg/s")
+
+        if not AIOSMTPD_SUPPORT:
+            self.stdout.write(self.style.WARNING("aiosmtpd not installed, skipping smtp"))
+            return
+
+        class Sink:
+            async def handle_DATA(self, server, session, envelope):
+                return "250 OK"
+
+        controller = SMTPController(Sink(), hostname="127.0.0.1", port=0)
+        controller.start()
+        try:
+            host, port = controller.server.sockets[0].getsockname()[:2]
+            for label, max_messages in (("smtp, new session", 1), ("smtp, pooled", messages)):
+                transport = SMTPTransport(host, port, use_tls=False, from_addr="bench@example.com",
+                                          pool_size=1, max_messages=max_messages)
+                seconds, _ = _timed(lambda: self._send_all(transport, messages, attachment), options['repeat'])
+                transport.close()
+                self.stdout.write(
+                    f"  {label:<18} {seconds * 1000:8.1f} ms  {messages / seconds:8.1f} msg/s  "
+                    f"({transport.stats()['connections_opened']} connections opened)"
+                )
+        finally:
+            controller.stop()
+
+    # -------------------- graph_http --------------------
+
+    def _local_sink(self):
+        """A keep-alive HTTP/1.1 server answering every POST with 202."""
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                self.send_response(202)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def bench_graph_http(self, tmp: Path, options):
+        messages, concurrency = options['messages'], options['concurrency']
+        body = os.urandom(options['file_kb'] * 1024)
+        server = None
+        url = options['http_url']
+        if not url:
+            server = self._local_sink()
+            url = f"http://127.0.0.1:{server.server_address[1]}/v1.0/me/sendMail"
+        self.stdout.write(f"Payload: {messages} POSTs of {options['file_kb']} KB, {concurrency} concurrent, {url}")
+
+        def run(post):
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                list(pool.map(lambda _: post(url, data=body, timeout=30).raise_for_status(), range(messages)))
+
+        unpooled = LatencyStats()
+
+        def post_unpooled(url, **kwargs):
+            started = unpooled.start()
+            try:
+                return requests.post(url, **kwargs)
+            finally:
+                unpooled.finish(started)
+
+        clients = [("no keep-alive", post_unpooled, lambda: {"connections": messages, **unpooled.summary()})]
+        pooled = PooledHttpClient(pool_size=concurrency)
+        clients.append(("HTTP/1.1 pooled", pooled.post, pooled.stats))
+        if HTTP2_SUPPORT:
+            http2 = Http2HttpClient(max_connections=2)
+            clients.append(("HTTP/2", http2.post, http2.stats))
+        else:
+            self.stdout.write(self.style.WARNING("httpx[http2] not installed, skipping HTTP/2"))
+
+        try:
+            for label, post, stats in clients:
+                seconds, _ = _timed(lambda: run(post), 1)
+                s = stats()
+                self.stdout.write(
+                    f"  {label:<16} {seconds * 1000:8.1f} ms  {messages / seconds:8.1f} req/s  "
+                    f"{s['connections']:>4} connections  p50 {s['p50_ms']} ms  p95 {s['p95_ms']} ms"
+                    + (f"  ({s['http_version']})" if "http_version" in s else "")
+                )
+        finally:
+            pooled.close()
+            if HTTP2_SUPPORT:
+                http2.close()
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+
+    # -------------------- parse --------------------
+
+    @staticmethod
+    def _recipient_frame(rows: int) -> pd.DataFrame:
+        return pd.DataFrame({
+            "Email": [f"user{n}@example.com" for n in range(rows)],
+            "CompanyName": [f"Şirket {n % 500}" for n in range(rows)],
+            "Name": [f"Kişi {n}" for n in range(rows)],
+            "Amount": [str(n * 7 % 1000) for n in range(rows)],
+            "CC": ["muhasebe@example.com" if n % 3 == 0 else "" for n in range(rows)],
+        })
+
+    @staticmethod
+    def _write_xlsx(df: pd.DataFrame, path: Path) -> Path:
+        wb = Workbook(write_only=True)
+        sheet = wb.create_sheet()
+        sheet.append(list(df.columns))
+        for row in df.itertuples(index=False):
+            sheet.append(list(row))
+        wb.save(path)
+        return path
+
+    def _build_recipient_files(self, tmp: Path, rows: int) -> dict:
+        """The same synthetic recipient list as .xlsx, .csv and (with pyarrow) .parquet."""
+        df = self._recipient_frame(rows)
+        files = {"xlsx": self._write_xlsx(df, tmp / "recipients.xlsx")}
+
+        df.to_csv(tmp / "recipients.csv", sep=";", index=False, encoding="utf-8-sig")
+        files["csv"] = tmp / "recipients.csv"
+
+        if PARQUET_SUPPORT:
+            df.to_parquet(tmp / "recipients.parquet", index=False)
+            files["parquet"] = tmp / "recipients.parquet"
+        else:
+            self.stdout.write(self.style.WARNING("pyarrow not installed, skipping parquet"))
+        return files
+
+    def bench_parse(self, tmp: Path, options):
+        rows = options['rows']
+        files = self._build_recipient_files(tmp, rows)
+        budget = ReadBudget(max_rows=rows, max_cells=rows * 10)
+        self.stdout.write(f"Recipient list: {rows} rows x 5 columns")
+
+        for fmt, path in files.items():
+            data = path.read_bytes()
+            seconds, df = _timed(lambda: read_recipients(io.BytesIO(data), path.name, budget=budget), options['repeat'])
+            self.stdout.write(
+                f"  {fmt:<8} {len(data) / 1024:8.0f} KB  {seconds * 1000:8.1f} ms  {len(df) / seconds:10.0f} rows/s"
+            )
+
+        data = files["xlsx"].read_bytes()
+        seconds, df = _timed(lambda: pd.read_excel(io.BytesIO(data)), options['repeat'])
+        self.stdout.write(
+            f"  {'xlsx (pd.read_excel)':<8} {seconds * 1000:8.1f} ms  {len(df) / seconds:10.0f} rows/s"
+        )
+
+    # -------------------- xlsx_engines --------------------
+
+    def bench_xlsx_engines(self, tmp: Path, options):
+        engines = ["openpyxl"] + (["calamine"] if CALAMINE_SUPPORT else [])
+        if not CALAMINE_SUPPORT:
+            self.stdout.write(self.style.WARNING("python-calamine not installed, timing openpyxl only"))
+
+        for rows in (int(size) for size in options['sizes'].split(",") if size.strip()):
+            path = self._write_xlsx(self._recipient_frame(rows), tmp / f"recipients_{rows}.xlsx")
+            data = path.read_bytes()
+            budget = ReadBudget(max_rows=rows, max_cells=rows * 10)
+            self.stdout.write(f"Workbook: {rows} rows x 5 columns, {len(data) / (1024 * 1024):.1f} MB")
+            for engine in engines:
+                seconds, df = _timed(
+                    lambda: read_xlsx(io.BytesIO(data), budget=budget, engine=engine), options['repeat']
+                )
+                self.stdout.write(
+                    f"  {engine:<9} {seconds * 1000:10.1f} ms  {len(df) / seconds:10.0f} rows/s"
+                )
+            path.unlink()
+
+    # -------------------- render --------------------
+
+    def bench_render(self, tmp: Path, options):
+        rows = options['render_rows']
+        df = self._recipient_frame(rows)
+        df.columns = df.columns.str.lower()
+        subject = "{companyname} - Fatura {amount} TL"
+        body = (
+            "Sayın {name},\r\n\r\n{companyname} adına düzenlenen {amount} TL tutarındaki fatura ektedir.\r\n"
+            "Sorularınız için {cc} adresine yazabilirsiniz.\r\n\r\nSaygılarımızla"
+        )
+        self.stdout.write(f"Rendering subject + body for {rows} rows")
+
+        def per_row():
+            return [render_subject_body(subject, body, row.to_dict()) for _, row in df.iterrows()]
+
+        def compiled():
+            renderer = CompiledSubjectBody(subject, body, df.columns)
+            return [renderer.render(values) for values in df.itertuples(index=False, name=None)]
+
+        def bulk():
+            return CompiledSubjectBody(subject, body, df.columns).render_frame(df)
+
+        base_seconds, expected = _timed(per_row, options['repeat'])
+        self.stdout.write(f"  {'render_subject_body (iterrows)':<34} {base_seconds * 1000:9.1f} ms  {rows / base_seconds:10.0f} rows/s")
+        for label, func in (("compiled (itertuples)", compiled), ("bulk (column-wise)", bulk)):
+            seconds, rendered = _timed(func, options['repeat'])
+            if rendered != expected:
+                self.stdout.write(self.style.ERROR(f"  {label} output differs from render_subject_body"))
+            self.stdout.write(
+                f"  {label:<34} {seconds * 1000:9.1f} ms  {rows / seconds:10.0f} rows/s  "
+                f"({base_seconds / seconds:.1f}x)"
+            )
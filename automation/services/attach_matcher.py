@@ -4,18 +4,29 @@ import zipfile
 import tempfile
 import shutil
 import base64
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from typing import List, Dict, Tuple, Any
+from typing import List, Dict, Tuple, Any, BinaryIO
 import logging
 
-try:
-    import rarfile
-    RAR_SUPPORT = True
-except ImportError:
-    RAR_SUPPORT = False
+from ..exceptions import ArchiveLimitError
+from .graph_payload import iter_base64
+from .extractors import (
+    ArchiveExtractor,
+    ExtractionBudget,
+    detect_extractor,
+    file_entry,
+    get_extractors,
+    is_broken_archive,
+)
 
 logger = logging.getLogger(__name__)
 
+# Archives of one upload are extracted concurrently by this many workers
+DEFAULT_EXTRACT_WORKERS = 4
+
 
 def norm(s: str) -> str:
     """
@@ -25,15 +36,153 @@ def norm(s: str) -> str:
     return (s or "").strip().casefold()
 
 
-def collect_files_from_upload(uploaded_files: List, base_tmp_dir: Path) -> Tuple[List[Dict[str, Any]], str]:
+class ZipHandleCache:
+    """
+    Keep a few archives open so repeated member reads don't re-parse the central directory.
+
+    Evicted handles are closed; member streams already opened from them stay
+    readable (ZipFile closes the file once its last stream is closed). Threads
+    should read through open(), which opens the member under the cache lock,
+    so a handle can't be evicted between lookup and open.
+    """
+
+    def __init__(self, max_handles: int = 8):
+        self.max_handles = max_handles
+        self._handles: "OrderedDict[str, zipfile.ZipFile]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> zipfile.ZipFile:
+        # Caller holds self._lock
+        handle = self._handles.get(key)
+        if handle is not None:
+            self._handles.move_to_end(key)
+            return handle
+        handle = zipfile.ZipFile(key, "r")
+        self._handles[key] = handle
+        while len(self._handles) > self.max_handles:
+            _, evicted = self._handles.popitem(last=False)
+            evicted.close()
+        return handle
+
+    def get(self, zip_path: str) -> zipfile.ZipFile:
+        """The cached handle of an archive; it is closed once evicted by another lookup."""
+        with self._lock:
+            return self._get(os.path.abspath(zip_path))
+
+    def open(self, zip_path: str, member: str) -> BinaryIO:
+        """A stream of one member, opened before any other thread can evict the handle."""
+        with self._lock:
+            return self._get(os.path.abspath(zip_path)).open(member)
+
+    def close_under(self, directory: str) -> int:
+        """Close the handles of archives inside directory; returns how many were closed."""
+        root = os.path.join(os.path.abspath(directory), "")
+        with self._lock:
+            keys = [key for key in self._handles if key.startswith(root)]
+            for key in keys:
+                self._handles.pop(key).close()
+        return len(keys)
+
+    def __len__(self) -> int:
+        return len(self._handles)
+
+
+_zip_handles = ZipHandleCache()
+
+
+def catalog_zip_members(zip_path: Path, budget: ExtractionBudget | None = None) -> List[Dict[str, Any]]:
+    """
+    Build the file catalogue of a ZIP from its central directory only.
+    No member is decompressed; bytes are read later by open_attachment_source().
+    Entries look like loose files plus "member" and "crc" keys.
+    Members are admitted against the budget on their declared sizes.
+    """
+    zip_extractor = next(e for e in get_extractors() if e.supports_catalogue)
+    return zip_extractor.catalogue(Path(zip_path), budget or ExtractionBudget.from_settings())
+
+
+def open_attachment_source(file_info: Dict[str, Any]) -> BinaryIO:
+    """
+    Open the bytes behind a catalogue entry, either a file on disk or a ZIP member.
+    The caller is responsible for closing the returned stream.
     """
-    Accept either:
-      - a single ZIP file, OR
-      - multiple loose files
+    member = file_info.get("member")
+    if member:
+        return _zip_handles.open(file_info["path"], member)
+    return open(file_info["path"], "rb")
+
+
+def read_attachment_bytes(file_info: Dict[str, Any]) -> bytes:
+    """Read the full content of a catalogue entry."""
+    with open_attachment_source(file_info) as src:
+        return src.read()
+
+
+def _save_upload(f, out_path: Path) -> Path:
+    """Write an uploaded file to disk in chunks."""
+    f.seek(0)
+    with open(out_path, "wb") as dst:
+        for chunk in f.chunks():
+            dst.write(chunk)
+    return out_path
+
+
+def _extract_upload(
+    f,
+    extractor: ArchiveExtractor,
+    tmp_root: Path,
+    budget: ExtractionBudget,
+    lazy_zip: bool
+) -> List[Dict[str, Any]]:
+    """Extract (or lazily catalogue) one uploaded archive under tmp_root."""
+    fname = Path(f.name)
+
+    if lazy_zip and extractor.supports_catalogue:
+        # keep the archive as-is; members are read on demand
+        archive_path = _save_upload(f, tmp_root / fname.name)
+        logger.debug(f"Stored {extractor.label} for lazy access: {archive_path}")
+        return extractor.catalogue(archive_path, budget)
+
+    out_dir = tmp_root / (fname.stem + extractor.dir_suffix)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    logger.debug(f"Extracting {extractor.label} to: {out_dir}")
+
+    if not extractor.needs_path:
+        f.seek(0)
+        return extractor.extract(f, out_dir, budget)
+
+    # The format library needs a real file: reuse Django's temp file when there is one
+    if hasattr(f, "temporary_file_path"):
+        return extractor.extract(f.temporary_file_path(), out_dir, budget)
+    temp_path = _save_upload(f, tmp_root / fname.name)
+    try:
+        return extractor.extract(str(temp_path), out_dir, budget)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def collect_files_from_upload(
+    uploaded_files: List,
+    base_tmp_dir: Path,
+    lazy_zip: bool = False,
+    budget: ExtractionBudget | None = None,
+    max_workers: int = DEFAULT_EXTRACT_WORKERS
+) -> Tuple[List[Dict[str, Any]], str]:
+    """
+    Accept any mix of archives and loose files.
     Returns a tuple of (files_list, temp_dir_path)
     files_list contains dicts: { "name": <filename>, "path": <abs_path>, "size": <int>, "content_type": <str> }
     All files are stored under a request-scoped temp folder to ensure we reference on-disk paths.
+    Archives are recognised by extension and magic bytes together (see
+    extractors.py) and extracted concurrently, up to max_workers at a time;
+    documents such as .docx and single compressed files such as .csv.gz are
+    kept as loose files.
+    With lazy_zip, a ZIP is stored once as-is and catalogued from its central directory;
+    its entries carry the archive path plus "member" instead of an extracted file path.
+    Archive members are checked against the extraction budget before they are
+    decompressed; ArchiveLimitError aborts the upload and removes the temp folder.
     """
+    budget = budget or ExtractionBudget.from_settings()
     try:
         tmp_root = Path(tempfile.mkdtemp(prefix="invoices_", dir=base_tmp_dir))
         results = []
@@ -43,146 +192,59 @@ def collect_files_from_upload(uploaded_files: List, base_tmp_dir: Path) -> Tuple
         logger.error(f"Failed to create temp directory: {e}")
         raise ValueError(f"Failed to create temporary directory: {e}")
 
-    def push_file(p: Path):
-        """Helper to add file metadata to results"""
-        try:
-            ctype, _ = mimetypes.guess_type(str(p))
-            size = p.stat().st_size
-            results.append({
-                "name": p.name, 
-                "path": str(p), 
-                "size": size, 
-                "content_type": ctype or "application/octet-stream"
-            })
-            logger.debug(f"Added file: {p.name} ({size} bytes, {ctype})")
-        except Exception as e:
-            logger.error(f"Error processing file {p}: {e}")
-
-    # If the form only allows one file input, uploaded_files will be length 1
+    archives: List[Tuple[Any, ArchiveExtractor]] = []
     for f in uploaded_files:
         fname = Path(f.name)
         logger.debug(f"Processing uploaded file: {fname}")
         
-        if fname.suffix.lower() == ".zip":
-            # extract zip safely
-            tmp_zip_dir = tmp_root / (fname.stem + "_unzipped")
-            tmp_zip_dir.mkdir(parents=True, exist_ok=True)
-            logger.debug(f"Extracting ZIP to: {tmp_zip_dir}")
-            
-            try:
-                with zipfile.ZipFile(f, "r") as zf:
-                    for member in zf.infolist():
-                        # skip directories
-                        if member.is_dir():
-                            continue
-                        # avoid path traversal
-                        safe_name = Path(member.filename).name
-                        out_path = tmp_zip_dir / safe_name
-                        logger.debug(f"Extracting: {member.filename} -> {out_path}")
-                        
-                        with zf.open(member) as src, open(out_path, "wb") as dst:
-                            dst.write(src.read())
-                        push_file(out_path)
-            except zipfile.BadZipFile as e:
-                logger.error(f"Invalid ZIP file {fname}: {e}")
-                raise ValueError(f"Invalid ZIP file: {fname}")
-            except Exception as e:
-                logger.error(f"Error extracting ZIP {fname}: {e}")
-                raise ValueError(f"Failed to extract ZIP file {fname}: {e}")
-        
-        elif fname.suffix.lower() == ".rar":
-            # extract rar safely
-            if not RAR_SUPPORT:
-                logger.error(f"RAR support not available. Please install rarfile: pip install rarfile")
-                raise ValueError(f"RAR support not available. Please install rarfile: pip install rarfile")
-            
-            tmp_rar_dir = tmp_root / (fname.stem + "_unrarred")
-            tmp_rar_dir.mkdir(parents=True, exist_ok=True)
-            logger.debug(f"Extracting RAR to: {tmp_rar_dir}")
-            
-            try:
-                # Reset file pointer to beginning
-                f.seek(0)
-                logger.debug(f"Attempting to open RAR file: {fname}")
-                
-                # Save uploaded file to temporary location first
-                temp_rar_path = tmp_root / fname.name
-                with open(temp_rar_path, "wb") as temp_file:
-                    for chunk in f.chunks():
-                        temp_file.write(chunk)
-                logger.debug(f"Saved RAR file to temporary location: {temp_rar_path}")
-                
-                # Check if file is actually a RAR file by reading magic bytes
-                with open(temp_rar_path, "rb") as check_file:
-                    magic = check_file.read(7)
-                    if not magic.startswith(b'Rar!'):
-                        logger.error(f"File {fname} is not a valid RAR file (invalid magic bytes)")
-                        temp_rar_path.unlink()
-                        raise ValueError(f"File {fname} is not a valid RAR archive. Please check the file format.")
-                
-                with rarfile.RarFile(temp_rar_path) as rf:
-                    logger.debug(f"Successfully opened RAR file: {fname}")
-                    members = rf.infolist()
-                    logger.debug(f"RAR file contains {len(members)} members")
-                    
-                    if not members:
-                        logger.warning(f"RAR file {fname} is empty")
-                        temp_rar_path.unlink()
-                        return
-                    
-                    for member in members:
-                        # skip directories
-                        if member.is_dir():
-                            logger.debug(f"Skipping directory: {member.filename}")
-                            continue
-                        # avoid path traversal
-                        safe_name = Path(member.filename).name
-                        out_path = tmp_rar_dir / safe_name
-                        logger.debug(f"Extracting: {member.filename} -> {out_path}")
-                        
-                        with rf.open(member) as src, open(out_path, "wb") as dst:
-                            dst.write(src.read())
-                        push_file(out_path)
-                        
-                # Clean up temporary RAR file
-                temp_rar_path.unlink()
-                logger.debug(f"Successfully extracted RAR file: {fname}")
-            except rarfile.BadRarFile as e:
-                logger.error(f"Invalid RAR file {fname}: {e}")
-                # Clean up temporary file if it exists
-                if 'temp_rar_path' in locals() and temp_rar_path.exists():
-                    temp_rar_path.unlink()
-                raise ValueError(f"Invalid RAR file: {fname}. The file may be corrupted or not a valid RAR archive.")
-            except rarfile.RarCannotExec as e:
-                logger.error(f"RAR executable not found for {fname}: {e}")
-                # Clean up temporary file if it exists
-                if 'temp_rar_path' in locals() and temp_rar_path.exists():
-                    temp_rar_path.unlink()
-                raise ValueError(f"RAR extraction failed: {fname}. Please ensure unrar is installed on the system.")
-            except Exception as e:
-                logger.error(f"Error extracting RAR {fname}: {e}", exc_info=True)
-                # Clean up temporary file if it exists
-                if 'temp_rar_path' in locals() and temp_rar_path.exists():
-                    temp_rar_path.unlink()
-                raise ValueError(f"Failed to extract RAR file {fname}: {str(e)}")
+        extractor = detect_extractor(f)
+        if extractor is not None:
+            archives.append((f, extractor))
+            continue
+
+        if is_broken_archive(f):
+            shutil.rmtree(tmp_root, ignore_errors=True)
+            logger.error(f"File {fname} is not a valid archive (unknown magic bytes)")
+            raise ValueError(f"File {fname} is not a valid archive. Please check the file format.")
+
+        # loose file: copy to tmp_root
+        out_path = tmp_root / fname.name
+        logger.debug(f"Copying loose file to: {out_path}")
+        try:
+            results.append(file_entry(_save_upload(f, out_path)))
+        except Exception as e:
+            logger.error(f"Error copying file {fname}: {e}")
+            raise ValueError(f"Failed to copy file {fname}: {e}")
+
+    def run(item: Tuple[Any, ArchiveExtractor]) -> List[Dict[str, Any]]:
+        f, extractor = item
+        try:
+            return _extract_upload(f, extractor, tmp_root, budget, lazy_zip)
+        except ArchiveLimitError:
+            raise
+        except ValueError as e:
+            logger.error(f"Error extracting {extractor.label} {f.name}: {e}")
+            raise ValueError(f"{e} ({f.name})") from e
+        except Exception as e:
+            logger.error(f"Error extracting {extractor.label} {f.name}: {e}", exc_info=True)
+            raise ValueError(f"Failed to extract {extractor.label} file {f.name}: {e}") from e
+
+    try:
+        if len(archives) > 1 and max_workers > 1:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(archives))) as pool:
+                extracted = list(pool.map(run, archives))
         else:
-            # loose file: copy to tmp_root
-            out_path = tmp_root / fname.name
-            logger.debug(f"Copying loose file to: {out_path}")
-            
-            try:
-                with open(out_path, "wb") as dst:
-                    for chunk in f.chunks():
-                        dst.write(chunk)
-                push_file(out_path)
-            except Exception as e:
-                logger.error(f"Error copying file {fname}: {e}")
-                raise ValueError(f"Failed to copy file {fname}: {e}")
+            extracted = [run(item) for item in archives]
+    except Exception:
+        shutil.rmtree(tmp_root, ignore_errors=True)
+        raise
+
+    for entries in extracted:
+        results.extend(entries)
 
     logger.debug(f"Collected {len(results)} files from upload")
     return results, str(tmp_root)
 
-
 def match_files_for_company(company_name: str, files: List[Dict[str, Any]], max_file_mb: int = 20) -> Tuple[List[Dict[str, Any]], List[str]]:
     """
     Returns (matched_files, warnings).
@@ -224,13 +286,10 @@ def build_graph_attachments(matched_files: List[Dict[str, Any]]) -> List[Dict[st
     """
     Build Microsoft Graph attachment objects from matched files.
     """
-    import base64
-    
     attachments = []
     for file_info in matched_files:
         try:
-            with open(file_info['path'], 'rb') as f:
-                content_bytes = f.read()
+            content_bytes = read_attachment_bytes(file_info)
             content_b64 = base64.b64encode(content_bytes).decode('ascii')
             attachment = {
                 "@odata.type": "#microsoft.graph.fileAttachment",
@@ -254,6 +313,8 @@ def cleanup_temp_directory(temp_dir: str) -> bool:
     Returns True if successful, False otherwise.
     """
     try:
+        # close this directory's cached archive handles before their files disappear
+        _zip_handles.close_under(temp_dir)
         if os.path.exists(temp_dir):
             shutil.rmtree(temp_dir, ignore_errors=True)
             logger.debug(f"Successfully cleaned up temp directory: {temp_dir}")
@@ -272,10 +333,10 @@ def build_graph_file_attachment_from_path(file_path: str, content_type: str | No
     Returns a dictionary suitable for Microsoft Graph API.
     """
     try:
+        # encode in chunks so the raw file is never held next to its base64 copy
         with open(file_path, "rb") as f:
-            data = f.read()
-        
-        b64 = base64.b64encode(data).decode("utf-8")
+            b64 = b"".join(iter_base64(f)).decode("ascii")
+        size = os.path.getsize(file_path)
         name = os.path.basename(file_path)
         
         # Guess content type if not provided
@@ -291,9 +352,33 @@ def build_graph_file_attachment_from_path(file_path: str, content_type: str | No
             "contentBytes": b64,
         }
         
-        logger.debug(f"Built Graph attachment: {name} ({len(data)} bytes, {content_type})")
+        logger.debug(f"Built Graph attachment: {name} ({size} bytes, {content_type})")
         return attachment
         
     except Exception as e:
         logger.error(f"Error building attachment from {file_path}: {e}")
         raise
+
+
+
+def build_graph_file_attachment(file_info: Dict[str, Any]) -> Dict[str, str]:
+    """
+    Build a Graph API file attachment from a catalogue entry.
+    Works for both extracted files and lazily catalogued ZIP members.
+    """
+    if not file_info.get("member"):
+        attachment = build_graph_file_attachment_from_path(file_info["path"], file_info.get("content_type"))
+        # library blobs are stored under their hash, not their file name
+        attachment["name"] = file_info.get("name") or attachment["name"]
+        return attachment
+
+    with open_attachment_source(file_info) as src:
+        b64 = b"".join(iter_base64(src)).decode("ascii")
+    attachment = {
+        "@odata.type": "#microsoft.graph.fileAttachment",
+        "name": file_info["name"],
+        "contentType": file_info.get("content_type") or "application/octet-stream",
+        "contentBytes": b64,
+    }
+    logger.debug(f"Built Graph attachment from ZIP member: {file_info['member']} ({file_info['size']} bytes)")
+    return attachment
@@ -0,0 +1,366 @@
+"""
+Per-user, content-addressed attachment library.
+
+Blobs are stored once under their SHA-256 and survive the end of a
+campaign, so a file that is uploaded again next month is recognised and
+not stored twice. Campaigns hold references to blob IDs; blobs nobody
+references are garbage-collected by the cleanup_temp_files command.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+
+from .attach_matcher import open_attachment_source
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+# Campaigns whose session never released them are dropped after this long
+CAMPAIGN_TTL_HOURS = 7 * 24
+
+_thread_lock = threading.Lock()
+
+
+def _sha256_of(src: BinaryIO) -> str:
+    hasher = hashlib.sha256()
+    for chunk in iter(lambda: src.read(HASH_CHUNK_SIZE), b""):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def get_library_root() -> Path:
+    """Root directory holding every user's library."""
+    return Path(getattr(settings, "ATTACHMENT_LIBRARY_PATH", Path(settings.DATA_STORAGE_PATH) / "attachment_library"))
+
+
+class AttachmentLibrary:
+    """Content-addressed attachment store for one user."""
+
+    def __init__(self, user_id: int, root: Optional[Path] = None):
+        self.user_id = user_id
+        self.root = Path(root or get_library_root()) / f"user_{user_id}"
+        self.blobs_dir = self.root / "blobs"
+        self.index_file = self.root / "index.json"
+        self.blobs_dir.mkdir(parents=True, exist_ok=True)
+
+    # -------------------- index --------------------
+
+    @contextmanager
+    def _locked_index(self):
+        """Load the index under a process + thread lock and save it on exit."""
+        lock_path = self.root / ".lock"
+        with _thread_lock, open(lock_path, "a+") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                index = self._read_index()
+                yield index
+                self._write_index(index)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_index(self) -> Dict[str, Any]:
+        if not self.index_file.exists():
+            return {"blobs": {}, "campaigns": {}, "fingerprints": {}}
+        try:
+            with open(self.index_file, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            index.setdefault("blobs", {})
+            index.setdefault("campaigns", {})
+            if "fingerprints" not in index:
+                # ZIP member fingerprint -> blob IDs, rebuilt from older per-blob lists
+                index["fingerprints"] = {}
+                for blob_id, meta in index["blobs"].items():
+                    for fingerprint in meta.pop("fingerprints", []):
+                        index["fingerprints"].setdefault(fingerprint, []).append(blob_id)
+            return index
+        except Exception as e:
+            logger.error(f"Corrupt attachment library index for user {self.user_id}, rebuilding: {e}")
+            return {"blobs": {}, "campaigns": {}, "fingerprints": {}}
+
+    def _write_index(self, index: Dict[str, Any]) -> None:
+        tmp = self.index_file.with_suffix(".json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(index, f, indent=2, ensure_ascii=False)
+        os.replace(tmp, self.index_file)
+
+    # -------------------- blobs --------------------
+
+    def blob_path(self, blob_id: str) -> Path:
+        return self.blobs_dir / blob_id[:2] / blob_id
+
+    def has_blob(self, blob_id: str) -> bool:
+        return self.blob_path(blob_id).exists()
+
+    def _entry(self, blob_id: str, meta: Dict[str, Any], name: str) -> Dict[str, Any]:
+        return {
+            "name": name,
+            "path": str(self.blob_path(blob_id)),
+            "size": meta["size"],
+            "content_type": meta["content_type"],
+            "blob_id": blob_id,
+        }
+
+    def _register(self, blob_id: str, staged: Optional[Path], name: str, size: int, content_type: str) -> Tuple[Dict[str, Any], bool]:
+        """Move a staged file into place unless the blob exists. Returns (entry, stored)."""
+        target = self.blob_path(blob_id)
+        now = datetime.now().isoformat()
+        with self._locked_index() as index:
+            stored = False
+            if not target.exists() and staged is not None:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(staged, target)
+                stored = True
+            meta = index["blobs"].setdefault(blob_id, {
+                "size": size,
+                "content_type": content_type,
+                "names": [],
+                "created": now,
+            })
+            if name not in meta["names"]:
+                meta["names"].append(name)
+            meta["last_used"] = now
+        if staged is not None and staged.exists():
+            staged.unlink()
+        logger.debug(f"Library {'stored' if stored else 'deduplicated'} {name} as {blob_id[:12]} for user {self.user_id}")
+        return self._entry(blob_id, meta, name), stored
+
+    def missing_blobs(self, blob_ids: Iterable[str]) -> List[str]:
+        """The blob IDs from the list that are not stored yet, in order, without duplicates."""
+        missing = []
+        for blob_id in blob_ids:
+            if blob_id not in missing and not self.has_blob(blob_id):
+                missing.append(blob_id)
+        return missing
+
+    def add_stream(
+        self,
+        src: BinaryIO,
+        name: str,
+        content_type: str,
+        move_from: Optional[Path] = None,
+        expected_sha256: Optional[str] = None
+    ) -> Tuple[Dict[str, Any], bool]:
+        """
+        Add the content of a stream to the library.
+
+        The stream is hashed while it is staged, so it is read once. When
+        move_from names a file on the same filesystem that holds the same
+        content, it is moved into place instead of staging a copy.
+
+        Args:
+            expected_sha256: Reject the content unless it hashes to this value
+
+        Returns:
+            Tuple of (catalogue entry, whether a new blob was stored)
+
+        Raises:
+            ValueError: If the content doesn't match expected_sha256
+        """
+        hasher = hashlib.sha256()
+        size = 0
+        if move_from is not None:
+            while True:
+                chunk = src.read(HASH_CHUNK_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                size += len(chunk)
+            blob_id = hasher.hexdigest()
+            if self.has_blob(blob_id):
+                return self._register(blob_id, None, name, size, content_type)
+            staged = self.root / f".staged_{uuid.uuid4().hex}"
+            try:
+                os.replace(move_from, staged)
+            except OSError:
+                shutil.copyfile(move_from, staged)
+            return self._register(blob_id, staged, name, size, content_type)
+
+        fd, staged_name = tempfile.mkstemp(prefix=".staged_", dir=self.root)
+        staged = Path(staged_name)
+        try:
+            with os.fdopen(fd, "wb") as dst:
+                while True:
+                    chunk = src.read(HASH_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    dst.write(chunk)
+                    size += len(chunk)
+            blob_id = hasher.hexdigest()
+            if expected_sha256 and blob_id != expected_sha256.lower():
+                raise ValueError(f"Content of {name} does not match its SHA-256 ({expected_sha256})")
+            return self._register(blob_id, staged, name, size, content_type)
+        finally:
+            if staged.exists():
+                staged.unlink()
+
+    def find_by_fingerprint(
+        self,
+        name: str,
+        size: int,
+        crc: int,
+        fingerprints: Optional[Dict[str, List[str]]] = None
+    ) -> List[str]:
+        """
+        Blobs previously imported from a ZIP member with the same name, size
+        and CRC-32. These are candidates only: CRC-32 collides, so the
+        member's content must be confirmed against the blob's SHA-256.
+        """
+        if fingerprints is None:
+            fingerprints = self._read_index()["fingerprints"]
+        candidates = fingerprints.get(f"{name}:{size}:{crc:08x}", [])
+        return [blob_id for blob_id in candidates if self.has_blob(blob_id)]
+
+    def import_catalogue(self, files: Iterable[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Import catalogue entries (extracted files or lazy ZIP members) into the library.
+
+        Returns:
+            Tuple of (library catalogue entries, number of new blobs stored)
+        """
+        entries = []
+        stored_count = 0
+        fingerprints = self._read_index()["fingerprints"]
+        for file_info in files:
+            name = file_info["name"]
+            content_type = file_info.get("content_type") or "application/octet-stream"
+
+            crc = file_info.get("crc")
+            if file_info.get("member") and crc is not None:
+                candidates = self.find_by_fingerprint(name, file_info["size"], crc, fingerprints)
+                if candidates:
+                    # Hashing the member confirms the match without staging a copy
+                    with open_attachment_source(file_info) as src:
+                        blob_id = _sha256_of(src)
+                    if blob_id in candidates:
+                        entry, _ = self._register(blob_id, None, name, file_info["size"], content_type)
+                        entries.append(entry)
+                        continue
+                    logger.warning(f"CRC-32 collision for {name}: content differs from the library blob")
+
+            move_from = None if file_info.get("member") else Path(file_info["path"])
+            with open_attachment_source(file_info) as src:
+                entry, stored = self.add_stream(src, name, content_type, move_from=move_from)
+            if crc is not None:
+                fingerprints = self._remember_fingerprint(entry["blob_id"], f"{name}:{entry['size']}:{crc:08x}")
+            stored_count += int(stored)
+            entries.append(entry)
+
+        logger.info(f"Library import for user {self.user_id}: {len(entries)} files, {stored_count} new blobs")
+        return entries, stored_count
+
+    def _remember_fingerprint(self, blob_id: str, fingerprint: str) -> Dict[str, List[str]]:
+        """Map a member fingerprint to blob_id; returns the updated fingerprint map."""
+        with self._locked_index() as index:
+            blob_ids = index["fingerprints"].setdefault(fingerprint, [])
+            if blob_id not in blob_ids:
+                blob_ids.append(blob_id)
+        return index["fingerprints"]
+
+    def catalogue(self, blob_ids: Iterable[str], names: Optional[Iterable[str]] = None) -> List[Dict[str, Any]]:
+        """
+        Catalogue entries for library blobs.
+
+        Entries are named after names when given (one per blob ID),
+        otherwise after the blob's latest upload.
+        """
+        index = self._read_index()
+        blob_ids = list(blob_ids)
+        names = list(names) if names is not None else [None] * len(blob_ids)
+        entries = []
+        for blob_id, name in zip(blob_ids, names):
+            meta = index["blobs"].get(blob_id)
+            if meta and self.has_blob(blob_id):
+                entries.append(self._entry(blob_id, meta, name or meta["names"][-1]))
+        return entries
+
+    # -------------------- campaigns --------------------
+
+    def reference(self, blob_ids: Iterable[str], campaign_id: Optional[str] = None) -> str:
+        """Record that a campaign uses these blobs. Returns the campaign ID."""
+        campaign_id = campaign_id or uuid.uuid4().hex
+        with self._locked_index() as index:
+            campaign = index["campaigns"].setdefault(campaign_id, {
+                "blobs": [],
+                "created": time.time(),
+            })
+            for blob_id in blob_ids:
+                if blob_id not in campaign["blobs"]:
+                    campaign["blobs"].append(blob_id)
+        return campaign_id
+
+    def release(self, campaign_id: str) -> None:
+        """Drop a campaign's references; its blobs stay until garbage-collected."""
+        with self._locked_index() as index:
+            index["campaigns"].pop(campaign_id, None)
+        logger.debug(f"Released library campaign {campaign_id} for user {self.user_id}")
+
+    def collect_garbage(self, min_age_hours: float = 24, dry_run: bool = False) -> Tuple[int, int]:
+        """
+        Delete blobs no campaign references and nobody used for min_age_hours.
+        Campaigns older than CAMPAIGN_TTL_HOURS are treated as abandoned.
+
+        Returns:
+            Tuple of (deleted blob count, freed bytes)
+        """
+        now = time.time()
+        cutoff = now - min_age_hours * 3600
+        deleted = 0
+        freed = 0
+        with self._locked_index() as index:
+            for campaign_id, campaign in list(index["campaigns"].items()):
+                if campaign.get("created", 0) < now - CAMPAIGN_TTL_HOURS * 3600 and not dry_run:
+                    del index["campaigns"][campaign_id]
+
+            referenced = {b for c in index["campaigns"].values() for b in c["blobs"]}
+            for blob_id, meta in list(index["blobs"].items()):
+                if blob_id in referenced:
+                    continue
+                last_used = datetime.fromisoformat(meta.get("last_used", meta["created"])).timestamp()
+                if last_used >= cutoff:
+                    continue
+                deleted += 1
+                freed += meta.get("size", 0)
+                if not dry_run:
+                    self.blob_path(blob_id).unlink(missing_ok=True)
+                    del index["blobs"][blob_id]
+            if not dry_run:
+                for fingerprint, blob_ids in list(index["fingerprints"].items()):
+                    blob_ids[:] = [b for b in blob_ids if b in index["blobs"]]
+                    if not blob_ids:
+                        del index["fingerprints"][fingerprint]
+        if deleted:
+            logger.info(f"Library GC for user {self.user_id}: {deleted} blobs, {freed} bytes")
+        return deleted, freed
+
+
+def iter_libraries(root: Optional[Path] = None) -> Iterable[AttachmentLibrary]:
+    """Every user library present on disk."""
+    root = Path(root or get_library_root())
+    if not root.exists():
+        return
+    for user_dir in sorted(root.glob("user_*")):
+        try:
+            user_id = int(user_dir.name.split("_", 1)[1])
+        except ValueError:
+            continue
+        yield AttachmentLibrary(user_id, root=root)
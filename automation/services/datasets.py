@@ -0,0 +1,196 @@
+"""
+Server-side cache of parsed recipient datasets.
+
+An uploaded recipient list is parsed once and stored per user under the
+SHA-256 of its content and the reader options that parsed it; the session
+only keeps that dataset ID. The preview
+and confirm steps load the stored frame (memory-mapped Arrow when pyarrow is
+installed, a pickle otherwise) instead of re-parsing the workbook.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+from django.conf import settings
+
+try:
+    import pyarrow
+    import pyarrow.feather as feather
+    ARROW_SUPPORT = True
+except ImportError:
+    ARROW_SUPPORT = False
+
+logger = logging.getLogger(__name__)
+
+_DATASET_ID = re.compile(r"[0-9a-f]{64}")
+
+
+def get_dataset_root() -> Path:
+    """Root directory holding every user's dataset cache."""
+    return Path(getattr(settings, "DATASET_CACHE_PATH", Path(settings.DATA_STORAGE_PATH) / "datasets"))
+
+
+class DatasetStore:
+    """Parsed recipient datasets of one user, keyed by content hash."""
+
+    def __init__(self, user_id: int, root: Optional[Path] = None):
+        self.user_id = user_id
+        self.root = Path(root or get_dataset_root()) / f"user_{user_id}"
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _meta_path(self, dataset_id: str) -> Path:
+        if not _DATASET_ID.fullmatch(dataset_id or ""):
+            raise ValueError(f"Invalid dataset ID: {dataset_id!r}")
+        return self.root / f"{dataset_id}.json"
+
+    def meta(self, dataset_id: str) -> Optional[Dict[str, Any]]:
+        """Stored metadata (rows, columns, format, source name), or None if the dataset is gone."""
+        meta_path = self._meta_path(dataset_id)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return meta if (self.root / meta["file"]).exists() else None
+
+    def exists(self, dataset_id: str) -> bool:
+        try:
+            return self.meta(dataset_id) is not None
+        except ValueError:
+            return False
+
+    def put(
+        self,
+        content: bytes,
+        parser: Callable[[bytes], pd.DataFrame],
+        name: str = "",
+        options: Optional[Dict[str, Any]] = None
+    ) -> Tuple[str, pd.DataFrame]:
+        """
+        Parse content with parser unless an identical upload is cached.
+
+        Args:
+            content: Uploaded file
+            parser: Turns content into a DataFrame
+            name: Source file name, kept in the metadata
+            options: Format and reader settings parser depends on; the same
+                bytes read differently are cached separately
+
+        Returns:
+            Tuple of (dataset ID, parsed DataFrame)
+        """
+        digest = hashlib.sha256(content)
+        if options:
+            digest.update(json.dumps(options, sort_keys=True, default=str).encode("utf-8"))
+        dataset_id = digest.hexdigest()
+        if self.exists(dataset_id):
+            logger.debug(f"Dataset {dataset_id[:12]} already parsed for user {self.user_id}")
+            return dataset_id, self.load(dataset_id)
+
+        start = time.perf_counter()
+        df = parser(content)
+        self.save(dataset_id, df, name, parse_seconds=time.perf_counter() - start)
+        return dataset_id, df
+
+    def save(self, dataset_id: str, df: pd.DataFrame, name: str = "", parse_seconds: float = 0.0) -> None:
+        """Write a parsed frame under dataset_id (atomically)."""
+        meta_path = self._meta_path(dataset_id)
+        tmp = self.root / f".tmp_{uuid.uuid4().hex}"
+        fmt = "pickle"
+        try:
+            if ARROW_SUPPORT:
+                try:
+                    df.reset_index(drop=True).to_feather(tmp)
+                    fmt = "arrow"
+                except (pyarrow.ArrowException, TypeError, ValueError) as e:
+                    # Mixed-type object columns don't convert to Arrow
+                    logger.debug(f"Dataset {dataset_id[:12]} not Arrow-compatible, pickling: {e}")
+            if fmt == "pickle":
+                df.to_pickle(tmp)
+            data_file = f"{dataset_id}.{fmt}"
+            os.replace(tmp, self.root / data_file)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+
+        meta = {
+            "file": data_file,
+            "format": fmt,
+            "name": name,
+            "rows": len(df),
+            "columns": [str(c) for c in df.columns],
+            "parse_seconds": round(parse_seconds, 3),
+            "created": time.time(),
+        }
+        meta_tmp = meta_path.with_suffix(".json.tmp")
+        with open(meta_tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(meta_tmp, meta_path)
+        logger.info(f"Cached dataset {dataset_id[:12]} for user {self.user_id}: {len(df)} rows as {fmt}")
+
+    def load(self, dataset_id: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Load a cached dataset, or only some of its columns.
+
+        Raises:
+            FileNotFoundError: If the dataset is not cached (any more)
+        """
+        meta = self.meta(dataset_id)
+        if meta is None:
+            raise FileNotFoundError(f"Dataset {dataset_id} is not cached")
+        path = self.root / meta["file"]
+        # Touch for the garbage collector
+        os.utime(path)
+        if meta["format"] == "arrow" and ARROW_SUPPORT:
+            return feather.read_table(path, columns=columns, memory_map=True).to_pandas()
+        df = pd.read_pickle(path)
+        return df[columns] if columns is not None else df
+
+    def collect_garbage(self, min_age_hours: float = 24, dry_run: bool = False) -> Tuple[int, int]:
+        """
+        Delete datasets nobody loaded for min_age_hours.
+
+        Returns:
+            Tuple of (deleted dataset count, freed bytes)
+        """
+        cutoff = time.time() - min_age_hours * 3600
+        deleted = 0
+        freed = 0
+        for meta_path in self.root.glob("*.json"):
+            try:
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    data_path = self.root / json.load(f)["file"]
+            except (OSError, ValueError, KeyError):
+                data_path = None
+            last_used = data_path.stat().st_mtime if data_path and data_path.exists() else 0
+            if last_used >= cutoff:
+                continue
+            deleted += 1
+            freed += data_path.stat().st_size if data_path and data_path.exists() else 0
+            if not dry_run:
+                if data_path:
+                    data_path.unlink(missing_ok=True)
+                meta_path.unlink(missing_ok=True)
+        if deleted:
+            logger.info(f"Dataset GC for user {self.user_id}: {deleted} datasets, {freed} bytes")
+        return deleted, freed
+
+
+def iter_dataset_stores(root: Optional[Path] = None) -> Iterable[DatasetStore]:
+    """Every user dataset cache present on disk."""
+    root = Path(root or get_dataset_root())
+    if not root.exists():
+        return
+    for user_dir in sorted(root.glob("user_*")):
+        try:
+            user_id = int(user_dir.name.split("_", 1)[1])
+        except ValueError:
+            continue
+        yield DatasetStore(user_id, root=root)
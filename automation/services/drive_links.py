@@ -0,0 +1,107 @@
+"""
+Attachments sent as OneDrive sharing links.
+
+Each distinct attachment of a campaign is uploaded once to the sender's
+OneDrive through an upload session and every message links to it, so the
+bytes sent grow with the number of distinct files rather than with the
+number of recipients.
+"""
+import html
+import logging
+import threading
+from datetime import datetime
+from typing import Callable, Dict, Hashable, List, Optional
+
+from .graph_client import create_sharing_link, upload_drive_file
+from .graph_payload import AttachmentSource
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FOLDER = "Mail Automation"
+
+
+class DriveLinkPublisher:
+    """
+    Uploads a campaign's attachments to OneDrive and hands out their links.
+
+    Safe to share between pipeline workers: a file requested by several
+    threads at once is uploaded by the first one while the others wait.
+    """
+
+    def __init__(
+        self,
+        token_provider: Callable[[], str],
+        folder: Optional[str] = None,
+        scope: str = "organization",
+        timeout: int = 60
+    ):
+        self._token_provider = token_provider
+        campaign = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+        self.folder = f"{(folder or DEFAULT_FOLDER).strip('/')}/{campaign}"
+        self.scope = scope
+        self.timeout = timeout
+        self._links: Dict[Hashable, Dict[str, str]] = {}
+        self._key_locks: Dict[Hashable, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self.uploads = 0
+        self.uploaded_bytes = 0
+        self.reused = 0
+
+    @staticmethod
+    def _key(source: AttachmentSource) -> Hashable:
+        if source.key is not None:
+            return (source.key, source.name)
+        return (source.name, source.size, source.content_type)
+
+    def link(self, source: AttachmentSource) -> Dict[str, str]:
+        """
+        Sharing link for an attachment, uploading it on first use.
+
+        Returns:
+            Dict with the file "name" and the link "url"
+
+        Raises:
+            requests.HTTPError: If the upload or the link creation fails
+        """
+        key = self._key(source)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            link = self._links.get(key)
+            if link is not None:
+                with self._lock:
+                    self.reused += 1
+                return link
+
+            access_token = self._token_provider()
+            with source.open() as stream:
+                item = upload_drive_file(
+                    access_token, f"{self.folder}/{source.name}", stream, source.size, self.timeout
+                )
+            url = create_sharing_link(access_token, item["id"], self.scope, timeout=self.timeout)
+            link = {"name": source.name, "url": url}
+            self._links[key] = link
+            with self._lock:
+                self.uploads += 1
+                self.uploaded_bytes += source.size
+            logger.debug(f"Uploaded {source.name} ({source.size} bytes) to OneDrive as {item['id']}")
+            return link
+
+    def links(self, sources: List[AttachmentSource]) -> List[Dict[str, str]]:
+        return [self.link(source) for source in sources]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"uploads": self.uploads, "uploaded_bytes": self.uploaded_bytes, "reused": self.reused}
+
+
+def append_links_html(body: str, links: List[Dict[str, str]], heading: str = "Ekler") -> str:
+    """The HTML body with a list of attachment links appended."""
+    if not links:
+        return body
+    items = "".join(
+        f'<li><a href="{html.escape(link["url"], quote=True)}">{html.escape(link["name"])}</a></li>'
+        for link in links
+    )
+    return f"{body}<br><br><p>{html.escape(heading)}:</p><ul>{items}</ul>"
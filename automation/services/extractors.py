@@ -0,0 +1,523 @@
+"""
+Archive extractors for uploaded attachments.
+
+Every supported format is an ArchiveExtractor registered in a module-level
+registry. An upload is only treated as an archive when its magic bytes and
+its extension agree, so documents that are ZIP containers (.docx, .xlsx,
+.odt...) and compressed single files (report.csv.gz) are attached as they
+are. Extractors stream members into a target directory and charge every
+member to the shared ExtractionBudget.
+"""
+import bz2
+import gzip
+import io
+import logging
+import lzma
+import mimetypes
+import shutil
+import tarfile
+import threading
+import zipfile
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple, Union
+
+from ..exceptions import ArchiveLimitError
+
+try:
+    import rarfile
+    RAR_SUPPORT = True
+except ImportError:
+    RAR_SUPPORT = False
+
+try:
+    import py7zr
+    SEVEN_ZIP_SUPPORT = True
+except ImportError:
+    SEVEN_ZIP_SUPPORT = False
+
+logger = logging.getLogger(__name__)
+
+COPY_CHUNK_SIZE = 1024 * 1024
+HEADER_SIZE = 512
+
+# Extensions that promise an archive; an upload is extracted only when its magic agrees
+ARCHIVE_EXTENSIONS = (".zip", ".rar", ".7z", ".tar", ".tgz", ".tbz2", ".txz", ".gz", ".bz2", ".xz")
+
+# Members marking a ZIP as an OOXML (docx/xlsx/pptx) or ODF document
+DOCUMENT_CONTAINER_MEMBERS = ("[Content_Types].xml", "mimetype")
+
+
+class ExtractionBudget:
+    """
+    Running limits for one upload's archive extraction.
+
+    Members are admitted on their declared (central directory) sizes before
+    anything is decompressed, then the bytes actually written are counted as
+    they are copied, so a lying header can't get past the total either.
+    Members larger than max_file_bytes are skipped; everything else that
+    breaks a limit aborts the whole upload with ArchiveLimitError.
+    A budget may be shared by archives extracted concurrently.
+    """
+
+    def __init__(
+        self,
+        max_total_bytes: int = 500 * 1024 * 1024,
+        max_files: int = 2000,
+        max_ratio: float = 100.0,
+        max_file_bytes: int = 20 * 1024 * 1024,
+        ratio_min_bytes: int = 1024 * 1024
+    ):
+        self.max_total_bytes = max_total_bytes
+        self.max_files = max_files
+        self.max_ratio = max_ratio
+        self.max_file_bytes = max_file_bytes
+        # small members compress absurdly well without being a threat
+        self.ratio_min_bytes = ratio_min_bytes
+        self.files = 0
+        self.declared_bytes = 0
+        self.written_bytes = 0
+        self.skipped: List[str] = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, max_file_mb: int = 20) -> "ExtractionBudget":
+        """Build a budget from the ARCHIVE_* settings."""
+        from django.conf import settings
+
+        return cls(
+            max_total_bytes=getattr(settings, "ARCHIVE_MAX_TOTAL_MB", 500) * 1024 * 1024,
+            max_files=getattr(settings, "ARCHIVE_MAX_FILES", 2000),
+            max_ratio=getattr(settings, "ARCHIVE_MAX_RATIO", 100),
+            max_file_bytes=max_file_mb * 1024 * 1024,
+        )
+
+    def admit(self, name: str, declared_size: int, compressed_size: int) -> bool:
+        """
+        Check a member before decompressing it.
+        Returns False if the member should be skipped, raises if the archive must be rejected.
+        """
+        if declared_size > self.max_file_bytes:
+            warn_msg = f"Skipped large file >{self.max_file_bytes // (1024 * 1024)}MB: {name}"
+            with self._lock:
+                self.skipped.append(warn_msg)
+            logger.warning(warn_msg)
+            return False
+
+        if declared_size >= self.ratio_min_bytes and declared_size > self.max_ratio * max(compressed_size, 1):
+            raise ArchiveLimitError(
+                f"Archive rejected: {name} expands {declared_size // max(compressed_size, 1)}x "
+                f"(limit {self.max_ratio:g}x). It looks like a decompression bomb."
+            )
+
+        with self._lock:
+            self.files += 1
+            self.declared_bytes += declared_size
+            files, declared = self.files, self.declared_bytes
+        if files > self.max_files:
+            raise ArchiveLimitError(f"Archive rejected: more than {self.max_files} files.")
+        if declared > self.max_total_bytes:
+            raise ArchiveLimitError(
+                f"Archive rejected: contents exceed {self.max_total_bytes // (1024 * 1024)} MB uncompressed."
+            )
+        return True
+
+    def consume(self, name: str, nbytes: int) -> None:
+        """Account for bytes actually written while extracting."""
+        with self._lock:
+            self.written_bytes += nbytes
+            written = self.written_bytes
+        if written > self.max_total_bytes:
+            raise ArchiveLimitError(
+                f"Archive rejected while extracting {name}: contents exceed "
+                f"{self.max_total_bytes // (1024 * 1024)} MB uncompressed."
+            )
+
+
+def copy_member(src: BinaryIO, dst: BinaryIO, name: str, budget: ExtractionBudget) -> int:
+    """Copy an archive member in chunks, charging every chunk to the budget."""
+    copied = 0
+    while True:
+        chunk = src.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            break
+        budget.consume(name, len(chunk))
+        dst.write(chunk)
+        copied += len(chunk)
+    return copied
+
+
+def file_entry(path: Path) -> Dict[str, Any]:
+    """Catalogue entry for a file on disk."""
+    ctype, _ = mimetypes.guess_type(str(path))
+    size = path.stat().st_size
+    logger.debug(f"Added file: {path.name} ({size} bytes, {ctype})")
+    return {
+        "name": path.name,
+        "path": str(path),
+        "size": size,
+        "content_type": ctype or "application/octet-stream"
+    }
+
+
+def member_path(out_dir: Path, member_name: str) -> Path:
+    """
+    Where to write an archive member: its base name in out_dir, or in a
+    numbered subdirectory when another member already took that name.
+    The base name is kept so both files are attached under the same name,
+    as the lazy ZIP catalogue does.
+    """
+    # avoid path traversal
+    base_name = Path(member_name).name
+    out_path = out_dir / base_name
+    n = 1
+    while out_path.exists():
+        out_path = out_dir / f"_{n}" / base_name
+        n += 1
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    return out_path
+
+
+Source = Union[str, Path, BinaryIO]
+
+
+class ArchiveExtractor:
+    """
+    Base class for archive formats.
+
+    Subclasses declare their magic bytes as (offset, signature) pairs and the
+    extensions they claim, and implement extract(). accepts() can look past
+    the magic bytes to turn down files that merely share a container format.
+    Formats whose library can only work on a real file set needs_path; ZIP
+    additionally supports catalogue() for lazy access.
+    """
+
+    name = ""
+    label = ""
+    magic: Tuple[Tuple[int, bytes], ...] = ()
+    extensions: Tuple[str, ...] = ()
+    dir_suffix = "_extracted"
+    needs_path = False
+    supports_catalogue = False
+
+    @property
+    def available(self) -> bool:
+        return True
+
+    def matches(self, header: bytes) -> bool:
+        return any(header[offset:offset + len(sig)] == sig for offset, sig in self.magic)
+
+    def claims(self, name: str) -> bool:
+        return (name or "").lower().endswith(self.extensions)
+
+    def accepts(self, file_obj: "Source", header: bytes) -> bool:
+        """Whether a file with matching magic bytes really is an archive to extract."""
+        return True
+
+    def extract(self, source: Source, out_dir: Path, budget: ExtractionBudget) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def catalogue(self, archive_path: Path, budget: ExtractionBudget) -> List[Dict[str, Any]]:
+        raise NotImplementedError(f"{self.label} archives can't be catalogued lazily")
+
+    def _write_member(self, src: BinaryIO, member_name: str, out_dir: Path, budget: ExtractionBudget) -> Dict[str, Any]:
+        out_path = member_path(out_dir, member_name)
+        logger.debug(f"Extracting: {member_name} -> {out_path}")
+        with open(out_path, "wb") as dst:
+            copy_member(src, dst, member_name, budget)
+        return file_entry(out_path)
+
+
+class ZipExtractor(ArchiveExtractor):
+    name = "zip"
+    label = "ZIP"
+    magic = ((0, b"PK\x03\x04"), (0, b"PK\x05\x06"))
+    extensions = (".zip",)
+    dir_suffix = "_unzipped"
+    supports_catalogue = True
+
+    def accepts(self, file_obj, header):
+        # An OOXML/ODF document renamed to .zip is still a document
+        try:
+            with _opened(file_obj) as f, zipfile.ZipFile(f, "r") as zf:
+                names = zf.namelist()
+        except zipfile.BadZipFile:
+            return True
+        return not any(name in DOCUMENT_CONTAINER_MEMBERS for name in names)
+
+    def extract(self, source, out_dir, budget):
+        results = []
+        try:
+            with zipfile.ZipFile(source, "r") as zf:
+                for member in zf.infolist():
+                    # skip directories
+                    if member.is_dir():
+                        continue
+                    if not budget.admit(member.filename, member.file_size, member.compress_size):
+                        continue
+                    with zf.open(member) as src:
+                        results.append(self._write_member(src, member.filename, out_dir, budget))
+        except zipfile.BadZipFile as e:
+            raise ValueError(f"Invalid ZIP file: {e}") from e
+        return results
+
+    def catalogue(self, archive_path, budget):
+        """
+        Build the file catalogue from the central directory only.
+        No member is decompressed; entries carry the archive path plus "member" and "crc".
+        """
+        results = []
+        with zipfile.ZipFile(archive_path, "r") as zf:
+            for member in zf.infolist():
+                if member.is_dir():
+                    continue
+                if not budget.admit(member.filename, member.file_size, member.compress_size):
+                    continue
+                # avoid path traversal, same naming as extracted files
+                safe_name = Path(member.filename).name
+                ctype, _ = mimetypes.guess_type(safe_name)
+                results.append({
+                    "name": safe_name,
+                    "path": str(archive_path),
+                    "member": member.filename,
+                    "size": member.file_size,
+                    "crc": member.CRC,
+                    "content_type": ctype or "application/octet-stream"
+                })
+                logger.debug(f"Catalogued: {member.filename} ({member.file_size} bytes, crc={member.CRC:08x})")
+        return results
+
+
+class RarExtractor(ArchiveExtractor):
+    name = "rar"
+    label = "RAR"
+    magic = ((0, b"Rar!\x1a\x07"),)
+    extensions = (".rar",)
+    dir_suffix = "_unrarred"
+    needs_path = True
+
+    @property
+    def available(self) -> bool:
+        return RAR_SUPPORT
+
+    def extract(self, source, out_dir, budget):
+        if not RAR_SUPPORT:
+            raise ValueError("RAR support not available. Please install rarfile: pip install rarfile")
+
+        results = []
+        try:
+            with rarfile.RarFile(source) as rf:
+                members = rf.infolist()
+                logger.debug(f"RAR file contains {len(members)} members")
+                for member in members:
+                    if member.is_dir():
+                        logger.debug(f"Skipping directory: {member.filename}")
+                        continue
+                    if not budget.admit(member.filename, member.file_size, member.compress_size):
+                        continue
+                    with rf.open(member) as src:
+                        results.append(self._write_member(src, member.filename, out_dir, budget))
+        except rarfile.BadRarFile as e:
+            raise ValueError("Invalid RAR file. The file may be corrupted or not a valid RAR archive.") from e
+        except rarfile.RarCannotExec as e:
+            raise ValueError("RAR extraction failed. Please ensure unrar is installed on the system.") from e
+        return results
+
+
+class TarExtractor(ArchiveExtractor):
+    """
+    Plain and compressed tarballs, read in stream mode so members are
+    decompressed once, in order, without seeking.
+    """
+
+    name = "tar"
+    label = "TAR"
+    magic = (
+        (257, b"ustar"),
+        (0, b"\x1f\x8b"),        # gzip
+        (0, b"BZh"),             # bzip2
+        (0, b"\xfd7zXZ\x00"),    # xz
+    )
+    extensions = (".tar", ".tgz", ".tbz2", ".txz", ".gz", ".bz2", ".xz")
+    _decompressors = (
+        (b"\x1f\x8b", lambda f: gzip.GzipFile(fileobj=f)),
+        (b"BZh", bz2.BZ2File),
+        (b"\xfd7zXZ\x00", lzma.LZMAFile),
+    )
+
+    def accepts(self, file_obj, header):
+        """A compressed file is a tarball only if its first decompressed block is a tar header."""
+        if header[257:262] == b"ustar":
+            return True
+        for signature, opener in self._decompressors:
+            if header.startswith(signature):
+                try:
+                    with _opened(file_obj) as f, opener(f) as stream:
+                        block = stream.read(HEADER_SIZE)
+                    tarfile.TarInfo.frombuf(block, tarfile.ENCODING, "surrogateescape")
+                    return True
+                except (OSError, EOFError, lzma.LZMAError, tarfile.TarError):
+                    return False
+        return False
+
+    def extract(self, source, out_dir, budget):
+        results = []
+        fileobj = source if hasattr(source, "read") else open(source, "rb")
+        # The whole compressed stream is the upper bound for any member's compressed size
+        archive_size = _stream_size(fileobj)
+        try:
+            with tarfile.open(fileobj=fileobj, mode="r|*") as tf:
+                for member in tf:
+                    if not member.isfile():
+                        continue
+                    if not budget.admit(member.name, member.size, archive_size):
+                        continue
+                    src = tf.extractfile(member)
+                    results.append(self._write_member(src, member.name, out_dir, budget))
+        except tarfile.TarError as e:
+            raise ValueError(f"Invalid TAR archive: {e}") from e
+        finally:
+            if fileobj is not source:
+                fileobj.close()
+        return results
+
+
+class SevenZipExtractor(ArchiveExtractor):
+    name = "7z"
+    label = "7Z"
+    magic = ((0, b"7z\xbc\xaf\x27\x1c"),)
+    extensions = (".7z",)
+
+    @property
+    def available(self) -> bool:
+        return SEVEN_ZIP_SUPPORT
+
+    def extract(self, source, out_dir, budget):
+        if not SEVEN_ZIP_SUPPORT:
+            raise ValueError("7z support not available. Please install py7zr: pip install py7zr")
+
+        results = []
+        # py7zr writes the archive's folder tree; members are flattened from here
+        staging = out_dir / ".7z_staging"
+        try:
+            with py7zr.SevenZipFile(source, mode="r") as archive:
+                targets = []
+                for info in archive.list():
+                    if info.is_directory:
+                        continue
+                    if budget.admit(info.filename, info.uncompressed, info.compressed or 0):
+                        targets.append(info.filename)
+                if not targets:
+                    return results
+                # py7zr decodes solid blocks as a whole, so let it write the admitted members
+                archive.extract(path=staging, targets=targets)
+
+            for member_name in targets:
+                flat = member_path(out_dir, member_name)
+                (staging / member_name).replace(flat)
+                budget.consume(member_name, flat.stat().st_size)
+                results.append(file_entry(flat))
+        except py7zr.Bad7zFile as e:
+            raise ValueError(f"Invalid 7z archive: {e}") from e
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        return results
+
+
+def _stream_size(fileobj: BinaryIO) -> int:
+    size = getattr(fileobj, "size", None)
+    if size:
+        return size
+    try:
+        pos = fileobj.tell()
+        fileobj.seek(0, io.SEEK_END)
+        size = fileobj.tell()
+        fileobj.seek(pos)
+        return size
+    except (AttributeError, OSError):
+        return 0
+
+
+_EXTRACTORS: List[ArchiveExtractor] = []
+
+
+def register_extractor(extractor: ArchiveExtractor) -> ArchiveExtractor:
+    """Register an extractor; later registrations win when magic bytes overlap."""
+    _EXTRACTORS.insert(0, extractor)
+    return extractor
+
+
+def get_extractors() -> List[ArchiveExtractor]:
+    return list(_EXTRACTORS)
+
+
+class _opened:
+    """
+    A file object for a path or upload, rewound; an upload's position is
+    restored on exit and a path's file is closed.
+    """
+
+    def __init__(self, file_obj: Source):
+        self.file_obj = file_obj
+
+    def __enter__(self) -> BinaryIO:
+        if not hasattr(self.file_obj, "read"):
+            self._own = open(self.file_obj, "rb")
+            return self._own
+        self._own = None
+        self._pos = self.file_obj.tell() if hasattr(self.file_obj, "tell") else 0
+        self.file_obj.seek(0)
+        return self.file_obj
+
+    def __exit__(self, *exc) -> None:
+        if self._own is not None:
+            self._own.close()
+        else:
+            self.file_obj.seek(self._pos)
+
+
+def source_name(file_obj: Source, name: Optional[str] = None) -> str:
+    """The file name of an upload or path (name wins when given)."""
+    if name:
+        return name
+    if hasattr(file_obj, "read"):
+        return Path(getattr(file_obj, "name", "") or "").name
+    return Path(file_obj).name
+
+
+def read_header(file_obj: Source) -> bytes:
+    """Read the first bytes of an upload or file without moving its position."""
+    if not hasattr(file_obj, "read"):
+        with open(file_obj, "rb") as f:
+            return f.read(HEADER_SIZE)
+    pos = file_obj.tell() if hasattr(file_obj, "tell") else 0
+    file_obj.seek(0)
+    header = file_obj.read(HEADER_SIZE)
+    file_obj.seek(pos)
+    return header
+
+
+def detect_extractor(file_obj: Source, name: Optional[str] = None) -> Optional[ArchiveExtractor]:
+    """
+    Pick the extractor whose extension and magic bytes both match the file,
+    or None for a file to attach as it is.
+    """
+    name = source_name(file_obj, name)
+    header = read_header(file_obj)
+    for extractor in _EXTRACTORS:
+        if extractor.claims(name) and extractor.matches(header) and extractor.accepts(file_obj, header):
+            return extractor
+    return None
+
+
+def is_broken_archive(file_obj: Source, name: Optional[str] = None) -> bool:
+    """True when the extension promises an archive whose magic bytes are missing."""
+    name = source_name(file_obj, name)
+    claimed = [e for e in _EXTRACTORS if e.claims(name)]
+    if not claimed:
+        return False
+    header = read_header(file_obj)
+    return not any(e.matches(header) for e in claimed)
+
+
+for _extractor in (ZipExtractor(), RarExtractor(), TarExtractor(), SevenZipExtractor()):
+    register_extractor(_extractor)
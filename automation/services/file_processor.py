@@ -4,10 +4,12 @@ File processing service for handling uploads and attachments.
 import base64
 import logging
 from typing import List, Dict, Any, Optional, Tuple
+from django.conf import settings
 from django.core.files.uploadedfile import UploadedFile
 from pathlib import Path
 
 from ..exceptions import FileProcessingError
+from .extractors import detect_extractor
 from .attach_matcher import (
     collect_files_from_upload,
     match_files_for_company,
@@ -33,13 +35,16 @@ class FileProcessorService:
     
     def process_uploaded_files(
         self,
-        uploaded_files: List[UploadedFile]
+        uploaded_files: List[UploadedFile],
+        lazy_zip: Optional[bool] = None
     ) -> Tuple[List[Dict[str, Any]], str]:
         """
-        Process uploaded files (ZIP or individual files).
+        Process uploaded files (archives or individual files).
         
         Args:
             uploaded_files: List of Django uploaded file objects
+            lazy_zip: Catalogue ZIPs without extracting them
+                (defaults to settings.LAZY_ZIP_ATTACHMENTS)
             
         Returns:
             Tuple of (processed_files_list, temp_directory_path)
@@ -47,12 +52,33 @@ class FileProcessorService:
         Raises:
             FileProcessingError: If file processing fails
         """
+        if lazy_zip is None:
+            lazy_zip = getattr(settings, "LAZY_ZIP_ATTACHMENTS", False)
         try:
-            return collect_files_from_upload(uploaded_files, self.base_temp_dir)
+            return collect_files_from_upload(
+                uploaded_files,
+                self.base_temp_dir,
+                lazy_zip=lazy_zip,
+                max_workers=getattr(settings, "ARCHIVE_EXTRACT_WORKERS", 4)
+            )
+        except FileProcessingError:
+            raise
         except Exception as e:
             logger.error(f"Error processing uploaded files: {e}")
             raise FileProcessingError(f"Failed to process uploaded files: {e}") from e
     
+    def is_archive(self, file_obj: UploadedFile) -> bool:
+        """
+        Check whether an upload is a supported archive, by extension and magic bytes.
+        
+        Args:
+            file_obj: Django uploaded file object
+            
+        Returns:
+            True if an extractor recognises the file
+        """
+        return detect_extractor(file_obj) is not None
+    
     def find_matching_files(
         self,
         company_name: str,
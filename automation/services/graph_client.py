@@ -1,10 +1,12 @@
 import os
 from pathlib import Path
+from urllib.parse import quote
 from typing import List, Optional, Dict, Any
 from django.conf import settings
 
 import msal
-import requests
+
+from .graph_http import get_http_client
 
 
 # Reserved OpenID Connect scopes that must not be passed to Graph app scopes
@@ -19,6 +21,12 @@ _raw_scopes = os.environ.get("GRAPH_SCOPES", "Mail.Send").split()
 GRAPH_SCOPES: List[str] = [s for s in _raw_scopes if s and s not in RESERVED]
 
 
+# Overridable so a local stand-in Graph server can be used in tests
+GRAPH_API_BASE = os.environ.get("GRAPH_API_BASE", "https://graph.microsoft.com/v1.0").rstrip("/")
+# Upload session chunks must be a multiple of 320 KiB
+UPLOAD_SESSION_CHUNK_SIZE = 10 * 320 * 1024
+
+
 # User-specific cache management
 BASE_DIR = Path(__file__).resolve().parents[2]
 _user_caches: Dict[int, msal.SerializableTokenCache] = {}
@@ -156,17 +164,17 @@ def poll_device_code(device_code: str, timeout: int = 2) -> Optional[dict]:
 
 def send_mail(access_token: str, message_payload: dict, timeout: int = 15) -> bool:
     """Send a mail using Graph. Raises for HTTP errors."""
-    url = "https://graph.microsoft.com/v1.0/me/sendMail"
+    url = f"{GRAPH_API_BASE}/me/sendMail"
     headers = {"Authorization": f"Bearer {access_token}"}
     body = {"message": message_payload, "saveToSentItems": True}
-    resp = requests.post(url, json=body, headers=headers, timeout=timeout)
+    resp = get_http_client().post(url, json=body, headers=headers, timeout=timeout)
     resp.raise_for_status()
     return True
 
 
 def send_mail_with_attachments(access_token: str, message_payload: dict, attachments: List[dict] = None, timeout: int = 15) -> bool:
     """Send a mail with attachments using Graph. Raises for HTTP errors."""
-    url = "https://graph.microsoft.com/v1.0/me/sendMail"
+    url = f"{GRAPH_API_BASE}/me/sendMail"
     headers = {"Authorization": f"Bearer {access_token}"}
     
     # Add attachments to message payload if provided
@@ -174,8 +182,131 @@ def send_mail_with_attachments(access_token: str, message_payload: dict, attachm
         message_payload["attachments"] = attachments
     
     body = {"message": message_payload, "saveToSentItems": True}
-    resp = requests.post(url, json=body, headers=headers, timeout=timeout)
+    resp = get_http_client().post(url, json=body, headers=headers, timeout=timeout)
+    resp.raise_for_status()
+    return True
+
+
+def send_mail_streaming(access_token: str, body, timeout: int = 15) -> bool:
+    """
+    Send a prebuilt sendMail body, e.g. a graph_payload.SendMailBody.
+    Iterables with a length are streamed with a Content-Length header. Raises for HTTP errors.
+    """
+    url = f"{GRAPH_API_BASE}/me/sendMail"
+    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+    resp = get_http_client().post(url, data=body, headers=headers, timeout=timeout)
     resp.raise_for_status()
     return True
 
 
+def create_draft_message(access_token: str, message_payload: dict, timeout: int = 15) -> str:
+    """Create a draft message and return its ID. Raises for HTTP errors."""
+    url = f"{GRAPH_API_BASE}/me/messages"
+    headers = {"Authorization": f"Bearer {access_token}"}
+    resp = get_http_client().post(url, json=message_payload, headers=headers, timeout=timeout)
+    resp.raise_for_status()
+    return resp.json()["id"]
+
+
+def add_draft_attachment(access_token: str, message_id: str, attachment_json: bytes, timeout: int = 15) -> None:
+    """Attach a serialized fileAttachment object to a draft. Raises for HTTP errors."""
+    url = f"{GRAPH_API_BASE}/me/messages/{message_id}/attachments"
+    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+    resp = get_http_client().post(url, data=attachment_json, headers=headers, timeout=timeout)
+    resp.raise_for_status()
+
+
+def upload_draft_attachment(
+    access_token: str,
+    message_id: str,
+    upload_item: dict,
+    stream,
+    size: int,
+    timeout: int = 15,
+    chunk_size: int = UPLOAD_SESSION_CHUNK_SIZE
+) -> None:
+    """
+    Upload a large attachment to a draft through an upload session.
+    The raw bytes are sent in ranges, without base64. Raises for HTTP errors.
+    """
+    url = f"{GRAPH_API_BASE}/me/messages/{message_id}/attachments/createUploadSession"
+    headers = {"Authorization": f"Bearer {access_token}"}
+    resp = get_http_client().post(url, json=upload_item, headers=headers, timeout=timeout)
+    resp.raise_for_status()
+    _upload_ranges(resp.json()["uploadUrl"], stream, size, timeout, chunk_size)
+
+
+def _upload_ranges(upload_url: str, stream, size: int, timeout: int, chunk_size: int):
+    """PUT a stream to an upload session in ranges; returns the response to the last range."""
+    # The upload URL is pre-authenticated; it must not get the bearer token
+    resp = None
+    start = 0
+    while start < size:
+        chunk = stream.read(min(chunk_size, size - start))
+        if not chunk:
+            raise ValueError(f"Attachment stream ended at {start} of {size} bytes")
+        end = start + len(chunk) - 1
+        range_headers = {
+            "Content-Type": "application/octet-stream",
+            "Content-Range": f"bytes {start}-{end}/{size}",
+        }
+        resp = get_http_client().put(upload_url, data=chunk, headers=range_headers, timeout=timeout)
+        resp.raise_for_status()
+        start = end + 1
+    if resp is None:
+        raise ValueError("Upload sessions need at least one byte")
+    return resp
+
+
+def send_draft_message(access_token: str, message_id: str, timeout: int = 15) -> bool:
+    """Send a draft message. Raises for HTTP errors."""
+    url = f"{GRAPH_API_BASE}/me/messages/{message_id}/send"
+    headers = {"Authorization": f"Bearer {access_token}"}
+    resp = get_http_client().post(url, headers=headers, timeout=timeout)
+    resp.raise_for_status()
+    return True
+
+
+def delete_draft_message(access_token: str, message_id: str, timeout: int = 15) -> None:
+    """Best-effort removal of a draft whose upload failed."""
+    url = f"{GRAPH_API_BASE}/me/messages/{message_id}"
+    try:
+        get_http_client().delete(url, headers={"Authorization": f"Bearer {access_token}"}, timeout=timeout)
+    except Exception:
+        pass
+
+
+def upload_drive_file(
+    access_token: str,
+    item_path: str,
+    stream,
+    size: int,
+    timeout: int = 60,
+    chunk_size: int = UPLOAD_SESSION_CHUNK_SIZE
+) -> dict:
+    """
+    Upload a file to the signed-in user's OneDrive through an upload session.
+    An existing file at item_path is kept and the new one renamed.
+    Returns the created driveItem. Raises for HTTP errors.
+    """
+    url = f"{GRAPH_API_BASE}/me/drive/root:/{quote(item_path)}:/createUploadSession"
+    headers = {"Authorization": f"Bearer {access_token}"}
+    body = {"item": {"@microsoft.graph.conflictBehavior": "rename"}}
+    resp = get_http_client().post(url, json=body, headers=headers, timeout=timeout)
+    resp.raise_for_status()
+    return _upload_ranges(resp.json()["uploadUrl"], stream, size, timeout, chunk_size).json()
+
+
+def create_sharing_link(
+    access_token: str,
+    item_id: str,
+    scope: str = "organization",
+    link_type: str = "view",
+    timeout: int = 15
+) -> str:
+    """Create (or get the existing) sharing link of a driveItem and return its URL. Raises for HTTP errors."""
+    url = f"{GRAPH_API_BASE}/me/drive/items/{item_id}/createLink"
+    headers = {"Authorization": f"Bearer {access_token}"}
+    resp = get_http_client().post(url, json={"type": link_type, "scope": scope}, headers=headers, timeout=timeout)
+    resp.raise_for_status()
+    return resp.json()["link"]["webUrl"]
@@ -0,0 +1,342 @@
+"""
+HTTP clients for Microsoft Graph calls.
+
+graph_client sends every request through get_http_client():
+
+- PooledHttpClient: a requests.Session with keep-alive connections
+  (HTTP/1.1, one connection per in-flight request)
+- Http2HttpClient: an httpx client that multiplexes concurrent requests as
+  HTTP/2 streams over a few connections (GRAPH_HTTP2, needs httpx[http2])
+
+Both record connection counts and per-request latency so the two can be
+compared from campaign logs and run_benchmarks. A campaign takes a
+snapshot() when it starts and logs only what happened since. The clients
+are shared by every user, so neither keeps cookies between requests.
+"""
+import http.cookiejar
+import logging
+import threading
+import time
+import weakref
+from typing import Any, Dict, List, Optional
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+try:
+    import h2  # noqa: F401 - httpx needs it for http2=True
+    import httpx
+    HTTP2_SUPPORT = True
+except ImportError:
+    HTTP2_SUPPORT = False
+
+logger = logging.getLogger(__name__)
+
+# HTTP/2 peers commonly advertise 100 concurrent streams and a 64 KiB initial window
+DEFAULT_MAX_STREAMS_PER_CONNECTION = 100
+DEFAULT_MAX_INFLIGHT_BYTES = 16 * 1024 * 1024
+LATENCY_SAMPLES = 10_000
+
+
+def _no_cookies() -> http.cookiejar.DefaultCookiePolicy:
+    """A cookie policy that neither stores nor sends any cookie."""
+    return http.cookiejar.DefaultCookiePolicy(allowed_domains=[])
+
+
+class LatencyWindow:
+    """Counters at a point in time, for stats since then (see LatencyStats.mark)."""
+
+    __slots__ = ("requests", "errors", "peak_in_flight", "connections", "__weakref__")
+
+    def __init__(self, requests: int, errors: int, in_flight: int):
+        self.requests = requests
+        self.errors = errors
+        self.peak_in_flight = in_flight
+        self.connections = 0
+
+
+class LatencyStats:
+    """Request latencies (most recent LATENCY_SAMPLES) and in-flight peak."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples: List[float] = []
+        self._windows: "weakref.WeakSet[LatencyWindow]" = weakref.WeakSet()
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def mark(self) -> LatencyWindow:
+        """Start a window; summary(since=window) covers only later requests."""
+        with self._lock:
+            window = LatencyWindow(self.requests, self.errors, self.in_flight)
+            self._windows.add(window)
+        return window
+
+    def start(self) -> float:
+        with self._lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            for window in self._windows:
+                window.peak_in_flight = max(window.peak_in_flight, self.in_flight)
+        return time.perf_counter()
+
+    def finish(self, started: float, failed: bool = False) -> None:
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.in_flight -= 1
+            self.requests += 1
+            self.errors += int(failed)
+            self._samples.append(elapsed)
+            if len(self._samples) > LATENCY_SAMPLES:
+                del self._samples[:len(self._samples) - LATENCY_SAMPLES]
+
+    def summary(self, since: Optional[LatencyWindow] = None) -> Dict[str, Any]:
+        with self._lock:
+            requests_count, errors, peak = self.requests, self.errors, self.peak_in_flight
+            samples = self._samples
+            if since is not None:
+                requests_count -= since.requests
+                errors -= since.errors
+                peak = since.peak_in_flight
+                samples = samples[len(samples) - min(requests_count, len(samples)):]
+            samples = sorted(samples)
+
+        def percentile(p: float) -> float:
+            if not samples:
+                return 0.0
+            return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 1)
+
+        return {
+            "requests": requests_count,
+            "errors": errors,
+            "peak_in_flight": peak,
+            "p50_ms": percentile(0.50),
+            "p95_ms": percentile(0.95),
+            "max_ms": round(samples[-1] * 1000, 1) if samples else 0.0,
+        }
+
+
+class StreamLimiter:
+    """
+    Bounds concurrent requests by stream count and by body bytes in flight.
+
+    Large bodies on many streams only stall on HTTP/2 flow-control windows,
+    so a request waits while max_inflight_bytes are already being sent
+    (a single request larger than the budget still goes out on its own).
+    """
+
+    def __init__(self, max_streams: int, max_inflight_bytes: int):
+        self.max_streams = max(1, max_streams)
+        self.max_inflight_bytes = max(1, max_inflight_bytes)
+        self._cond = threading.Condition()
+        self._streams = 0
+        self._bytes = 0
+
+    def acquire(self, size: int) -> None:
+        with self._cond:
+            while self._streams >= self.max_streams or (
+                self._streams and self._bytes + size > self.max_inflight_bytes
+            ):
+                self._cond.wait()
+            self._streams += 1
+            self._bytes += size
+
+    def release(self, size: int) -> None:
+        with self._cond:
+            self._streams -= 1
+            self._bytes -= size
+            self._cond.notify_all()
+
+
+def _body_size(data: Any) -> int:
+    if data is None:
+        return 0
+    try:
+        return len(data)
+    except TypeError:
+        return 0
+
+
+class PooledHttpClient:
+    """requests.Session with a bounded keep-alive pool per host."""
+
+    http_version = "HTTP/1.1"
+
+    def __init__(self, pool_size: int = 10):
+        self.session = requests.Session()
+        self.session.cookies.set_policy(_no_cookies())
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.latency = LatencyStats()
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        started = self.latency.start()
+        failed = True
+        try:
+            response = self.session.request(method, url, **kwargs)
+            failed = response.status_code >= 400
+            return response
+        finally:
+            self.latency.finish(started, failed)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url: str, **kwargs) -> requests.Response:
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> requests.Response:
+        return self.request("DELETE", url, **kwargs)
+
+    def connections_opened(self) -> int:
+        pools = self.adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in list(pools.keys()))
+
+    def snapshot(self) -> LatencyWindow:
+        window = self.latency.mark()
+        window.connections = self.connections_opened()
+        return window
+
+    def stats(self, since: Optional[LatencyWindow] = None) -> Dict[str, Any]:
+        connections = max(0, self.connections_opened() - (since.connections if since is not None else 0))
+        return {"http_version": self.http_version, "connections": connections, **self.latency.summary(since)}
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class Http2HttpClient:
+    """
+    httpx client multiplexing requests over HTTP/2 connections.
+
+    Accepts the requests-style keyword arguments graph_client uses (json,
+    data, headers, timeout). Servers without HTTP/2 are spoken to over
+    HTTP/1.1 by httpx.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 2,
+        max_streams_per_connection: int = DEFAULT_MAX_STREAMS_PER_CONNECTION,
+        max_inflight_bytes: int = DEFAULT_MAX_INFLIGHT_BYTES
+    ):
+        if not HTTP2_SUPPORT:
+            raise ImportError("HTTP/2 support requires httpx[http2]: pip install 'httpx[http2]'")
+        self.client = httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+        self.client.cookies.jar.set_policy(_no_cookies())
+        self.limiter = StreamLimiter(max_connections * max_streams_per_connection, max_inflight_bytes)
+        self.latency = LatencyStats()
+        self._lock = threading.Lock()
+        # Connections seen in the transport's pool; a closed one drops out
+        # with its object, so a reused id() is never mistaken for it
+        self._seen_connections: "weakref.WeakSet[Any]" = weakref.WeakSet()
+        self._connections_opened = 0
+        self._versions: Dict[str, int] = {}
+
+    def _pool_connections(self) -> List[Any]:
+        pool = getattr(getattr(self.client, "_transport", None), "_pool", None)
+        return list(getattr(pool, "connections", []) or [])
+
+    def connections_opened(self) -> int:
+        with self._lock:
+            for connection in self._pool_connections():
+                if connection not in self._seen_connections:
+                    self._seen_connections.add(connection)
+                    self._connections_opened += 1
+            return self._connections_opened
+
+    def request(self, method: str, url: str, json=None, data=None, headers=None, timeout=None, **kwargs):
+        headers = dict(headers or {})
+        size = _body_size(data)
+        if data is not None and not isinstance(data, (bytes, str)):
+            # Iterable bodies (SendMailBody) keep their exact length
+            headers.setdefault("Content-Length", str(size))
+        self.limiter.acquire(size)
+        started = self.latency.start()
+        failed = True
+        try:
+            response = self.client.request(
+                method, url, json=json, content=data, headers=headers, timeout=timeout, **kwargs
+            )
+            failed = response.status_code >= 400
+            self.connections_opened()
+            with self._lock:
+                self._versions[response.http_version] = self._versions.get(response.http_version, 0) + 1
+            return response
+        finally:
+            self.latency.finish(started, failed)
+            self.limiter.release(size)
+
+    def post(self, url: str, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url: str, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url: str, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def snapshot(self) -> LatencyWindow:
+        window = self.latency.mark()
+        window.connections = self.connections_opened()
+        return window
+
+    def stats(self, since: Optional[LatencyWindow] = None) -> Dict[str, Any]:
+        connections = max(0, self.connections_opened() - (since.connections if since is not None else 0))
+        with self._lock:
+            versions = dict(self._versions)
+        http_version = max(versions, key=versions.get) if versions else "HTTP/2"
+        return {"http_version": http_version, "connections": connections, **self.latency.summary(since)}
+
+    def close(self) -> None:
+        self.client.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_http_client():
+    """The process-wide HTTP client for Graph calls, created on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            if getattr(settings, "GRAPH_HTTP2", False) and HTTP2_SUPPORT:
+                _client = Http2HttpClient(
+                    max_connections=getattr(settings, "GRAPH_HTTP2_MAX_CONNECTIONS", 2),
+                    max_streams_per_connection=getattr(
+                        settings, "GRAPH_HTTP2_MAX_STREAMS", DEFAULT_MAX_STREAMS_PER_CONNECTION
+                    ),
+                    max_inflight_bytes=int(getattr(settings, "GRAPH_HTTP2_MAX_INFLIGHT_MB", 16) * 1024 * 1024),
+                )
+            else:
+                if getattr(settings, "GRAPH_HTTP2", False):
+                    logger.warning("GRAPH_HTTP2 is set but httpx[http2] is not installed, using HTTP/1.1")
+                _client = PooledHttpClient(getattr(settings, "GRAPH_HTTP_POOL_SIZE", 10))
+        return _client
+
+
+def reset_http_client() -> None:
+    """Close the shared client; the next call creates one from current settings."""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+
+
+def format_http_stats(stats: Optional[Dict[str, Any]] = None, since: Optional[LatencyWindow] = None) -> str:
+    """One-line summary of the shared client's counters (since a snapshot) for campaign logs."""
+    s = stats or get_http_client().stats(since)
+    return (
+        f"[HTTP] {s['http_version']}: {s['connections']} connection(s), {s['requests']} requests "
+        f"({s['errors']} failed), peak {s['peak_in_flight']} in flight, "
+        f"latency p50 {s['p50_ms']} ms / p95 {s['p95_ms']} ms / max {s['max_ms']} ms"
+    )
@@ -0,0 +1,287 @@
+"""
+Streaming request bodies for Microsoft Graph sendMail.
+
+Attachments are read in chunks and base64-encoded while the request is
+sent, so a send holds one small buffer per attachment instead of the raw
+file, its base64 string and the serialized JSON at the same time.
+"""
+import base64
+import json
+import logging
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, BinaryIO, Callable, Dict, Hashable, Iterator, List, Optional, Set, Union
+
+logger = logging.getLogger(__name__)
+
+# Multiple of 3 so every chunk encodes without padding
+B64_CHUNK_SIZE = 3 * 64 * 1024
+
+FILE_ATTACHMENT_TYPE = "#microsoft.graph.fileAttachment"
+
+DEFAULT_FRAGMENT_CACHE_BYTES = 64 * 1024 * 1024
+
+
+def base64_length(size: int) -> int:
+    """Length of the padded base64 encoding of size bytes."""
+    return 4 * ((size + 2) // 3)
+
+
+def iter_base64(src: BinaryIO, chunk_size: int = B64_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Base64-encode a stream in 3-byte-aligned chunks.
+
+    Short reads (e.g. from ZIP members) are carried over, so the
+    concatenated output equals base64.b64encode(src.read()).
+    """
+    remainder = b""
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            break
+        if remainder:
+            chunk = remainder + chunk
+        cut = len(chunk) - len(chunk) % 3
+        remainder = chunk[cut:]
+        if cut:
+            yield base64.b64encode(memoryview(chunk)[:cut])
+    if remainder:
+        yield base64.b64encode(remainder)
+
+
+class AttachmentSource:
+    """
+    A file attachment whose content is only read while the request body is sent.
+
+    Can be passed to send_single_mail() wherever a Graph attachment dict is accepted.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        content_type: str,
+        size: int,
+        opener: Callable[[], BinaryIO],
+        key: Optional[Hashable] = None
+    ):
+        self.name = name
+        self.content_type = content_type or "application/octet-stream"
+        self.size = size
+        self._opener = opener
+        # identifies the content across messages; None disables fragment caching
+        self.key = key
+
+    @classmethod
+    def from_file_info(cls, file_info: Dict[str, Any]) -> "AttachmentSource":
+        """Build a source from a catalogue entry (extracted file, library blob or ZIP member)."""
+        # attach_matcher encodes through this module, import lazily
+        from .attach_matcher import open_attachment_source
+
+        size = file_info["size"] if file_info.get("member") else os.path.getsize(file_info["path"])
+        return cls(
+            name=file_info["name"],
+            content_type=file_info.get("content_type"),
+            size=size,
+            opener=lambda: open_attachment_source(file_info),
+            key=(file_info["path"], file_info.get("member"), size)
+        )
+
+    @classmethod
+    def from_path(cls, file_path: str, content_type: Optional[str] = None) -> "AttachmentSource":
+        """Build a source from a file on disk, guessing the content type if needed."""
+        if not content_type:
+            content_type, _ = mimetypes.guess_type(file_path)
+        return cls(
+            name=os.path.basename(file_path),
+            content_type=content_type,
+            size=os.path.getsize(file_path),
+            opener=lambda: open(file_path, "rb"),
+            key=(file_path, None, os.path.getsize(file_path))
+        )
+
+    def open(self) -> BinaryIO:
+        return self._opener()
+
+    def encode(self) -> str:
+        """Full base64 content, for callers that need the dict form."""
+        with self.open() as src:
+            return b"".join(iter_base64(src)).decode("ascii")
+
+    def as_graph_attachment(self) -> Dict[str, str]:
+        return {
+            "@odata.type": FILE_ATTACHMENT_TYPE,
+            "name": self.name,
+            "contentType": self.content_type,
+            "contentBytes": self.encode(),
+        }
+
+    def fragment_head(self) -> bytes:
+        """JSON of the attachment up to the opening quote of contentBytes."""
+        meta = json.dumps({
+            "@odata.type": FILE_ATTACHMENT_TYPE,
+            "name": self.name,
+            "contentType": self.content_type,
+        })
+        return f'{meta[:-1]}, "contentBytes": "'.encode("ascii")
+
+    def fragment_length(self) -> int:
+        return len(self.fragment_head()) + base64_length(self.size) + len(FRAGMENT_TAIL)
+
+    def fragment(self) -> bytes:
+        """The complete serialized attachment object."""
+        with self.open() as src:
+            return b"".join([self.fragment_head(), *iter_base64(src), FRAGMENT_TAIL])
+
+
+FRAGMENT_TAIL = b'"}'
+
+Attachment = Union[AttachmentSource, Dict[str, Any]]
+
+
+class AttachmentFragmentCache:
+    """
+    Serialized attachment fragments shared by the messages of one campaign.
+
+    When many recipients get the same file, its JSON fragment (base64 content
+    included) is built once and spliced into every body instead of being
+    re-encoded per message. A file is only held in memory once it is used a
+    second time (or the caller knows it is shared), so single-use files keep
+    streaming from disk. Fragments are kept LRU within max_bytes; an
+    attachment that doesn't fit is streamed as usual.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_FRAGMENT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._fragments: "OrderedDict[Hashable, bytes]" = OrderedDict()
+        self._seen: Set[Hashable] = set()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.first_uses = 0
+
+    def get(self, source: AttachmentSource, shared: bool = False) -> Optional[bytes]:
+        """
+        The cached fragment for source, building it on its second use.
+
+        Args:
+            source: Attachment to splice in
+            shared: source goes into more than one message, so build and
+                cache it on first use (e.g. warming a company's attachment set)
+
+        Returns:
+            The fragment, or None when source should be streamed instead
+        """
+        if source.key is None or source.fragment_length() > self.max_bytes:
+            with self._lock:
+                self.bypassed += 1
+            return None
+
+        key = (source.key, source.name, source.content_type)
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is not None:
+                self._fragments.move_to_end(key)
+                self.hits += 1
+                return fragment
+            if not shared and key not in self._seen:
+                # Possibly single-use: stream it, cache it if it comes back
+                self._seen.add(key)
+                self.first_uses += 1
+                return None
+
+        fragment = source.fragment()
+        with self._lock:
+            self.misses += 1
+            if key not in self._fragments:
+                self._fragments[key] = fragment
+                self._size += len(fragment)
+            while self._size > self.max_bytes:
+                _, evicted = self._fragments.popitem(last=False)
+                self._size -= len(evicted)
+        return fragment
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "first_uses": self.first_uses,
+                "entries": len(self._fragments),
+                "bytes": self._size,
+            }
+
+
+class SendMailBody:
+    """
+    Iterable sendMail JSON body with an exact length.
+
+    requests sends an iterable that has __len__ with a Content-Length header
+    instead of chunked encoding. The body can be iterated more than once.
+    Serializes to the same JSON as {"message": payload, "saveToSentItems": ...}
+    with the attachments appended to the message. With a fragment_cache,
+    attachments are spliced in pre-serialized; only the per-recipient fields
+    (subject, body, recipients) are serialized per message.
+    """
+
+    def __init__(
+        self,
+        message_payload: Dict[str, Any],
+        attachments: List[Attachment],
+        save_to_sent_items: bool = True,
+        fragment_cache: Optional[AttachmentFragmentCache] = None
+    ):
+        message = {k: v for k, v in message_payload.items() if k != "attachments"}
+        self.attachments = list(attachments)
+        self._parts: List[Union[bytes, AttachmentSource]] = []
+
+        message_json = json.dumps(message)
+        head = '{"message": ' + message_json[:-1]
+        if self.attachments:
+            head += (", " if message else "") + '"attachments": ['
+        self._parts.append(head.encode("ascii"))
+
+        for i, attachment in enumerate(self.attachments):
+            separator = ", " if i else ""
+            if isinstance(attachment, AttachmentSource):
+                fragment = fragment_cache.get(attachment) if fragment_cache is not None else None
+                if separator:
+                    self._parts.append(separator.encode("ascii"))
+                if fragment is not None:
+                    self._parts.append(fragment)
+                else:
+                    self._parts.append(attachment.fragment_head())
+                    self._parts.append(attachment)
+                    self._parts.append(FRAGMENT_TAIL)
+            else:
+                self._parts.append((separator + json.dumps(attachment)).encode("ascii"))
+
+        tail = "]" if self.attachments else ""
+        tail += "}" + f', "saveToSentItems": {json.dumps(save_to_sent_items)}' + "}"
+        self._parts.append(tail.encode("ascii"))
+
+        self._length = sum(
+            base64_length(part.size) if isinstance(part, AttachmentSource) else len(part)
+            for part in self._parts
+        )
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> Iterator[bytes]:
+        for part in self._parts:
+            if not isinstance(part, AttachmentSource):
+                yield part
+                continue
+            sent = 0
+            with part.open() as src:
+                for chunk in iter_base64(src):
+                    sent += len(chunk)
+                    yield chunk
+            if sent != base64_length(part.size):
+                # Content-Length is already on the wire; abort rather than send a corrupt body
+                raise ValueError(f"Attachment {part.name} changed size while sending")
@@ -0,0 +1,190 @@
+"""
+Optional Jinja2 engine for email templates.
+
+Templates saved with engine "jinja" can use conditionals and loops. They run
+in Jinja's SandboxedEnvironment, so recipient data and template authors
+can't reach Python internals. Compiled templates are cached in memory by the
+environment and as bytecode on disk, both keyed by the SHA-256 of the
+template source, so a campaign compiles each template at most once and a
+restarted worker only loads the bytecode.
+"""
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Sequence, Set, Tuple
+
+from django.conf import settings
+
+from .template_render import normalize_key
+
+try:
+    import jinja2
+    from jinja2 import meta as jinja_meta
+    from jinja2.sandbox import SandboxedEnvironment
+    JINJA_SUPPORT = True
+except ImportError:
+    JINJA_SUPPORT = False
+
+logger = logging.getLogger(__name__)
+
+FORMAT_ENGINE = "format"
+JINJA_ENGINE = "jinja"
+
+# Compiled templates kept in memory by the environment (and their sources by the loader)
+MEMORY_CACHE_SIZE = 400
+
+if JINJA_SUPPORT:
+    class _SourceLoader(jinja2.BaseLoader):
+        """Serves template sources registered under their SHA-256 (the max_sources most recent)."""
+
+        def __init__(self, max_sources: int = MEMORY_CACHE_SIZE):
+            self.max_sources = max(1, max_sources)
+            self.sources: "OrderedDict[str, str]" = OrderedDict()
+            self._lock = threading.Lock()
+
+        def add(self, name: str, source: str) -> None:
+            with self._lock:
+                self.sources[name] = source
+                self.sources.move_to_end(name)
+                while len(self.sources) > self.max_sources:
+                    self.sources.popitem(last=False)
+
+        def get_source(self, environment, template):
+            with self._lock:
+                if template not in self.sources:
+                    raise jinja2.TemplateNotFound(template)
+                self.sources.move_to_end(template)
+                source = self.sources[template]
+            # Names are content hashes, so a loaded template never goes stale
+            return source, None, lambda: True
+
+
+_environment = None
+_environment_lock = threading.Lock()
+
+
+def _require_jinja() -> None:
+    if not JINJA_SUPPORT:
+        raise ImportError("Jinja2 templates require jinja2: pip install jinja2")
+
+
+def get_bytecode_cache_path() -> Path:
+    return Path(getattr(settings, "JINJA_BYTECODE_CACHE_PATH", Path(settings.DATA_STORAGE_PATH) / "jinja_cache"))
+
+
+def get_environment():
+    """The process-wide sandboxed environment, created on first use."""
+    global _environment
+    _require_jinja()
+    with _environment_lock:
+        if _environment is None:
+            cache_dir = get_bytecode_cache_path()
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            _environment = SandboxedEnvironment(
+                loader=_SourceLoader(),
+                bytecode_cache=jinja2.FileSystemBytecodeCache(str(cache_dir)),
+                cache_size=MEMORY_CACHE_SIZE,
+                # Values are inserted as-is, like {placeholder} templates
+                autoescape=False,
+                keep_trailing_newline=True,
+                # Block tags on their own line leave no line (and no <br>) behind
+                trim_blocks=True,
+                lstrip_blocks=True,
+            )
+        return _environment
+
+
+def reset_environment() -> None:
+    """Drop the shared environment; the next call creates one from current settings."""
+    global _environment
+    with _environment_lock:
+        _environment = None
+
+
+def compile_jinja(source: str):
+    """
+    The compiled template for source (from memory, disk bytecode or a fresh compile).
+
+    Raises:
+        jinja2.TemplateSyntaxError: If source is not a valid template
+    """
+    env = get_environment()
+    key = hashlib.sha256((source or "").encode("utf-8")).hexdigest()
+    env.loader.add(key, source or "")
+    return env.get_template(key)
+
+
+def jinja_fields(*templates: str) -> Optional[Set[str]]:
+    """
+    Top-level variables the templates read, or None if one does not parse
+    (or jinja2 is not installed).
+    """
+    if not JINJA_SUPPORT:
+        return None
+    env = get_environment()
+    fields: Set[str] = set()
+    for tpl in templates:
+        if not tpl:
+            continue
+        try:
+            fields |= jinja_meta.find_undeclared_variables(env.parse(tpl))
+        except jinja2.TemplateSyntaxError:
+            return None
+    return fields
+
+
+def validate_jinja(*templates: str) -> None:
+    """
+    Raises:
+        ValueError: If a template does not compile (or jinja2 is missing)
+    """
+    try:
+        for tpl in templates:
+            compile_jinja(tpl)
+    except ImportError as e:
+        raise ValueError(str(e)) from e
+    except jinja2.TemplateSyntaxError as e:
+        raise ValueError(f"Template syntax error on line {e.lineno}: {e.message}") from e
+
+
+def _html_breaks(text: str) -> str:
+    return text.replace('\r\n', '\n').replace('\r', '\n').replace('\n', '<br>')
+
+
+class JinjaSubjectBody:
+    """
+    Subject and body Jinja templates compiled once per campaign, rendering
+    rows given as value tuples with render_text's context and line breaks.
+    """
+
+    bulk = False
+
+    def __init__(self, subject_tpl: str, body_tpl: str, columns: Sequence[Any]):
+        self.subject = compile_jinja(subject_tpl)
+        self.body = compile_jinja(body_tpl)
+        self.columns = list(columns)
+        # Same keys as build_context: original names, then normalized ones
+        self._keys = [(str(c), normalize_key(c)) for c in self.columns]
+
+    def context(self, values: Sequence[Any]) -> Dict[str, Any]:
+        ctx: Dict[str, Any] = {}
+        for (key, _normalized), value in zip(self._keys, values):
+            ctx[key] = "" if value is None else value
+        for (_key, normalized), value in zip(self._keys, values):
+            ctx[normalized] = "" if value is None else value
+        return ctx
+
+    def render(self, values: Sequence[Any]) -> Tuple[str, str]:
+        ctx = self.context(values)
+        return _html_breaks(self.subject.render(ctx)), _html_breaks(self.body.render(ctx))
+
+    def render_frame(self, df) -> None:
+        return None
+
+
+def render_jinja_subject_body(subject_tpl: str, body_tpl: str, row: Dict[str, Any]) -> Tuple[str, str]:
+    """render_subject_body for one row dict with the Jinja engine."""
+    renderer = JinjaSubjectBody(subject_tpl, body_tpl, list(row.keys()))
+    return renderer.render(list(row.values()))
@@ -1,38 +1,56 @@
 """
 Mail service for handling email operations.
 """
-import base64
 import logging
 from typing import Dict, List, Optional, Any
 from django.core.files.uploadedfile import UploadedFile
 
-from ..exceptions import MailSendError
+from ..exceptions import DeliveryUnknownError, MailSendError, PartialDeliveryError
 from .graph_client import (
     acquire_token_silent_or_fail,
     send_mail as graph_send_mail,
     send_mail_with_attachments,
+    send_mail_streaming,
+    create_draft_message,
+    add_draft_attachment,
+    upload_draft_attachment,
+    send_draft_message,
+    delete_draft_message,
     NeedsLoginError
 )
+from .graph_payload import AttachmentFragmentCache, AttachmentSource, SendMailBody, iter_base64
+from .payload_planner import (
+    SPLIT,
+    UPLOAD_SESSION,
+    MessagePlan,
+    PayloadLimits,
+    as_source,
+    split_payload,
+    upload_session_item,
+)
+from .transports import get_transport
 
 logger = logging.getLogger(__name__)
 
 
 def build_message_payload(
-    to_email: str,
+    to_email: Optional[str],
     subject: str,
     body: str,
     attachments: Optional[List[Dict[str, str]]] = None,
-    cc_emails: Optional[List[str]] = None
+    cc_emails: Optional[List[str]] = None,
+    bcc_emails: Optional[List[str]] = None
 ) -> Dict[str, Any]:
     """
     Build Microsoft Graph message payload.
     
     Args:
-        to_email: Recipient email address
+        to_email: Recipient email address; None for BCC-only messages
         subject: Email subject
         body: Email body (HTML)
         attachments: List of attachment objects
         cc_emails: List of CC email addresses
+        bcc_emails: List of BCC email addresses
         
     Returns:
         Message payload dictionary
@@ -40,7 +58,7 @@ def build_message_payload(
     payload = {
         "subject": subject,
         "body": {"contentType": "HTML", "content": body},
-        "toRecipients": [{"emailAddress": {"address": to_email}}],
+        "toRecipients": [{"emailAddress": {"address": to_email}}] if to_email else [],
     }
     
     if attachments:
@@ -48,6 +66,9 @@ def build_message_payload(
     
     if cc_emails:
         payload["ccRecipients"] = [{"emailAddress": {"address": cc}} for cc in cc_emails if cc and cc.strip()]
+    
+    if bcc_emails:
+        payload["bccRecipients"] = [{"emailAddress": {"address": bcc}} for bcc in bcc_emails if bcc and bcc.strip()]
         
     return payload
 
@@ -63,8 +84,8 @@ def encode_attachment(file_obj: UploadedFile) -> Dict[str, str]:
         Graph attachment dictionary
     """
     try:
-        content = file_obj.read()
-        b64 = base64.b64encode(content).decode("utf-8")
+        file_obj.seek(0)
+        b64 = b"".join(iter_base64(file_obj)).decode("ascii")
         
         return {
             "@odata.type": "#microsoft.graph.fileAttachment",
@@ -78,49 +99,112 @@ def encode_attachment(file_obj: UploadedFile) -> Dict[str, str]:
 
 
 def send_single_mail(
-    to_email: str,
+    to_email: Optional[str],
     subject: str,
     body: str,
     attachments: Optional[List[Dict[str, str]]] = None,
     cc_emails: Optional[List[str]] = None,
     timeout: int = 15,
-    user_id: Optional[int] = None
+    user_id: Optional[int] = None,
+    fragment_cache: Optional[AttachmentFragmentCache] = None,
+    plan: Optional[MessagePlan] = None,
+    bcc_emails: Optional[List[str]] = None
 ) -> bool:
     """
-    Send a single email.
+    Send a single email through the configured transport (MAIL_TRANSPORT).
     
     Args:
-        to_email: Recipient email address
+        to_email: Recipient email address; None for BCC-only messages
         subject: Email subject
         body: Email body (HTML)
-        attachments: List of attachment objects
+        attachments: List of attachment objects (Graph dicts or AttachmentSource)
         cc_emails: List of CC email addresses
         timeout: Request timeout in seconds
         user_id: User ID for authentication context
+        fragment_cache: Campaign-wide cache of serialized AttachmentSource fragments
+        plan: Send strategy from payload_planner.plan_message(); planned by the Graph transport if omitted
+        bcc_emails: List of BCC email addresses
         
     Returns:
         True if successful
         
     Raises:
         MailSendError: If sending fails
+        PartialDeliveryError: If the message was sent but some CC/BCC recipients were refused
+        DeliveryUnknownError: If the connection dropped while the message was handed over (not resent)
         NeedsLoginError: If authentication is required
     """
     try:
-        access_token = acquire_token_silent_or_fail(user_id)
-        message_payload = build_message_payload(to_email, subject, body, attachments, cc_emails)
-        
-        if attachments:
-            return send_mail_with_attachments(access_token, message_payload, attachments, timeout)
-        else:
-            return graph_send_mail(access_token, message_payload, timeout)
+        message_payload = build_message_payload(to_email, subject, body, None, cc_emails, bcc_emails)
+        return get_transport().send(
+            message_payload, attachments, timeout=timeout, user_id=user_id,
+            fragment_cache=fragment_cache, plan=plan
+        )
             
-    except NeedsLoginError:
+    except (NeedsLoginError, PartialDeliveryError, DeliveryUnknownError):
         raise
     except Exception as e:
-        logger.error(f"Error sending mail to {to_email}: {e}")
+        logger.error(f"Error sending mail to {to_email or f'{len(bcc_emails or [])} BCC recipients'}: {e}")
         raise MailSendError(f"Failed to send mail: {e}") from e
 
 
+def _send_planned(
+    access_token: str,
+    message_payload: Dict[str, Any],
+    plan: MessagePlan,
+    limits: PayloadLimits,
+    timeout: int,
+    fragment_cache: Optional[AttachmentFragmentCache]
+) -> bool:
+    """Send a message (or its parts) the way the plan says."""
+    if plan.strategy == SPLIT:
+        for index, part in enumerate(plan.parts):
+            part_payload = split_payload(message_payload, index, len(plan.parts))
+            _send_planned(access_token, part_payload, part, limits, timeout, fragment_cache)
+        logger.debug(f"Sent message in {len(plan.parts)} parts")
+        return True
+    
+    attachments = plan.attachments
+    if plan.strategy == UPLOAD_SESSION:
+        return _send_with_upload_session(access_token, message_payload, attachments, limits, timeout, fragment_cache)
+    
+    if any(isinstance(a, AttachmentSource) for a in attachments):
+        # File-backed attachments are encoded while the body streams out
+        mail_body = SendMailBody(message_payload, attachments, fragment_cache=fragment_cache)
+        return send_mail_streaming(access_token, mail_body, timeout)
+    return send_mail_with_attachments(access_token, message_payload, attachments, timeout)
+
+
+def _send_with_upload_session(
+    access_token: str,
+    message_payload: Dict[str, Any],
+    attachments: List[Any],
+    limits: PayloadLimits,
+    timeout: int,
+    fragment_cache: Optional[AttachmentFragmentCache]
+) -> bool:
+    """
+    Send a message too large for one sendMail request: create a draft,
+    attach small files as JSON and upload large ones in ranges, then send it.
+    """
+    message_id = create_draft_message(access_token, message_payload, timeout)
+    try:
+        for attachment in attachments:
+            source = as_source(attachment)
+            if source.size >= limits.upload_session_min_bytes:
+                with source.open() as stream:
+                    upload_draft_attachment(
+                        access_token, message_id, upload_session_item(source), stream, source.size, timeout
+                    )
+            else:
+                fragment = fragment_cache.get(source) if fragment_cache is not None else None
+                add_draft_attachment(access_token, message_id, fragment or source.fragment(), timeout)
+        return send_draft_message(access_token, message_id, timeout)
+    except Exception:
+        delete_draft_message(access_token, message_id, timeout)
+        raise
+
+
 def send_bulk_mails(
     mail_data: List[Dict[str, Any]],
     timeout: int = 15,
@@ -138,32 +222,17 @@ def send_bulk_mails(
         List of result dictionaries with status and error information
     """
     results = []
+    transport = get_transport()
     
-    try:
-        access_token = acquire_token_silent_or_fail(user_id)
-    except NeedsLoginError:
-        # Return error for all mails
-        for data in mail_data:
-            results.append({
-                "email": data.get("email", "unknown"),
-                "status": "ERROR",
-                "error_detail": "Authentication required"
-            })
-        return results
-    
-    for data in mail_data:
+    for position, data in enumerate(mail_data):
         try:
             to_email = data["email"]
             subject = data["subject"]
             body = data["body"]
             attachments = data.get("attachments", [])
             
-            message_payload = build_message_payload(to_email, subject, body, attachments)
-            
-            if attachments:
-                send_mail_with_attachments(access_token, message_payload, attachments, timeout)
-            else:
-                graph_send_mail(access_token, message_payload, timeout)
+            message_payload = build_message_payload(to_email, subject, body)
+            transport.send(message_payload, attachments, timeout=timeout, user_id=user_id)
                 
             results.append({
                 "email": to_email,
@@ -171,6 +240,21 @@ def send_bulk_mails(
                 "error_detail": ""
             })
             
+        except PartialDeliveryError as e:
+            results.append({
+                "email": data["email"],
+                "status": "OK",
+                "error_detail": str(e)
+            })
+        except NeedsLoginError:
+            # Return error for this and all remaining mails
+            for remaining in mail_data[position:]:
+                results.append({
+                    "email": remaining.get("email", "unknown"),
+                    "status": "ERROR",
+                    "error_detail": "Authentication required"
+                })
+            break
         except Exception as e:
             logger.error(f"Error sending mail to {data.get('email', 'unknown')}: {e}")
             results.append({
@@ -0,0 +1,234 @@
+"""
+Ahead-of-time planning of how each message goes over the wire.
+
+Sizes are computed exactly from file sizes (base64 expansion plus the JSON
+around it), so messages that don't fit a single sendMail request are routed
+to an upload session or split into several messages before sending starts.
+"""
+import base64
+import hashlib
+import io
+import json
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional
+
+import pandas as pd
+from django.conf import settings
+
+from .attach_matcher import norm
+from .graph_payload import Attachment, AttachmentSource, SendMailBody, base64_length
+
+logger = logging.getLogger(__name__)
+
+INLINE = "inline"
+UPLOAD_SESSION = "upload_session"
+SPLIT = "split"
+STRATEGIES = (INLINE, UPLOAD_SESSION, SPLIT)
+
+MB = 1024 * 1024
+
+# Graph permission that creating drafts and attachment upload sessions needs
+UPLOAD_SESSION_SCOPE = "Mail.ReadWrite"
+
+
+@dataclass
+class PayloadLimits:
+    # Graph rejects sendMail requests above 4 MB
+    inline_request_bytes: int = 4 * MB
+    # Attachments this large go through an upload session instead of a JSON POST
+    upload_session_min_bytes: int = 3 * MB
+    # Largest message the mailbox accepts, attachments base64-encoded
+    max_message_bytes: int = 35 * MB
+    # Draft + upload session sends need Mail.ReadWrite; without it large
+    # messages are split into parts that each fit a sendMail request
+    upload_sessions: bool = True
+
+    @classmethod
+    def from_settings(cls) -> "PayloadLimits":
+        scopes = {s.lower() for s in str(getattr(settings, "GRAPH_SCOPES", "")).split()}
+        return cls(
+            inline_request_bytes=int(getattr(settings, "GRAPH_INLINE_REQUEST_MB", 4) * MB),
+            upload_session_min_bytes=int(getattr(settings, "GRAPH_UPLOAD_SESSION_MIN_MB", 3) * MB),
+            max_message_bytes=int(getattr(settings, "GRAPH_MAX_MESSAGE_MB", 35) * MB),
+            upload_sessions=UPLOAD_SESSION_SCOPE.lower() in scopes,
+        )
+
+
+@dataclass
+class MessagePlan:
+    strategy: str
+    wire_bytes: int
+    attachments: List[Attachment]
+    # One plan per message when the strategy is SPLIT
+    parts: List["MessagePlan"] = field(default_factory=list)
+
+
+def as_source(attachment: Attachment) -> AttachmentSource:
+    """View a pre-encoded Graph attachment dict as an AttachmentSource."""
+    if isinstance(attachment, AttachmentSource):
+        return attachment
+    content = attachment.get("contentBytes", "")
+    return AttachmentSource(
+        name=attachment.get("name", "attachment"),
+        content_type=attachment.get("contentType"),
+        size=raw_size(attachment),
+        opener=lambda: io.BytesIO(base64.b64decode(content))
+    )
+
+
+def raw_size(attachment: Attachment) -> int:
+    """Size in bytes of the attachment content before base64 encoding."""
+    if isinstance(attachment, AttachmentSource):
+        return attachment.size
+    content = attachment.get("contentBytes", "")
+    return len(content) * 3 // 4 - content[-2:].count("=")
+
+
+def inline_request_bytes(message_payload: Dict[str, Any], attachments: List[Attachment]) -> int:
+    """Exact size of the sendMail request; no attachment is read."""
+    return len(SendMailBody(message_payload, attachments))
+
+
+def upload_session_request_bytes(
+    message_payload: Dict[str, Any],
+    attachments: List[Attachment],
+    limits: PayloadLimits
+) -> int:
+    """
+    Bytes sent for a draft + attachments + send sequence: the draft JSON,
+    small attachments as JSON objects, large ones raw through upload sessions.
+    """
+    message = {k: v for k, v in message_payload.items() if k != "attachments"}
+    total = len(json.dumps(message))
+    for attachment in attachments:
+        source = as_source(attachment)
+        if source.size >= limits.upload_session_min_bytes:
+            total += len(json.dumps(upload_session_item(source))) + source.size
+        else:
+            total += source.fragment_length()
+    return total
+
+
+def upload_session_item(source: AttachmentSource) -> Dict[str, Any]:
+    """Body of the createUploadSession request for an attachment."""
+    return {
+        "AttachmentItem": {
+            "attachmentType": "file",
+            "name": source.name,
+            "size": source.size,
+            "contentType": source.content_type,
+        }
+    }
+
+
+def _plan_single(message_payload: Dict[str, Any], attachments: List[Attachment], limits: PayloadLimits) -> MessagePlan:
+    inline_bytes = inline_request_bytes(message_payload, attachments)
+    if inline_bytes <= limits.inline_request_bytes:
+        return MessagePlan(INLINE, inline_bytes, attachments)
+    if not limits.upload_sessions:
+        # Only a single attachment too large for any sendMail request gets here
+        logger.warning(
+            f"Message of {inline_bytes} bytes exceeds the sendMail limit and upload sessions "
+            f"need {UPLOAD_SESSION_SCOPE} in GRAPH_SCOPES; sending inline"
+        )
+        return MessagePlan(INLINE, inline_bytes, attachments)
+    return MessagePlan(UPLOAD_SESSION, upload_session_request_bytes(message_payload, attachments, limits), attachments)
+
+
+def plan_message(
+    message_payload: Dict[str, Any],
+    attachments: Optional[List[Attachment]],
+    limits: Optional[PayloadLimits] = None
+) -> MessagePlan:
+    """
+    Choose how to send one message.
+
+    Inline when the whole sendMail request fits, upload session when only the
+    request is too big, otherwise split the attachments (in their original
+    order) into as many messages as needed, each planned on its own. Without
+    upload sessions (limits.upload_sessions off), a message too big for one
+    sendMail request is split into parts that each fit one.
+    """
+    limits = limits or PayloadLimits.from_settings()
+    attachments = list(attachments or [])
+    encoded_total = sum(base64_length(raw_size(a)) for a in attachments)
+    if limits.upload_sessions:
+        if encoded_total <= limits.max_message_bytes:
+            return _plan_single(message_payload, attachments, limits)
+        groups = _group_attachments(attachments, lambda group: sum(
+            base64_length(raw_size(a)) for a in group
+        ) <= limits.max_message_bytes)
+    else:
+        if inline_request_bytes(message_payload, attachments) <= limits.inline_request_bytes:
+            return _plan_single(message_payload, attachments, limits)
+        # Part subjects get a " (i/n)" suffix; size parts with the longest one
+        widest = split_payload(message_payload, len(attachments) - 1, len(attachments))
+        groups = _group_attachments(attachments, lambda group: (
+            inline_request_bytes(widest, group) <= limits.inline_request_bytes
+        ))
+        if len(groups) == 1:
+            return _plan_single(message_payload, attachments, limits)
+
+    parts = [
+        _plan_single(split_payload(message_payload, i, len(groups)), group, limits)
+        for i, group in enumerate(groups)
+    ]
+    return MessagePlan(SPLIT, sum(p.wire_bytes for p in parts), attachments, parts)
+
+
+def _group_attachments(attachments: List[Attachment], fits) -> List[List[Attachment]]:
+    """Consecutive attachments packed into groups while fits(group) holds (each group has at least one)."""
+    groups: List[List[Attachment]] = []
+    for attachment in attachments:
+        if groups and fits(groups[-1] + [attachment]):
+            groups[-1].append(attachment)
+        else:
+            groups.append([attachment])
+    return groups
+
+
+def split_payload(message_payload: Dict[str, Any], index: int, count: int) -> Dict[str, Any]:
+    """Message payload for part index of count, marked in the subject."""
+    payload = dict(message_payload)
+    payload["subject"] = f"{message_payload.get('subject', '')} ({index + 1}/{count})"
+    return payload
+
+
+def summarize_plans(plans: Iterable[MessagePlan]) -> Dict[str, int]:
+    """Strategy counts and expected bytes on the wire for a campaign."""
+    summary = {strategy: 0 for strategy in STRATEGIES}
+    summary["messages"] = 0
+    summary["wire_bytes"] = 0
+    for plan in plans:
+        summary[plan.strategy] += 1
+        summary["messages"] += len(plan.parts) or 1
+        summary["wire_bytes"] += plan.wire_bytes
+    return summary
+
+
+def company_keys(df: pd.DataFrame, company_column: str) -> pd.Series:
+    """Normalized company name of every row ("" when missing)."""
+    if company_column not in df.columns:
+        return pd.Series([""] * len(df), index=df.index)
+    return df[company_column].where(df[company_column].notna(), "").astype(str).map(norm)
+
+
+def send_order_by_company(df: pd.DataFrame, company_column: str) -> List[int]:
+    """
+    Row positions with each company's rows back to back.
+
+    Companies keep the order of their first appearance and rows keep their
+    Excel order within a company, so a company's attachments are built once
+    and reused while they are still cached.
+    """
+    keys = company_keys(df, company_column)
+    codes = pd.Categorical(keys, categories=pd.unique(keys)).codes
+    return pd.Series(codes).sort_values(kind="stable").index.tolist()
+
+
+def message_fingerprint(subject: str, body: str, cc_emails: List[str], files: List[Dict[str, Any]]) -> str:
+    """SHA-256 identifying a rendered message apart from its recipient."""
+    file_ids = [[f["name"], f.get("path", ""), f.get("member") or ""] for f in files]
+    raw = json.dumps([subject, body, list(cc_emails), file_ids], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
@@ -0,0 +1,225 @@
+"""
+Staged, thread-based processing pipeline.
+
+Every stage runs in its own worker threads and hands items to the next
+stage through a bounded queue. A slow stage fills its inbox and blocks the
+stages before it (backpressure), so at most queue_size items wait between
+any two stages no matter how large the input is. CPU-bound stages (encoding)
+and network-bound stages (sending) overlap instead of alternating per row.
+"""
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 8
+
+_DONE = object()
+
+
+class PipelineItem:
+    """One unit of work flowing through the stages."""
+
+    __slots__ = ("index", "data", "error")
+
+    def __init__(self, index: int, data: Dict[str, Any]):
+        self.index = index
+        self.data = data
+        self.error: Optional[Exception] = None
+
+
+class Stage:
+    """
+    A pipeline stage: func(item) is called for every item by `workers` threads.
+
+    Once an item has failed, later stages skip it unless they set
+    handles_errors (typically the final recording stage). An ordered stage
+    receives items in input order even when the stage before it has several
+    workers finishing out of order.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[PipelineItem], None],
+        workers: int = 1,
+        handles_errors: bool = False,
+        ordered: bool = False
+    ):
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+        self.handles_errors = handles_errors
+        self.ordered = ordered
+        self._lock = threading.Lock()
+        self.items = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.queue_samples = 0
+        self.queue_depth_total = 0
+        self.max_queue_depth = 0
+
+    def _record_run(self, seconds: float, failed: bool) -> None:
+        with self._lock:
+            self.items += 1
+            self.errors += int(failed)
+            self.busy_seconds += seconds
+
+    def _record_queue_depth(self, depth: int) -> None:
+        with self._lock:
+            self.queue_samples += 1
+            self.queue_depth_total += depth
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+
+class KeyedOnce:
+    """
+    Values shared by a stage's workers, built once per key.
+
+    A key requested by several workers at once is built by the first one
+    while the others wait for its result (a failed build is retried by the
+    next caller).
+    """
+
+    def __init__(self):
+        self._values: Dict[Hashable, Any] = {}
+        self._key_locks: Dict[Hashable, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, build: Callable[[], Any]) -> Any:
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self._values:
+                self._values[key] = build()
+            return self._values[key]
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+
+class Pipeline:
+    """Run items through stages connected by bounded queues."""
+
+    def __init__(self, stages: List[Stage], queue_size: int = DEFAULT_QUEUE_SIZE):
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage")
+        self.stages = stages
+        self.queue_size = max(1, int(queue_size))
+        self.wall_seconds = 0.0
+
+    def run(self, items: Iterable[Dict[str, Any]]) -> List[PipelineItem]:
+        """
+        Process items and return them in input order once every stage is done.
+
+        Args:
+            items: Iterable of per-item data dicts; consumed lazily
+
+        Returns:
+            List of PipelineItem, with .error set for items that failed
+        """
+        inboxes = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        remaining = [stage.workers for stage in self.stages]
+        remaining_lock = threading.Lock()
+        finished: List[PipelineItem] = []
+        # Reorder buffers of ordered stages: items that arrived ahead of their turn
+        pending: List[Dict[int, PipelineItem]] = [{} for _ in self.stages]
+        next_index = [0] * len(self.stages)
+        order_locks = [threading.Lock() for _ in self.stages]
+
+        def enqueue(position: int, item: Any) -> None:
+            inboxes[position].put(item)
+            if item is not _DONE:
+                self.stages[position]._record_queue_depth(inboxes[position].qsize())
+
+        def put(position: int, item: Any) -> None:
+            if item is _DONE or not self.stages[position].ordered:
+                enqueue(position, item)
+                return
+            # Every item passes every stage, so indexes arrive without gaps
+            with order_locks[position]:
+                pending[position][item.index] = item
+                while next_index[position] in pending[position]:
+                    enqueue(position, pending[position].pop(next_index[position]))
+                    next_index[position] += 1
+
+        def work(position: int) -> None:
+            stage = self.stages[position]
+            last_stage = position == len(self.stages) - 1
+            while True:
+                item = inboxes[position].get()
+                if item is _DONE:
+                    break
+                if item.error is None or stage.handles_errors:
+                    start = time.perf_counter()
+                    failed = False
+                    try:
+                        stage.func(item)
+                    except Exception as e:
+                        logger.debug(f"Pipeline stage {stage.name} failed on item {item.index}: {e}")
+                        item.error = e
+                        failed = True
+                    stage._record_run(time.perf_counter() - start, failed)
+                if last_stage:
+                    finished.append(item)
+                else:
+                    put(position + 1, item)
+
+            # The last worker of a stage closes the next stage's inbox
+            with remaining_lock:
+                remaining[position] -= 1
+                closing = remaining[position] == 0
+            if closing and not last_stage:
+                for _ in range(self.stages[position + 1].workers):
+                    put(position + 1, _DONE)
+
+        threads = [
+            threading.Thread(target=work, args=(position,), name=f"pipeline-{stage.name}-{n}", daemon=True)
+            for position, stage in enumerate(self.stages)
+            for n in range(stage.workers)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            for index, data in enumerate(items):
+                put(0, PipelineItem(index, data))
+        finally:
+            for _ in range(self.stages[0].workers):
+                put(0, _DONE)
+            for thread in threads:
+                thread.join()
+            self.wall_seconds = time.perf_counter() - start
+
+        finished.sort(key=lambda item: item.index)
+        return finished
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """Per-stage counters; utilization is busy time over wall time of all workers."""
+        wall = self.wall_seconds or 1e-9
+        return [
+            {
+                "stage": stage.name,
+                "workers": stage.workers,
+                "items": stage.items,
+                "errors": stage.errors,
+                "busy_seconds": round(stage.busy_seconds, 3),
+                "utilization": round(min(1.0, stage.busy_seconds / (wall * stage.workers)), 3),
+                "avg_queue_depth": round(stage.queue_depth_total / stage.queue_samples, 2) if stage.queue_samples else 0,
+                "max_queue_depth": stage.max_queue_depth,
+            }
+            for stage in self.stages
+        ]
+
+    def format_stats(self) -> List[str]:
+        """Human-readable stats lines for campaign logs."""
+        lines = [f"[PIPELINE] {self.wall_seconds:.1f}s total, queue size {self.queue_size}"]
+        for s in self.stats():
+            lines.append(
+                f"[PIPELINE] {s['stage']}: {s['workers']} worker(s), {s['items']} items, "
+                f"{s['utilization'] * 100:.0f}% busy, queue avg {s['avg_queue_depth']} / max {s['max_queue_depth']}"
+            )
+        return lines
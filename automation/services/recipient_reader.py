@@ -0,0 +1,466 @@
+"""
+Streaming readers for recipient lists (XLSX, CSV and Parquet).
+
+Every reader yields DataFrame batches as the file is parsed instead of
+materializing it first, and exposes the normalized column names before
+the first batch. openpyxl's read-only mode parses the sheet XML
+incrementally (or calamine, a native XLSX engine, is used when installed),
+CSV is read in chunks as strings and Parquet by record batch. Row and cell budgets are checked against declared dimensions up
+front (where the format has them) and against the rows actually read,
+so oversized files are rejected early.
+
+Readers can be narrowed with select() to the columns a campaign uses; the
+other columns are then never turned into DataFrame cells, and empty cells
+of the selected ones come out as "" (numbers stay numbers).
+"""
+import codecs
+import csv
+import io
+import logging
+from dataclasses import dataclass
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from openpyxl import load_workbook
+
+from ..exceptions import FileProcessingError, RecipientListLimitError
+
+try:
+    import pyarrow.parquet as pq
+    PARQUET_SUPPORT = True
+except ImportError:
+    PARQUET_SUPPORT = False
+
+try:
+    from python_calamine import CalamineWorkbook
+    CALAMINE_SUPPORT = True
+except ImportError:
+    CALAMINE_SUPPORT = False
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_ROWS = 5000
+
+XLSX = "xlsx"
+CSV = "csv"
+PARQUET = "parquet"
+FORMATS = (XLSX, CSV, PARQUET)
+
+XLSX_ENGINES = ("auto", "calamine", "openpyxl")
+
+# Bytes looked at to guess the encoding and delimiter of a CSV file
+CSV_SNIFF_BYTES = 64 * 1024
+CSV_FALLBACK_ENCODING = "cp1254"
+
+
+def _decode_as_fallback(error: UnicodeDecodeError):
+    # A UTF-8 file with a Windows-1254 byte past the sniffed head (e.g. rows
+    # pasted from an Excel export): decode just those bytes as Windows-1254
+    return error.object[error.start:error.end].decode(CSV_FALLBACK_ENCODING, errors="replace"), error.end
+
+
+codecs.register_error("recipient_csv_fallback", _decode_as_fallback)
+
+
+@dataclass
+class ReadBudget:
+    max_rows: int = 200_000
+    max_cells: int = 5_000_000
+
+    @classmethod
+    def from_settings(cls) -> "ReadBudget":
+        return cls(
+            max_rows=getattr(settings, "RECIPIENT_MAX_ROWS", 200_000),
+            max_cells=getattr(settings, "RECIPIENT_MAX_CELLS", 5_000_000),
+        )
+
+    def check(self, rows: int, columns: int, declared: bool = False) -> None:
+        """
+        Raises:
+            RecipientListLimitError: If rows or rows x columns exceed the budget
+        """
+        source = "declares" if declared else "has"
+        if rows > self.max_rows:
+            raise RecipientListLimitError(
+                f"Recipient list {source} more than {self.max_rows} rows"
+            )
+        if rows * columns > self.max_cells:
+            raise RecipientListLimitError(
+                f"Recipient list {source} more than {self.max_cells} cells ({rows} rows x {columns} columns)"
+            )
+
+
+def normalize_columns(names: Sequence[Any]) -> List[str]:
+    """
+    Column names stripped and lowercased, then made unique like pd.read_excel:
+    empty headers become "unnamed: i" and duplicates get ".1", ".2" suffixes
+    ("Email" and "email" are read as "email" and "email.1").
+    """
+    columns = []
+    seen = {}
+    for i, name in enumerate(names):
+        label = "" if name is None else str(name).strip().lower()
+        if not label:
+            label = f"unnamed: {i}"
+        if label in seen:
+            seen[label] += 1
+            candidate = f"{label}.{seen[label]}"
+            while candidate in seen:
+                seen[label] += 1
+                candidate = f"{label}.{seen[label]}"
+            label = candidate
+        seen[label] = 0
+        columns.append(label)
+    return columns
+
+
+def cell_value(value: Any) -> Any:
+    """A cell for templates: "" for empty cells, any other value (numbers too) unchanged."""
+    if value is None or value is pd.NA or value is pd.NaT:
+        return ""
+    if isinstance(value, float) and value != value:
+        return ""
+    return value
+
+
+def fill_empty_cells(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    df with empty cells (NaN, None) as "". Columns without empty cells keep
+    their dtype, so numeric placeholders like {amount:.2f} still format.
+    """
+    columns = {}
+    for i in range(df.shape[1]):
+        column = df.iloc[:, i]
+        empty = column.isna()
+        columns[i] = column.astype(object).where(~empty, "") if empty.any() else column
+    return pd.DataFrame(columns, index=df.index).set_axis(list(df.columns), axis=1)
+
+
+def detect_format(name: str, head: bytes) -> str:
+    """
+    Recipient list format from the file's first bytes, then its extension.
+
+    Raises:
+        FileProcessingError: If the format is not supported
+    """
+    lower = (name or "").lower()
+    if head.startswith(b"PK\x03\x04"):
+        return XLSX
+    if head.startswith(b"PAR1"):
+        return PARQUET
+    if lower.endswith((".csv", ".txt")):
+        return CSV
+    if lower.endswith((".xlsx", ".xlsm", ".parquet")):
+        raise FileProcessingError(f"{name} is not a valid {lower.rsplit('.', 1)[-1]} file")
+    raise FileProcessingError(f"Unsupported recipient list format: {name or 'unnamed file'} (use .xlsx, .csv or .parquet)")
+
+
+class XlsxBatchReader:
+    """
+    Read the first sheet of a workbook as DataFrame batches (openpyxl engine).
+
+    The header row is read on construction, so .columns is available before
+    any data row is parsed. Fully empty rows are dropped at the end of the
+    sheet and kept (as NaN rows) in the middle, like pd.read_excel.
+    """
+
+    engine = "openpyxl"
+
+    def __init__(self, src: BinaryIO, batch_size: int = DEFAULT_BATCH_ROWS, budget: Optional[ReadBudget] = None):
+        self.batch_size = max(1, batch_size)
+        self.budget = budget or ReadBudget.from_settings()
+        self.rows_read = 0
+        self._rows, declared_rows, declared_columns = self._open(src)
+        try:
+            header = list(next(self._rows, ()) or ())
+            while header and header[-1] is None:
+                header.pop()
+            self.columns = normalize_columns(header)
+
+            self.budget.check(declared_rows, max(declared_columns, len(self.columns)), declared=True)
+        except Exception:
+            self.close()
+            raise
+        self._selected: Optional[List[int]] = None
+
+    def select(self, columns: Sequence[str]) -> None:
+        """Only yield these columns (in sheet order), with "" for empty cells."""
+        self._selected = [i for i, c in enumerate(self.columns) if c in set(columns)]
+
+    def _open(self, src: BinaryIO):
+        """(row value tuples incl. header, declared data rows, declared columns) of the first sheet."""
+        self._workbook = load_workbook(src, read_only=True, data_only=True)
+        sheet = self._workbook.worksheets[0]
+        return sheet.iter_rows(values_only=True), (sheet.max_row or 1) - 1, sheet.max_column or 0
+
+    def header_frame(self) -> pd.DataFrame:
+        """An empty frame with the sheet's (selected) columns."""
+        if self._selected is not None:
+            return pd.DataFrame(columns=[self.columns[i] for i in self._selected])
+        return pd.DataFrame(columns=self.columns)
+
+    def _frame(self, rows: List[tuple]) -> pd.DataFrame:
+        if self._selected is not None:
+            return pd.DataFrame(
+                [[cell_value(row[i]) for i in self._selected] for row in rows],
+                columns=[self.columns[i] for i in self._selected],
+                dtype=object
+            )
+        return pd.DataFrame.from_records(rows, columns=self.columns).fillna(np.nan)
+
+    def __iter__(self) -> Iterator[pd.DataFrame]:
+        width = len(self.columns)
+        batch: List[tuple] = []
+        pending_empty = 0
+        try:
+            for values in self._rows:
+                row = tuple(values[:width]) + (None,) * (width - len(values))
+                if all(v is None for v in row):
+                    pending_empty += 1
+                    continue
+                self.rows_read += pending_empty + 1
+                self.budget.check(self.rows_read, width)
+                for pending in [(None,) * width] * pending_empty + [row]:
+                    batch.append(pending)
+                    if len(batch) >= self.batch_size:
+                        yield self._frame(batch)
+                        batch = []
+                pending_empty = 0
+            if batch:
+                yield self._frame(batch)
+        finally:
+            self.close()
+        logger.debug(f"Read {self.rows_read} recipient rows")
+
+    def close(self) -> None:
+        self._workbook.close()
+
+
+def _calamine_value(value: Any) -> Any:
+    # calamine reports empty cells as "" and every number as float;
+    # openpyxl gives None and ints for integral numbers
+    if value == "":
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+class CalamineXlsxBatchReader(XlsxBatchReader):
+    """XlsxBatchReader on the native calamine engine (needs python-calamine)."""
+
+    engine = "calamine"
+
+    def _open(self, src: BinaryIO):
+        if not CALAMINE_SUPPORT:
+            raise ImportError("The calamine engine requires python-calamine: pip install python-calamine")
+        self._workbook = CalamineWorkbook.from_filelike(src)
+        sheet = self._workbook.get_sheet_by_index(0)
+        rows = (tuple(_calamine_value(v) for v in row) for row in sheet.iter_rows())
+        return rows, max(sheet.height - 1, 0), sheet.width
+
+    def close(self) -> None:
+        close = getattr(self._workbook, "close", None)
+        if close:
+            close()
+
+
+def get_xlsx_reader_class(engine: Optional[str] = None):
+    """
+    Workbook reader for engine (default: RECIPIENT_XLSX_ENGINE).
+
+    "auto" picks calamine when installed; an explicit "calamine" without
+    python-calamine falls back to openpyxl with a warning.
+    """
+    engine = (engine or getattr(settings, "RECIPIENT_XLSX_ENGINE", "auto")).lower()
+    if engine not in XLSX_ENGINES:
+        raise ValueError(f"Unknown XLSX engine: {engine} (choose from {', '.join(XLSX_ENGINES)})")
+    if engine == "openpyxl":
+        return XlsxBatchReader
+    if CALAMINE_SUPPORT:
+        return CalamineXlsxBatchReader
+    if engine == "calamine":
+        logger.warning("RECIPIENT_XLSX_ENGINE is calamine but python-calamine is not installed, using openpyxl")
+    return XlsxBatchReader
+
+
+def _sniff_csv(head: bytes):
+    """
+    (encoding, encoding error handler, delimiter) of a CSV file from its
+    first bytes. The handler keeps bytes after the head that don't fit the
+    guessed encoding from failing the read.
+    """
+    try:
+        text = head.decode("utf-8-sig")
+        encoding = "utf-8-sig"
+    except UnicodeDecodeError as e:
+        if e.start >= len(head) - 3:
+            # Cut in the middle of a character
+            text = head[:e.start].decode("utf-8-sig")
+            encoding = "utf-8-sig"
+        else:
+            # Excel's Turkish CSV export
+            text = head.decode(CSV_FALLBACK_ENCODING, errors="replace")
+            encoding = CSV_FALLBACK_ENCODING
+    errors = "recipient_csv_fallback" if encoding == "utf-8-sig" else "replace"
+    try:
+        delimiter = csv.Sniffer().sniff(text.split("\n", 1)[0], delimiters=",;\t|").delimiter
+    except csv.Error:
+        delimiter = ","
+    return encoding, errors, delimiter
+
+
+class CsvBatchReader:
+    """
+    Read a CSV file in chunks, every value as a string (missing cells as NaN).
+
+    The encoding (UTF-8, else Windows-1254) and the delimiter (, ; tab or |)
+    are guessed from the start of the file. Later bytes that aren't valid
+    UTF-8 are read as Windows-1254 rather than failing mid-send.
+    """
+
+    def __init__(self, src: BinaryIO, batch_size: int = DEFAULT_BATCH_ROWS, budget: Optional[ReadBudget] = None):
+        self.batch_size = max(1, batch_size)
+        self.budget = budget or ReadBudget.from_settings()
+        self.rows_read = 0
+        head = src.read(CSV_SNIFF_BYTES)
+        src.seek(0)
+        self.encoding, self.encoding_errors, self.delimiter = _sniff_csv(head)
+        header = pd.read_csv(
+            io.BytesIO(head), sep=self.delimiter, encoding=self.encoding, encoding_errors=self.encoding_errors,
+            nrows=0, dtype=str
+        )
+        self.columns = normalize_columns(header.columns)
+        self._src = src
+        self._selected: Optional[List[int]] = None
+
+    def select(self, columns: Sequence[str]) -> None:
+        """Only parse these columns, with "" for empty cells."""
+        self._selected = [i for i, c in enumerate(self.columns) if c in set(columns)]
+
+    def _output_columns(self) -> List[str]:
+        if self._selected is None:
+            return self.columns
+        return [self.columns[i] for i in self._selected]
+
+    def header_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(columns=self._output_columns())
+
+    def __iter__(self) -> Iterator[pd.DataFrame]:
+        chunks = pd.read_csv(
+            self._src, sep=self.delimiter, encoding=self.encoding, encoding_errors=self.encoding_errors,
+            dtype=str, chunksize=self.batch_size, usecols=self._selected
+        )
+        columns = self._output_columns()
+        with chunks:
+            for chunk in chunks:
+                self.rows_read += len(chunk)
+                self.budget.check(self.rows_read, len(self.columns))
+                chunk.columns = columns
+                yield chunk.fillna("") if self._selected is not None else chunk
+        logger.debug(f"Read {self.rows_read} recipient rows from CSV")
+
+    def close(self) -> None:
+        pass
+
+
+class ParquetBatchReader:
+    """Read a Parquet file record batch by record batch (needs pyarrow)."""
+
+    def __init__(self, src: BinaryIO, batch_size: int = DEFAULT_BATCH_ROWS, budget: Optional[ReadBudget] = None):
+        if not PARQUET_SUPPORT:
+            raise FileProcessingError("Parquet recipient lists need pyarrow: pip install pyarrow")
+        self.batch_size = max(1, batch_size)
+        self.budget = budget or ReadBudget.from_settings()
+        self.rows_read = 0
+        self._file = pq.ParquetFile(src)
+        self._names = self._file.schema_arrow.names
+        self.columns = normalize_columns(self._names)
+        self.budget.check(self._file.metadata.num_rows, len(self.columns), declared=True)
+        self._selected: Optional[List[int]] = None
+
+    def select(self, columns: Sequence[str]) -> None:
+        """Only decode these columns, with "" for empty cells."""
+        self._selected = [i for i, c in enumerate(self.columns) if c in set(columns)]
+
+    def header_frame(self) -> pd.DataFrame:
+        if self._selected is not None:
+            return pd.DataFrame(columns=[self.columns[i] for i in self._selected])
+        return pd.DataFrame(columns=self.columns)
+
+    def __iter__(self) -> Iterator[pd.DataFrame]:
+        indices = self._selected if self._selected is not None else range(len(self.columns))
+        names = [self._names[i] for i in indices]
+        for batch in self._file.iter_batches(batch_size=self.batch_size, columns=names):
+            df = batch.to_pandas()
+            df.columns = [self.columns[i] for i in indices]
+            self.rows_read += len(df)
+            yield fill_empty_cells(df) if self._selected is not None else df
+        logger.debug(f"Read {self.rows_read} recipient rows from Parquet")
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def _choose_reader(name: str, head: bytes, engine: Optional[str] = None):
+    fmt = detect_format(name, head)
+    if fmt == XLSX:
+        return fmt, get_xlsx_reader_class(engine)
+    return fmt, CsvBatchReader if fmt == CSV else ParquetBatchReader
+
+
+def reader_options(name: str, head: bytes, engine: Optional[str] = None) -> Dict[str, str]:
+    """
+    The format and reader class open_recipient_reader() would pick for a
+    file, for keying parsed datasets.
+
+    Raises:
+        FileProcessingError: If the format is not supported
+    """
+    fmt, reader_class = _choose_reader(name, head, engine)
+    return {"format": fmt, "reader": reader_class.__name__}
+
+
+def open_recipient_reader(
+    src: BinaryIO,
+    name: str = "",
+    batch_size: int = DEFAULT_BATCH_ROWS,
+    budget: Optional[ReadBudget] = None,
+    engine: Optional[str] = None
+):
+    """A batch reader for src, chosen by detect_format() (and engine for workbooks)."""
+    head = src.read(8)
+    src.seek(0)
+    fmt, reader_class = _choose_reader(name, head, engine)
+    logger.debug(f"Reading recipient list {name or '(unnamed)'} as {fmt} ({reader_class.__name__})")
+    return reader_class(src, batch_size=batch_size, budget=budget)
+
+
+def _concat(reader) -> pd.DataFrame:
+    batches = list(reader)
+    if not batches:
+        return reader.header_frame()
+    return pd.concat(batches, ignore_index=True)
+
+
+def read_recipients(
+    src: BinaryIO,
+    name: str = "",
+    budget: Optional[ReadBudget] = None,
+    batch_size: int = DEFAULT_BATCH_ROWS,
+    engine: Optional[str] = None
+) -> pd.DataFrame:
+    """Read a whole recipient list of any supported format."""
+    return _concat(open_recipient_reader(src, name, batch_size=batch_size, budget=budget, engine=engine))
+
+
+def read_xlsx(
+    src: BinaryIO,
+    budget: Optional[ReadBudget] = None,
+    batch_size: int = DEFAULT_BATCH_ROWS,
+    engine: Optional[str] = None
+) -> pd.DataFrame:
+    """Read a whole workbook with the configured (or given) engine."""
+    return _concat(get_xlsx_reader_class(engine)(src, batch_size=batch_size, budget=budget))
@@ -0,0 +1,134 @@
+"""
+Pre-send validation of recipient lists.
+
+Every row is checked with column-wise string operations before anything is
+sent: the email address must be present and well-formed, each CC address
+(split on ";" or ",") must be well-formed, and every {placeholder} of the
+template must have a column. Rows that fail are excluded from dispatch and
+reported with their reasons instead of costing a Graph call each.
+"""
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from .template_render import normalize_key
+
+logger = logging.getLogger(__name__)
+
+# Pragmatic address check (dot-atom local part, dotted host name with a TLD)
+EMAIL_PATTERN = (
+    r"[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+)*"
+    r"@(?:[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?\.)+[A-Za-z]{2,63}"
+)
+
+
+def missing_placeholders(fields: Optional[Iterable[str]], columns: Sequence[Any]) -> List[str]:
+    """Placeholders that no column fills (SafeDict would leave them in the message)."""
+    if not fields:
+        return []
+    available = {str(c) for c in columns} | {normalize_key(c) for c in columns}
+    return sorted(f for f in fields if f not in available)
+
+
+def _text(column: pd.Series) -> pd.Series:
+    return column.where(column.notna(), "").astype(str).str.strip()
+
+
+@dataclass
+class ValidationResult:
+    """Per-row outcome of validate_recipients()."""
+    invalid: np.ndarray
+    reasons: pd.Series
+    counts: Dict[str, int] = field(default_factory=dict)
+    missing_columns: List[str] = field(default_factory=list)
+
+    @property
+    def invalid_count(self) -> int:
+        return int(self.invalid.sum())
+
+    @property
+    def valid_count(self) -> int:
+        return int(len(self.invalid) - self.invalid.sum())
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "valid": self.valid_count,
+            "invalid": self.invalid_count,
+            "missing_columns": ", ".join(self.missing_columns),
+            **self.counts,
+        }
+
+
+def validate_recipients(
+    df: pd.DataFrame,
+    email_column: str,
+    fields: Optional[Iterable[str]] = None,
+    cc_column: str = "cc"
+) -> ValidationResult:
+    """
+    Check every row of df without rendering or sending anything.
+
+    Args:
+        df: Recipient rows
+        email_column: Column holding the recipient address
+        fields: {placeholder} names of the template (None skips the check)
+        cc_column: Column holding CC addresses, if present
+
+    Returns:
+        ValidationResult with an invalid-row mask and the reasons per row
+    """
+    n = len(df)
+    reasons = np.full(n, "", dtype=object)
+    invalid = np.zeros(n, dtype=bool)
+    counts = {"empty_email": 0, "invalid_email": 0, "invalid_cc": 0}
+
+    def flag(mask: np.ndarray, reason, counter: Optional[str] = None) -> None:
+        nonlocal reasons, invalid
+        mask = np.asarray(mask, dtype=bool)
+        if not mask.any():
+            return
+        if counter:
+            counts[counter] += int(mask.sum())
+        reason = np.broadcast_to(np.asarray(reason, dtype=object), (n,))
+        joined = np.where(invalid, reasons + "; " + reason, reason)
+        reasons = np.where(mask, joined, reasons)
+        invalid |= mask
+
+    if email_column in df.columns:
+        email = _text(df[email_column])
+        empty = (email == "").to_numpy()
+        malformed = ~empty & ~email.str.fullmatch(EMAIL_PATTERN).fillna(False).to_numpy(dtype=bool)
+        flag(empty, "Empty email address", "empty_email")
+        flag(malformed, ("Invalid email address: " + email).to_numpy(dtype=object), "invalid_email")
+    else:
+        flag(np.ones(n, dtype=bool), f"Missing email column '{email_column}'", "empty_email")
+
+    if cc_column in df.columns and n:
+        # One entry per CC address, keyed by row position
+        cc = _text(df[cc_column]).reset_index(drop=True)
+        addresses = cc.str.replace(";", ",", regex=False).str.split(",").explode().str.strip()
+        addresses = addresses[addresses != ""]
+        bad = addresses[~addresses.str.fullmatch(EMAIL_PATTERN).fillna(False)]
+        if len(bad):
+            bad_cc = np.zeros(n, dtype=bool)
+            bad_cc[bad.index.unique().to_numpy(dtype=int)] = True
+            detail = bad.groupby(level=0).agg(", ".join).reindex(range(n), fill_value="")
+            flag(bad_cc, "Invalid CC address: " + detail.to_numpy(dtype=object), "invalid_cc")
+
+    missing = missing_placeholders(fields, df.columns)
+    if missing:
+        placeholders = ", ".join("{" + f + "}" for f in missing)
+        flag(np.ones(n, dtype=bool), f"No column for placeholder(s) {placeholders}")
+
+    result = ValidationResult(
+        invalid=invalid,
+        reasons=pd.Series(reasons, index=df.index, dtype=object),
+        counts=counts,
+        missing_columns=missing
+    )
+    if result.invalid_count:
+        logger.info(f"Recipient validation: {result.invalid_count} of {n} rows invalid {counts}")
+    return result
@@ -1,5 +1,10 @@
-from collections import UserDict
-from typing import Dict, Any, Tuple
+import string
+import threading
+from collections import OrderedDict, UserDict
+
+import numpy as np
+import pandas as pd
+from typing import Dict, Any, List, Optional, Sequence, Set, Tuple
 
 
 def normalize_key(k: str) -> str:
@@ -11,6 +16,35 @@ class SafeDict(UserDict):
         return "{" + key + "}"
 
 
+def template_fields(*templates: str, engine: str = "format") -> Optional[Set[str]]:
+    """
+    Context keys referenced by str.format templates ("{name}", "{row.attr}",
+    "{amount:{width}}" -> name, row, amount, width), or by Jinja templates
+    with engine="jinja".
+
+    Returns None if a template does not parse, so callers keep every column.
+    """
+    if engine == "jinja":
+        from .jinja_render import jinja_fields
+        return jinja_fields(*templates)
+    formatter = string.Formatter()
+    fields: Set[str] = set()
+    pending = [t for t in templates if t]
+    try:
+        while pending:
+            for _literal, field, spec, _conversion in formatter.parse(pending.pop()):
+                if field is None:
+                    continue
+                key = field.split(".", 1)[0].split("[", 1)[0]
+                if key and not key.isdigit():
+                    fields.add(key)
+                if spec and "{" in spec:
+                    pending.append(spec)
+    except ValueError:
+        return None
+    return fields
+
+
 def build_context(row: Dict[str, Any]) -> Dict[str, Any]:
     ctx: Dict[str, Any] = {}
     for k, v in row.items():
@@ -32,7 +66,282 @@ def render_text(tpl: str, row: Dict[str, Any]) -> str:
     return rendered
 
 
-def render_subject_body(subject_tpl: str, body_tpl: str, row: Dict[str, Any]) -> Tuple[str, str]:
+def render_subject_body(
+    subject_tpl: str, body_tpl: str, row: Dict[str, Any], engine: str = "format"
+) -> Tuple[str, str]:
+    if engine == "jinja":
+        from .jinja_render import render_jinja_subject_body
+        return render_jinja_subject_body(subject_tpl, body_tpl, row)
     return render_text(subject_tpl, row), render_text(body_tpl, row)
 
 
+def _html_breaks(text: str) -> str:
+    return text.replace('\r\n', '\n').replace('\r', '\n').replace('\n', '<br>')
+
+
+def _resolve_columns(columns: Sequence[Any]) -> Dict[str, int]:
+    """Context key -> tuple index, with build_context's precedence (normalized keys win, last column wins)."""
+    index: Dict[str, int] = {}
+    for i, c in enumerate(columns):
+        index[str(c)] = i
+    for i, c in enumerate(columns):
+        index[normalize_key(c)] = i
+    return index
+
+
+_CONVERSIONS = {"r": repr, "s": str, "a": ascii}
+
+
+def _column_text(column: pd.Series) -> pd.Series:
+    """A column as format_map would print it with build_context's None -> ""."""
+    if column.dtype.kind in "iufb":
+        return column.astype(str)
+    if pd.api.types.infer_dtype(column, skipna=False) == "string":
+        return column
+    return column.map(lambda v: "" if v is None else format(v, "")).astype(object)
+
+
+class CompiledTemplate:
+    """
+    A template parsed once for a campaign's columns, rendering rows given as
+    value tuples (df.itertuples(index=False, name=None)) exactly like render_text.
+
+    Literals are split out and have their line breaks converted at compile
+    time; fields are resolved to tuple indexes. Templates the fast path does
+    not cover (attribute/index access, nested format specs, positional or
+    malformed fields) and values containing line breaks go through
+    render_text.
+
+    Templates of plain placeholders (no format spec or conversion) can also
+    be rendered a whole frame at a time with render_frame().
+    """
+
+    def __init__(self, tpl: str, columns: Sequence[Any]):
+        self.tpl = tpl or ""
+        self.columns = list(columns)
+        # (converted literal, column index or None, spec, conversion, missing-field text)
+        self.segments: List[Tuple[str, Optional[int], str, Any, Optional[str]]] = []
+        self._raw_literals: List[str] = []
+        self.compiled = self._compile()
+        self.bulk = self.compiled and all(
+            column is None or (not spec and conversion is None)
+            for _literal, column, spec, conversion, _missing in self.segments
+        )
+
+    def _compile(self) -> bool:
+        index = _resolve_columns(self.columns)
+        try:
+            parsed = list(string.Formatter().parse(self.tpl))
+        except ValueError:
+            return False
+        for literal, field, spec, conversion in parsed:
+            if field is not None and literal.endswith("\r"):
+                # A bare CR could pair with an LF after the field
+                return False
+            self._raw_literals.append(literal)
+            literal = _html_breaks(literal)
+            if field is None:
+                self.segments.append((literal, None, "", None, None))
+                continue
+            simple = field and not field.isdigit() and "." not in field and "[" not in field
+            if not simple or "{" in (spec or "") or (conversion and conversion not in _CONVERSIONS):
+                return False
+            column = index.get(field)
+            convert = _CONVERSIONS.get(conversion)
+            missing = None
+            if column is None:
+                # SafeDict leaves unknown placeholders in place (conversion and spec still apply)
+                placeholder = "{" + field + "}"
+                try:
+                    missing = format(convert(placeholder) if convert else placeholder, spec or "")
+                except ValueError:
+                    return False
+            self.segments.append((literal, column, spec or "", convert, missing))
+        return True
+
+    def render(self, values: Sequence[Any]) -> str:
+        if not self.compiled:
+            return self._render_slow(values)
+        out = []
+        for literal, column, spec, conversion, missing in self.segments:
+            out.append(literal)
+            if column is None:
+                if missing is not None:
+                    out.append(missing)
+                continue
+            value = values[column]
+            if value is None:
+                value = ""
+            if conversion is not None:
+                value = conversion(value)
+            text = value if not spec and type(value) is str else format(value, spec)
+            if "\n" in text or "\r" in text:
+                # Line breaks in values interact with neighbouring literals
+                return self._render_slow(values)
+            out.append(text)
+        return "".join(out)
+
+    def _render_slow(self, values: Sequence[Any]) -> str:
+        return render_text(self.tpl, dict(zip(self.columns, values)))
+
+    def render_frame(self, df: pd.DataFrame) -> Optional[pd.Series]:
+        """
+        Render every row of df (with this template's columns) by concatenating
+        whole columns; None if the template needs per-row rendering.
+        """
+        if not self.bulk:
+            return None
+        texts = {
+            column: _column_text(df.iloc[:, column]).to_numpy(dtype=object)
+            for _literal, column, _spec, _conversion, _missing in self.segments
+            if column is not None
+        }
+        # Line breaks in values are converted over the whole string, as render_text does
+        breaks = any("\n" in v or "\r" in v for text in texts.values() for v in text)
+        rendered = np.full(len(df), "", dtype=object)
+        for raw_literal, (literal, column, _spec, _conversion, missing) in zip(self._raw_literals, self.segments):
+            literal = raw_literal if breaks else literal
+            if literal:
+                rendered = rendered + literal
+            if column is not None:
+                rendered = rendered + texts[column]
+            elif missing is not None:
+                rendered = rendered + missing
+        rendered = pd.Series(rendered, index=df.index, dtype=object)
+        if breaks:
+            rendered = (
+                rendered.str.replace("\r\n", "\n", regex=False)
+                .str.replace("\r", "\n", regex=False)
+                .str.replace("\n", "<br>", regex=False)
+            )
+        return rendered
+
+
+class CompiledSubjectBody:
+    """Subject and body templates compiled once per campaign."""
+
+    def __init__(self, subject_tpl: str, body_tpl: str, columns: Sequence[Any]):
+        self.subject = CompiledTemplate(subject_tpl, columns)
+        self.body = CompiledTemplate(body_tpl, columns)
+
+    @property
+    def bulk(self) -> bool:
+        return self.subject.bulk and self.body.bulk
+
+    def render(self, values: Sequence[Any]) -> Tuple[str, str]:
+        return self.subject.render(values), self.body.render(values)
+
+    def render_frame(self, df: pd.DataFrame) -> Optional[List[Tuple[str, str]]]:
+        """(subject, body) of every row of df, or None unless both templates render in bulk."""
+        if not self.bulk:
+            return None
+        return list(zip(self.subject.render_frame(df), self.body.render_frame(df)))
+
+
+class MemoizedRenderer:
+    """
+    Wraps a campaign renderer so rows with the same values in the columns
+    the templates reference share one rendered (subject, body).
+
+    Entries are kept in an LRU of max_entries. Without known fields (a
+    template that does not parse) every row is rendered.
+    """
+
+    def __init__(self, renderer, columns: Sequence[Any], fields: Optional[Set[str]], max_entries: int = 50_000):
+        self.renderer = renderer
+        self.max_entries = max(0, max_entries)
+        index = _resolve_columns(columns)
+        self.key_indexes: Optional[List[int]] = None
+        if fields is not None:
+            self.key_indexes = sorted({index[f] for f in fields if f in index})
+        self._cache: "OrderedDict[tuple, Tuple[str, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.uncached = 0
+        self.bulk_rows = 0
+
+    @property
+    def bulk(self) -> bool:
+        return getattr(self.renderer, "bulk", False)
+
+    def render(self, values: Sequence[Any]) -> Tuple[str, str]:
+        if self.key_indexes is None or not self.max_entries:
+            with self._lock:
+                self.uncached += 1
+            return self.renderer.render(values)
+        # 1, 1.0 and True are equal keys but render differently
+        key = tuple((type(values[i]), values[i]) for i in self.key_indexes)
+        try:
+            with self._lock:
+                rendered = self._cache.get(key)
+                if rendered is not None:
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    return rendered
+        except TypeError:
+            # Unhashable cell values
+            with self._lock:
+                self.uncached += 1
+            return self.renderer.render(values)
+        rendered = self.renderer.render(values)
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = rendered
+            if len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return rendered
+
+    def render_frame(self, df: pd.DataFrame) -> Optional[List[Tuple[str, str]]]:
+        rendered = self.renderer.render_frame(df)
+        if rendered is not None:
+            with self._lock:
+                self.bulk_rows += len(df)
+        return rendered
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "rows": lookups + self.uncached + self.bulk_rows,
+                "renders": self.misses + self.uncached,
+                "hits": self.hits,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "bulk_rows": self.bulk_rows,
+                "key_columns": len(self.key_indexes) if self.key_indexes is not None else None,
+            }
+
+    def format_stats(self) -> str:
+        """One-line summary for campaign logs."""
+        s = self.stats()
+        if s["bulk_rows"] == s["rows"] and s["rows"]:
+            return f"[RENDER] {s['rows']} rows rendered column-wise"
+        if s["key_columns"] is None:
+            return f"[RENDER] {s['rows']} rows, {s['renders']} rendered (not memoized: template fields unknown)"
+        return (
+            f"[RENDER] {s['rows']} rows, {s['renders']} rendered, {s['hits']} reused "
+            f"(hit rate {s['hit_rate']:.0%}, memoized on {s['key_columns']} referenced column(s))"
+        )
+
+
+def compile_subject_body(
+    subject_tpl: str,
+    body_tpl: str,
+    columns: Sequence[Any],
+    engine: str = "format",
+    memoize: bool = False,
+    max_entries: int = 50_000
+):
+    """
+    Campaign renderer for the template's engine ("format" or "jinja"),
+    optionally memoized on the referenced columns.
+    """
+    if engine == "jinja":
+        from .jinja_render import JinjaSubjectBody
+        renderer = JinjaSubjectBody(subject_tpl, body_tpl, columns)
+    else:
+        renderer = CompiledSubjectBody(subject_tpl, body_tpl, columns)
+    if not memoize:
+        return renderer
+    fields = template_fields(subject_tpl, body_tpl, engine=engine)
+    return MemoizedRenderer(renderer, columns, fields, max_entries=max_entries)
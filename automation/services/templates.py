@@ -51,7 +51,7 @@ class TemplateService:
             raise TemplateNotFoundError(f"Template '{name}' not found")
         return templates[name]
     
-    def save_template(self, name: str, subject: str, body: str) -> None:
+    def save_template(self, name: str, subject: str, body: str, engine: str = "format") -> None:
         """
         Save or update a template for the current user.
         
@@ -59,9 +59,12 @@ class TemplateService:
             name: Template name
             subject: Email subject template
             body: Email body template
+            engine: "format" for {placeholder} templates, "jinja" for Jinja2
         """
         templates = self.get_templates()
         templates[name] = {"subject": subject, "body": body}
+        if engine != "format":
+            templates[name]["engine"] = engine
         self._save_user_templates(templates)
         # Update cache
         self._templates_cache = templates
@@ -116,13 +119,17 @@ class TemplateService:
             # Normalize to {subject, body} format
             normalized: Dict[str, Dict[str, str]] = {}
             for name, value in data.items():
+                engine = "format"
                 if isinstance(value, dict):
                     subject = str(value.get("subject", ""))
                     body = str(value.get("body", ""))
+                    engine = str(value.get("engine") or "format")
                 else:  # Legacy format
                     subject = ""
                     body = str(value)
                 normalized[str(name)] = {"subject": subject, "body": body}
+                if engine != "format":
+                    normalized[str(name)]["engine"] = engine
             
             return normalized
         except Exception as e:
@@ -165,7 +172,9 @@ class TemplateService:
             TemplateNotFoundError: If template doesn't exist
         """
         template = self.get_template(name)
-        return render_subject_body(template["subject"], template["body"], context)
+        return render_subject_body(
+            template["subject"], template["body"], context, engine=template.get("engine", "format")
+        )
     
     def upload_templates_from_json(self, json_content: str) -> None:
         """
@@ -0,0 +1,483 @@
+"""
+Mail transports behind send_single_mail() and send_bulk_mails().
+
+Every transport delivers the same Graph-shaped message payload (see
+mailer.build_message_payload) plus its attachments:
+
+- graph: Microsoft Graph sendMail / drafts / upload sessions (default)
+- smtp:  pooled, persistent SMTP connections; MIME is streamed to the socket
+- file:  writes .eml files to a directory, for dry runs and benchmarks
+
+The transport is chosen with the MAIL_TRANSPORT setting.
+"""
+import email.utils
+import io
+import logging
+import os
+import queue
+import smtplib
+import threading
+import time
+import uuid
+from email.header import Header
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from django.conf import settings
+
+from ..exceptions import DeliveryUnknownError, PartialDeliveryError
+from .graph_payload import Attachment, AttachmentFragmentCache, iter_base64
+from .payload_planner import MessagePlan, PayloadLimits, as_source, plan_message
+
+logger = logging.getLogger(__name__)
+
+GRAPH = "graph"
+SMTP = "smtp"
+FILE = "file"
+
+# 57 raw bytes encode to one 76-character base64 line (RFC 2045)
+MIME_LINE_BYTES = 57
+MIME_CHUNK_SIZE = MIME_LINE_BYTES * 3 * 1024
+CRLF = b"\r\n"
+
+
+class MailTransport:
+    """Delivers message payloads; subclasses implement send()."""
+
+    name = ""
+
+    def send(
+        self,
+        message_payload: Dict[str, Any],
+        attachments: Optional[List[Attachment]] = None,
+        timeout: int = 15,
+        user_id: Optional[int] = None,
+        fragment_cache: Optional[AttachmentFragmentCache] = None,
+        plan: Optional[MessagePlan] = None
+    ) -> bool:
+        """
+        Send one message.
+
+        Args:
+            message_payload: Graph message payload without attachments
+            attachments: Graph attachment dicts or AttachmentSource objects
+            timeout: Network timeout in seconds
+            user_id: User ID for authentication context
+            fragment_cache: Campaign-wide cache of serialized attachments (Graph only)
+            plan: Send strategy from payload_planner.plan_message() (Graph only)
+
+        Returns:
+            True if successful
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Release connections held by the transport."""
+
+
+class GraphTransport(MailTransport):
+    """Microsoft Graph, planned per message as inline, upload session or split."""
+
+    name = GRAPH
+
+    def send(self, message_payload, attachments=None, timeout=15, user_id=None, fragment_cache=None, plan=None):
+        # Resolved through the mailer module so its patched names keep working
+        from . import mailer
+
+        access_token = mailer.acquire_token_silent_or_fail(user_id)
+        if not attachments:
+            return mailer.graph_send_mail(access_token, message_payload, timeout)
+
+        limits = PayloadLimits.from_settings()
+        plan = plan or plan_message(message_payload, attachments, limits)
+        return mailer._send_planned(access_token, message_payload, plan, limits, timeout, fragment_cache)
+
+
+# -------------------- MIME --------------------
+
+def _addresses(message_payload: Dict[str, Any], field: str) -> List[str]:
+    return [r["emailAddress"]["address"] for r in message_payload.get(field, [])]
+
+
+def _base64_lines(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Re-wrap base64 output into CRLF-terminated 76-character lines."""
+    pending = b""
+    for chunk in chunks:
+        pending += chunk
+        cut = len(pending) - len(pending) % 76
+        for start in range(0, cut, 76):
+            yield pending[start:start + 76] + CRLF
+        pending = pending[cut:]
+    if pending:
+        yield pending + CRLF
+
+
+def _header(name: str, value: str) -> bytes:
+    encoded = value if value.isascii() else Header(value, "utf-8", header_name=name).encode(linesep="\r\n")
+    return f"{name}: {encoded}".encode("ascii") + CRLF
+
+
+def iter_mime_message(
+    from_addr: str,
+    message_payload: Dict[str, Any],
+    attachments: Optional[List[Attachment]] = None
+) -> Iterator[bytes]:
+    """
+    Serialize a Graph message payload as a MIME message, CRLF line by line.
+
+    Attachment content is read and base64-encoded while the lines are
+    consumed, so no attachment is held in memory. BCC recipients are not
+    written to the headers.
+    """
+    to_addrs = _addresses(message_payload, "toRecipients")
+    cc_addrs = _addresses(message_payload, "ccRecipients")
+    body = message_payload.get("body", {})
+    subtype = "html" if body.get("contentType", "HTML").lower() == "html" else "plain"
+
+    yield _header("From", from_addr)
+    if to_addrs:
+        yield _header("To", ", ".join(to_addrs))
+    if cc_addrs:
+        yield _header("Cc", ", ".join(cc_addrs))
+    yield _header("Subject", message_payload.get("subject", ""))
+    yield _header("Date", email.utils.formatdate(localtime=True))
+    yield _header("Message-ID", email.utils.make_msgid())
+    yield _header("MIME-Version", "1.0")
+
+    text_headers = [
+        _header("Content-Type", f'text/{subtype}; charset="utf-8"'),
+        _header("Content-Transfer-Encoding", "base64"),
+    ]
+    text_lines = _base64_lines(iter_base64(io.BytesIO(body.get("content", "").encode("utf-8"))))
+
+    if not attachments:
+        yield from text_headers
+        yield CRLF
+        yield from text_lines
+        return
+
+    boundary = f"=_{uuid.uuid4().hex}"
+    yield _header("Content-Type", f'multipart/mixed; boundary="{boundary}"')
+    yield CRLF
+    yield f"--{boundary}".encode("ascii") + CRLF
+    yield from text_headers
+    yield CRLF
+    yield from text_lines
+
+    for attachment in attachments:
+        source = as_source(attachment)
+        filename = email.utils.encode_rfc2231(source.name, "utf-8")
+        yield f"--{boundary}".encode("ascii") + CRLF
+        yield _header("Content-Type", source.content_type)
+        yield _header("Content-Disposition", f"attachment; filename*={filename}")
+        yield _header("Content-Transfer-Encoding", "base64")
+        yield CRLF
+        with source.open() as src:
+            yield from _base64_lines(iter_base64(src, MIME_CHUNK_SIZE))
+    yield f"--{boundary}--".encode("ascii") + CRLF
+
+
+# -------------------- SMTP --------------------
+
+class _PooledConnection:
+    __slots__ = ("smtp", "messages", "last_used")
+
+    def __init__(self, smtp: smtplib.SMTP):
+        self.smtp = smtp
+        self.messages = 0
+        self.last_used = time.monotonic()
+
+
+class SMTPTransport(MailTransport):
+    """
+    SMTP with a pool of persistent connections.
+
+    A connection is reused for up to max_messages messages (one session
+    instead of a connect/TLS/AUTH handshake per message) and checked with
+    NOOP when it has been idle. The message is streamed to the socket line
+    by line after DATA, dot-stuffed, so attachments are never built in memory.
+    """
+
+    name = SMTP
+
+    def __init__(
+        self,
+        host: str,
+        port: int = 587,
+        username: str = "",
+        password: str = "",
+        from_addr: str = "",
+        use_tls: bool = True,
+        use_ssl: bool = False,
+        pool_size: int = 2,
+        max_messages: int = 100,
+        idle_check_seconds: float = 30,
+        timeout: int = 30
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.from_addr = from_addr or username
+        self.use_tls = use_tls
+        self.use_ssl = use_ssl
+        self.pool_size = max(1, pool_size)
+        self.max_messages = max(1, max_messages)
+        self.idle_check_seconds = idle_check_seconds
+        self.timeout = timeout
+        self._idle: "queue.LifoQueue[_PooledConnection]" = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._open = 0
+        self._slots = threading.BoundedSemaphore(self.pool_size)
+        self.connections_opened = 0
+        self.messages_sent = 0
+
+    @classmethod
+    def from_settings(cls) -> "SMTPTransport":
+        return cls(
+            host=getattr(settings, "SMTP_HOST", "localhost"),
+            port=getattr(settings, "SMTP_PORT", 587),
+            username=getattr(settings, "SMTP_USERNAME", ""),
+            password=getattr(settings, "SMTP_PASSWORD", ""),
+            from_addr=getattr(settings, "SMTP_FROM", ""),
+            use_tls=getattr(settings, "SMTP_USE_TLS", True),
+            use_ssl=getattr(settings, "SMTP_USE_SSL", False),
+            pool_size=getattr(settings, "SMTP_POOL_SIZE", 2),
+            max_messages=getattr(settings, "SMTP_MAX_MESSAGES_PER_CONNECTION", 100),
+        )
+
+    def _connect(self, timeout: float) -> _PooledConnection:
+        if self.use_ssl:
+            smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=timeout)
+        else:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=timeout)
+            if self.use_tls:
+                smtp.starttls()
+        if self.username:
+            smtp.login(self.username, self.password)
+        with self._lock:
+            self._open += 1
+            self.connections_opened += 1
+        logger.debug(f"Opened SMTP connection to {self.host}:{self.port}")
+        return _PooledConnection(smtp)
+
+    def _discard(self, conn: _PooledConnection, quit: bool = True) -> None:
+        try:
+            if quit:
+                conn.smtp.quit()
+            else:
+                conn.smtp.close()
+        except (smtplib.SMTPException, OSError):
+            pass
+        with self._lock:
+            self._open -= 1
+
+    def _checkout(self, timeout: float) -> _PooledConnection:
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect(timeout)
+            # A pooled session takes the timeout of the message it sends next
+            conn.smtp.timeout = timeout
+            if conn.smtp.sock is not None:
+                conn.smtp.sock.settimeout(timeout)
+            if time.monotonic() - conn.last_used < self.idle_check_seconds:
+                return conn
+            try:
+                if conn.smtp.noop()[0] == 250:
+                    return conn
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._discard(conn, quit=False)
+
+    def _checkin(self, conn: _PooledConnection) -> None:
+        conn.last_used = time.monotonic()
+        if conn.messages >= self.max_messages:
+            self._discard(conn)
+        else:
+            self._idle.put(conn)
+
+    def _transmit(
+        self,
+        smtp: smtplib.SMTP,
+        from_addr: str,
+        primary: List[str],
+        copies: List[str],
+        lines: Iterator[bytes]
+    ) -> Dict[str, Any]:
+        """
+        Deliver one message over an open session.
+
+        Returns:
+            The refused CC/BCC recipients as {address: (code, response)}
+
+        Raises:
+            smtplib.SMTPRecipientsRefused: If a To recipient (or every recipient) is refused
+        """
+        code, resp = smtp.mail(from_addr)
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+        refused = {}
+        for recipient in primary + copies:
+            code, resp = smtp.rcpt(recipient)
+            if code not in (250, 251):
+                logger.warning(f"SMTP server refused recipient {recipient}: {code} {resp!r}")
+                refused[recipient] = (code, resp)
+        refused_primary = {r: refused[r] for r in primary if r in refused}
+        if refused_primary or len(refused) == len(primary) + len(copies):
+            # Nothing is sent unless every addressee can get it
+            smtp.rset()
+            raise smtplib.SMTPRecipientsRefused(refused_primary or refused)
+
+        smtp.putcmd("data")
+        code, resp = smtp.getreply()
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+        try:
+            buffer = []
+            buffered = 0
+            for line in lines:
+                if line.startswith(b"."):
+                    line = b"." + line
+                buffer.append(line)
+                buffered += len(line)
+                if buffered >= 64 * 1024:
+                    smtp.send(b"".join(buffer))
+                    buffer, buffered = [], 0
+            buffer.append(b"." + CRLF)
+            smtp.send(b"".join(buffer))
+            code, resp = smtp.getreply()
+        except (smtplib.SMTPServerDisconnected, OSError) as e:
+            # The server may have accepted the message; sending it again could deliver it twice
+            raise DeliveryUnknownError(
+                f"Connection lost during DATA, the message may have been delivered (not resent): {e}"
+            ) from e
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    def send(self, message_payload, attachments=None, timeout=15, user_id=None, fragment_cache=None, plan=None):
+        """
+        Raises:
+            smtplib.SMTPRecipientsRefused: If a To recipient is refused; nothing is sent
+            PartialDeliveryError: If the message went out but CC/BCC recipients were refused
+            DeliveryUnknownError: If the connection dropped during DATA; the message is not resent
+        """
+        primary = _addresses(message_payload, "toRecipients")
+        copies = _addresses(message_payload, "ccRecipients") + _addresses(message_payload, "bccRecipients")
+        timeout = timeout or self.timeout
+        with self._slots:
+            for attempt in (1, 2):
+                conn = self._checkout(timeout)
+                lines = iter_mime_message(self.from_addr, message_payload, attachments)
+                try:
+                    refused = self._transmit(conn.smtp, self.from_addr, primary, copies, lines)
+                except smtplib.SMTPServerDisconnected:
+                    # The server dropped an idle session before DATA; retry once on a fresh one
+                    self._discard(conn, quit=False)
+                    if attempt == 2:
+                        raise
+                    continue
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused):
+                    conn.messages += 1
+                    self._checkin(conn)
+                    raise
+                except Exception:
+                    # Mid-DATA failures leave the session in an unknown state
+                    self._discard(conn, quit=False)
+                    raise
+                conn.messages += 1
+                self._checkin(conn)
+                with self._lock:
+                    self.messages_sent += 1
+                if refused:
+                    raise PartialDeliveryError(
+                        f"Delivered, but the server refused {', '.join(refused)}", refused
+                    )
+                return True
+
+    def close(self) -> None:
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "connections_opened": self.connections_opened,
+                "open_connections": self._open,
+                "messages_sent": self.messages_sent,
+            }
+
+
+# -------------------- file sink --------------------
+
+class FileSinkTransport(MailTransport):
+    """Writes every message as an .eml file instead of sending it."""
+
+    name = FILE
+
+    def __init__(self, directory: Path, from_addr: str = "mail-automation@localhost"):
+        self.directory = Path(directory)
+        self.from_addr = from_addr
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_settings(cls) -> "FileSinkTransport":
+        directory = getattr(settings, "MAIL_FILE_SINK_PATH", Path(settings.DATA_STORAGE_PATH) / "outbox")
+        return cls(directory, getattr(settings, "SMTP_FROM", "") or "mail-automation@localhost")
+
+    def send(self, message_payload, attachments=None, timeout=15, user_id=None, fragment_cache=None, plan=None):
+        name = f"{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:12]}.eml"
+        target = self.directory / name
+        tmp = target.with_suffix(".eml.tmp")
+        with open(tmp, "wb") as f:
+            for line in iter_mime_message(self.from_addr, message_payload, attachments):
+                f.write(line)
+        os.replace(tmp, target)
+        logger.debug(f"Wrote message to {target}")
+        return True
+
+
+# -------------------- registry --------------------
+
+_transports: Dict[str, MailTransport] = {}
+_registry_lock = threading.Lock()
+
+
+def get_transport(name: Optional[str] = None) -> MailTransport:
+    """
+    The shared transport for name (default: the MAIL_TRANSPORT setting).
+
+    Transports are created once per process so SMTP connections stay pooled
+    across campaigns.
+
+    Raises:
+        ValueError: If name is not a known transport
+    """
+    name = (name or getattr(settings, "MAIL_TRANSPORT", GRAPH)).lower()
+    with _registry_lock:
+        transport = _transports.get(name)
+        if transport is None:
+            if name == GRAPH:
+                transport = GraphTransport()
+            elif name == SMTP:
+                transport = SMTPTransport.from_settings()
+            elif name == FILE:
+                transport = FileSinkTransport.from_settings()
+            else:
+                raise ValueError(f"Unknown mail transport: {name}")
+            _transports[name] = transport
+        return transport
+
+
+def close_transports() -> None:
+    """Close and forget every shared transport."""
+    with _registry_lock:
+        for transport in _transports.values():
+            transport.close()
+        _transports.clear()
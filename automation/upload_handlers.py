@@ -0,0 +1,166 @@
+"""
+Upload handlers for the mail automation form.
+"""
+import hashlib
+import logging
+import mimetypes
+import shutil
+import tempfile
+import zipfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+
+from .exceptions import ArchiveLimitError
+from .services.extractors import ExtractionBudget, detect_extractor
+
+logger = logging.getLogger(__name__)
+
+
+class CampaignStoredFile(UploadedFile):
+    """
+    An uploaded attachment that already lives in the campaign store.
+
+    Besides the usual UploadedFile API it exposes the campaign directory,
+    the SHA-256 of the content and the ready-made attachment catalogue.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        name: str,
+        content_type: str,
+        size: int,
+        charset: Optional[str],
+        sha256: str,
+        store_dir: Path,
+        catalogue: Optional[List[Dict[str, Any]]],
+        catalogue_error: str = ""
+    ):
+        super().__init__(open(path, "rb"), name, content_type, size, charset)
+        self.path = str(path)
+        self.sha256 = sha256
+        self.store_dir = str(store_dir)
+        self.catalogue = catalogue
+        self.catalogue_error = catalogue_error
+
+    def temporary_file_path(self) -> str:
+        """Return the on-disk path of the stored upload."""
+        return self.path
+
+
+class CampaignAttachmentUploadHandler(FileUploadHandler):
+    """
+    Write mail attachments straight into a campaign store while the request streams in.
+
+    The content is hashed on the fly and catalogued as soon as the last chunk
+    lands: loose files become a single entry, ZIPs are catalogued from their
+    central directory (see ZipExtractor.catalogue). Other archive types are
+    stored without a catalogue and handled by the regular extraction path.
+    All attachments of one request share a campaign directory.
+    Fields other than the attachment field are passed on to the next handler.
+    """
+
+    field_names = ("attachment",)
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.activated = False
+        self.handling = False
+        self.store_dir: Optional[Path] = None
+        self.target: Optional[Path] = None
+        self.destination = None
+        self.hasher = None
+        self.budget: Optional[ExtractionBudget] = None
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        path = getattr(self.request, "path", "") or ""
+        self.activated = (
+            getattr(settings, "STREAMING_ATTACHMENT_UPLOADS", False)
+            and path.startswith("/mail")
+        )
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        self.handling = self.activated and field_name in self.field_names
+        if not self.handling:
+            return
+
+        if self.store_dir is None:
+            base_dir = Path(getattr(settings, "FILE_UPLOAD_TEMP_DIR", tempfile.gettempdir()))
+            base_dir.mkdir(parents=True, exist_ok=True)
+            self.store_dir = Path(tempfile.mkdtemp(prefix="invoices_", dir=base_dir))
+            self.budget = ExtractionBudget.from_settings()
+        # avoid path traversal
+        self.target = self.store_dir / Path(file_name).name
+        self.destination = open(self.target, "wb")
+        self.hasher = hashlib.sha256()
+        logger.debug(f"Streaming upload {file_name} into campaign store: {self.store_dir}")
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.handling:
+            return raw_data
+        self.destination.write(raw_data)
+        self.hasher.update(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if not self.handling:
+            return None
+        self.handling = False
+        self.destination.close()
+
+        catalogue_error = ""
+        try:
+            catalogue = self._build_catalogue(file_size)
+        except zipfile.BadZipFile as e:
+            logger.error(f"Invalid ZIP file {self.file_name}: {e}")
+            catalogue = None
+        except ArchiveLimitError as e:
+            # Raising here would surface as a generic upload failure; let the view report it
+            logger.warning(f"Upload {self.file_name} rejected: {e}")
+            catalogue = None
+            catalogue_error = str(e)
+
+        logger.debug(
+            f"Stored upload {self.file_name} ({file_size} bytes, sha256={self.hasher.hexdigest()[:12]}), "
+            f"{len(catalogue) if catalogue is not None else 'no'} catalogue entries"
+        )
+        return CampaignStoredFile(
+            path=self.target,
+            name=self.target.name,
+            content_type=self.content_type,
+            size=file_size,
+            charset=self.charset,
+            sha256=self.hasher.hexdigest(),
+            store_dir=self.store_dir,
+            catalogue=catalogue,
+            catalogue_error=catalogue_error,
+        )
+
+    def upload_interrupted(self):
+        if self.destination is not None and not self.destination.closed:
+            self.destination.close()
+        if self.store_dir is not None:
+            shutil.rmtree(self.store_dir, ignore_errors=True)
+            logger.debug(f"Upload interrupted, removed campaign store: {self.store_dir}")
+
+    def _build_catalogue(self, file_size: int) -> Optional[List[Dict[str, Any]]]:
+        """Catalogue the stored upload, or None when it needs regular extraction."""
+        extractor = detect_extractor(self.target)
+        if extractor is not None:
+            if not extractor.supports_catalogue:
+                return None
+            return extractor.catalogue(self.target, self.budget)
+
+        ctype, _ = mimetypes.guess_type(str(self.target))
+        return [{
+            "name": self.target.name,
+            "path": str(self.target),
+            "size": file_size,
+            "content_type": ctype or self.content_type or "application/octet-stream"
+        }]
@@ -11,6 +11,9 @@ urlpatterns = [
     path("mail/", views.mail_automation, name="mail_automation"),
     path("mail/signin/start/", views.mail_signin_start, name="mail_signin_start"),
     path("mail/signin/poll/", views.mail_signin_poll, name="mail_signin_poll"),
+    path("mail/attachments/manifest/", views.mail_attachment_manifest, name="mail_attachment_manifest"),
+    path("mail/attachments/blob/<str:sha256>/", views.mail_attachment_blob, name="mail_attachment_blob"),
+    path("mail/attachments/commit/", views.mail_attachment_commit, name="mail_attachment_commit"),
     path("templates/", views.template_manager, name="template_manager"),
     path("templates/download/", views.template_download, name="download_templates"),
     path("templates/delete/<str:name>/", views.delete_template, name="delete_template"),
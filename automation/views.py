@@ -10,11 +10,20 @@ import logging
 import pandas as pd
 from io import BytesIO
 from pathlib import Path
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, Iterable, Iterator, List, Optional
 
 from .forms import SignupForm, MailAutomationForm, TemplateEditForm
-from .exceptions import MailSendError, TemplateNotFoundError, FileProcessingError, ReportGenerationError
-from .services.mailer import send_single_mail, encode_attachment
+from .exceptions import MailSendError, PartialDeliveryError, TemplateNotFoundError, FileProcessingError, ReportGenerationError, ArchiveLimitError
+from .services.mailer import send_single_mail, encode_attachment, build_message_payload
+from .services.payload_planner import (
+    PayloadLimits,
+    as_source,
+    message_fingerprint,
+    plan_message,
+    send_order_by_company,
+    summarize_plans,
+)
+from .services.pipeline import KeyedOnce, Pipeline, Stage
 from .services.templates import template_service, TemplateService
 from .services.reporting import reporting_service
 from .services.file_processor import file_processor
@@ -23,68 +32,167 @@ from .services.graph_client import (
     send_mail_with_attachments,
     NeedsLoginError
 )
-from .services.template_render import render_subject_body
-from .services.attach_matcher import build_graph_file_attachment_from_path
+from .services.template_render import compile_subject_body, render_subject_body, template_fields
+from .services.attach_matcher import build_graph_file_attachment_from_path, build_graph_file_attachment
+from .services.attachment_library import AttachmentLibrary
+from .services.datasets import DatasetStore
+from .services.recipient_reader import fill_empty_cells, open_recipient_reader, read_recipients, reader_options
+from .services.recipient_validation import ValidationResult, validate_recipients
+from .services.drive_links import DriveLinkPublisher, append_links_html
+from .services.graph_payload import AttachmentSource, AttachmentFragmentCache
+from .services.graph_http import format_http_stats, get_http_client
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
+# Recipient columns the send flow reads besides template placeholders
+RECIPIENT_BASE_COLUMNS = ("email", "e-mail", "mail", "cc", "companyname")
+
+
+def _parse_excel(content: bytes, name: str = "") -> pd.DataFrame:
+    """
+    Parse an uploaded recipient list (.xlsx, .csv or .parquet, within the
+    row/cell budget) with normalized column names.
+    """
+    return read_recipients(BytesIO(content), name, batch_size=getattr(settings, "RECIPIENT_BATCH_ROWS", 5000))
+
+
+def _find_email_column(columns) -> str:
+    """The first of email / e-mail / mail among normalized column names."""
+    for col in ["email", "e-mail", "mail"]:
+        if col in columns:
+            return col
+    raise ValueError("Excel file must contain an 'email' column")
+
+
+def _recipient_columns(columns, fields) -> List[str]:
+    """Columns a campaign needs: template placeholders plus address and company columns, in file order."""
+    wanted = set(fields) | set(RECIPIENT_BASE_COLUMNS)
+    return [c for c in columns if c in wanted]
+
+
+def _stream_excel_file(request: HttpRequest, fields=None):
+    """
+    Open the uploaded recipient list for a one-shot send: rows are read in
+    batches while earlier batches are already being sent.
 
-def _process_excel_file(request: HttpRequest) -> tuple[pd.DataFrame, str]:
-    """Process Excel file from form or session."""
+    Args:
+        request: Request carrying the excel_file upload
+        fields: Template placeholders; if given, only the columns the campaign
+            needs are read, with "" for empty cells
+
+    Returns:
+        Tuple of (batch reader, email column)
+    """
+    uploaded = request.FILES["excel_file"]
+    logger.debug(f"Streaming recipient file {uploaded.name}, Size: {uploaded.size}")
+    reader = open_recipient_reader(
+        uploaded, uploaded.name, batch_size=getattr(settings, "RECIPIENT_BATCH_ROWS", 5000)
+    )
+    try:
+        email_column = _find_email_column(reader.columns)
+    except ValueError:
+        reader.close()
+        raise
+    if fields is not None:
+        reader.select(_recipient_columns(reader.columns, fields))
+    return reader, email_column
+
+
+def _process_excel_file(request: HttpRequest, fields=None) -> tuple[pd.DataFrame, str]:
+    """
+    Process Excel file from form or session.
+
+    The workbook is parsed once and cached server-side under the hash of its
+    content and reader options; the session only holds the dataset ID. With
+    template fields, only the columns the campaign needs are returned, with
+    "" for empty cells.
+    """
+    store = DatasetStore(request.user.id)
     uploaded = request.FILES.get("excel_file")
+    dataset_id = request.session.get("mail_dataset_id")
     if uploaded:
         logger.debug(f"Excel file name: {uploaded.name}, Size: {uploaded.size}")
         content = uploaded.read()
-        request.session["mail_excel_b64"] = base64.b64encode(content).decode("ascii")
-        df = pd.read_excel(BytesIO(content))
+        dataset_id, df = store.put(
+            content,
+            lambda content: _parse_excel(content, uploaded.name),
+            uploaded.name,
+            options=reader_options(uploaded.name, content[:8]),
+        )
+        request.session["mail_dataset_id"] = dataset_id
         logger.debug(f"Excel loaded successfully, {len(df)} rows")
+    elif dataset_id and store.exists(dataset_id):
+        logger.debug("Using cached dataset from session")
+        columns = None
+        if fields is not None:
+            columns = _recipient_columns(store.meta(dataset_id)["columns"], fields)
+        df = store.load(dataset_id, columns=columns)
+        logger.debug(f"Dataset {dataset_id[:12]} loaded, {len(df)} rows")
     elif request.session.get("mail_excel_b64"):
-        logger.debug("Using Excel from session")
+        # Sessions from before the dataset cache still carry the workbook
+        logger.debug("Migrating Excel from session to the dataset cache")
         content = base64.b64decode(request.session["mail_excel_b64"])
-        df = pd.read_excel(BytesIO(content))
-        logger.debug(f"Excel loaded from session, {len(df)} rows")
+        dataset_id, df = store.put(content, _parse_excel, options=reader_options("", content[:8]))
+        request.session["mail_dataset_id"] = dataset_id
     else:
         raise ValueError("Please upload an Excel file.")
+    request.session.pop("mail_excel_b64", None)
     
     # Normalize column names
-    df.columns = df.columns.str.strip().str.lower()
+    df.columns = df.columns.astype(str).str.strip().str.lower()
     
     # Find email column
-    email_column = None
-    for col in ["email", "e-mail", "mail"]:
-        if col in df.columns:
-            email_column = col
-            break
+    email_column = _find_email_column(df.columns)
     
-    if not email_column:
-        raise ValueError("Excel file must contain an 'email' column")
+    if fields is not None:
+        columns = _recipient_columns(df.columns, fields)
+        logger.debug(f"Using {len(columns)} of {len(df.columns)} columns: {', '.join(columns)}")
+        df = fill_empty_cells(df[columns])
     
     return df, email_column
 
 
 def _process_attachments(request: HttpRequest) -> List[Dict[str, Any]]:
     """Process attachment files."""
-    attachment_file = request.FILES.get('attachment')
+    attachment_files = request.FILES.getlist('attachment')
     uploaded_files = []
     
-    if attachment_file:
-        logger.debug(f"Processing attachment: {attachment_file.name}, Size: {attachment_file.size}")
+    if attachment_files:
+        for attachment_file in attachment_files:
+            logger.debug(f"Processing attachment: {attachment_file.name}, Size: {attachment_file.size}")
+            if getattr(attachment_file, "catalogue_error", ""):
+                file_processor.cleanup_temp_files(attachment_file.store_dir)
+                raise ArchiveLimitError(attachment_file.catalogue_error)
         
-        if attachment_file.name.lower().endswith(('.zip', '.rar')):
-            # ZIP or RAR file - extract and collect files
-            from django.conf import settings
-            import tempfile as tf
+        # Streamed uploads of one request share a campaign store
+        streamed_store_dir = getattr(attachment_files[0], "store_dir", None)
+        
+        if all(getattr(f, "catalogue", None) is not None for f in attachment_files):
+            # Already stored and catalogued by CampaignAttachmentUploadHandler
+            for attachment_file in attachment_files:
+                uploaded_files.extend(attachment_file.catalogue)
+            logger.debug(f"Using streamed upload catalogue: {len(uploaded_files)} files")
             
-            base_temp_dir = Path(getattr(settings, 'FILE_UPLOAD_TEMP_DIR', tf.gettempdir()))
-            uploaded_files, temp_files_dir = file_processor.process_uploaded_files([attachment_file])
-            file_type = "ZIP" if attachment_file.name.lower().endswith('.zip') else "RAR"
-            logger.debug(f"Extracted {file_type}: {len(uploaded_files)} files")
+            uploaded_files = _store_in_library(request, uploaded_files, streamed_store_dir)
+        elif (
+            len(attachment_files) > 1
+            or file_processor.is_archive(attachment_files[0])
+            or getattr(settings, "STREAMING_GRAPH_PAYLOADS", True)
+        ):
+            # Archives (ZIP, RAR, TAR, 7Z...) and multiple files - extract and collect files.
+            # A single file is kept on disk too when sends stream attachments from disk.
+            uploaded_files, temp_files_dir = file_processor.process_uploaded_files(attachment_files)
+            logger.debug(f"Collected {len(uploaded_files)} files from {len(attachment_files)} uploads")
             
-            request.session["uploaded_files"] = uploaded_files
-            request.session["temp_files_dir"] = temp_files_dir
+            # A streamed upload that still needed extraction leaves its own store behind
+            if streamed_store_dir:
+                file_processor.cleanup_temp_files(streamed_store_dir)
+            
+            uploaded_files = _store_in_library(request, uploaded_files, temp_files_dir)
         else:
             # Single file
+            attachment_file = attachment_files[0]
             attachment_data = encode_attachment(attachment_file)
             uploaded_files = [{
                 "name": attachment_file.name,
@@ -100,6 +208,40 @@ def _process_attachments(request: HttpRequest) -> List[Dict[str, Any]]:
     return uploaded_files
 
 
+def _store_in_library(request: HttpRequest, uploaded_files: List[Dict[str, Any]], temp_files_dir: str) -> List[Dict[str, Any]]:
+    """
+    Keep the collected files for this campaign.
+
+    With ATTACHMENT_LIBRARY_ENABLED the files move into the user's persistent
+    library (deduplicated by SHA-256) and the campaign references them by blob ID;
+    otherwise they stay in the request temp directory until the session is cleaned up.
+    """
+    if not getattr(settings, "ATTACHMENT_LIBRARY_ENABLED", False):
+        request.session["uploaded_files"] = uploaded_files
+        request.session["temp_files_dir"] = temp_files_dir
+        return uploaded_files
+
+    library = AttachmentLibrary(request.user.id)
+    try:
+        library_files, stored_count = library.import_catalogue(uploaded_files)
+    finally:
+        file_processor.cleanup_temp_files(temp_files_dir)
+
+    previous_campaign = request.session.get("attachment_campaign_id")
+    if previous_campaign:
+        library.release(previous_campaign)
+    campaign_id = library.reference(f["blob_id"] for f in library_files)
+    logger.info(
+        f"Campaign {campaign_id} uses {len(library_files)} library files "
+        f"({stored_count} new, {len(library_files) - stored_count} already stored)"
+    )
+
+    request.session["uploaded_files"] = library_files
+    request.session["attachment_campaign_id"] = campaign_id
+    request.session.pop("temp_files_dir", None)
+    return library_files
+
+
 def _get_matching_attachments(company_name: str, uploaded_files: List[Dict[str, Any]], df: pd.DataFrame) -> str:
     """Get matching attachments for a company."""
     if not uploaded_files:
@@ -169,6 +311,141 @@ def _perform_dry_run(
     return logs, attachment_summary
 
 
+def _row_cc_emails(row: pd.Series, df: pd.DataFrame) -> List[str]:
+    """CC addresses of a row; several may be separated by semicolon or comma."""
+    if 'cc' not in df.columns:
+        return []
+    cc_value = row.get('cc', '')
+    if pd.isna(cc_value) or not str(cc_value).strip():
+        return []
+    return [cc.strip() for cc in str(cc_value).replace(';', ',').split(',') if cc.strip()]
+
+
+def _row_attachment_files(
+    row: pd.Series,
+    df: pd.DataFrame,
+    company_column: str,
+    uploaded_files: List[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    """Uploaded files that go with a row: all of them without a company column, else name matches."""
+    if not uploaded_files:
+        return []
+    if company_column not in df.columns:
+        return list(uploaded_files)
+    company_name = row.get(company_column, "")
+    if pd.isna(company_name) or not str(company_name).strip():
+        return []
+    company_lower = str(company_name).strip().lower()
+    return [f for f in uploaded_files if company_lower in f["name"].lower()]
+
+
+def _plan_campaign(
+    df: pd.DataFrame,
+    email_column: str,
+    company_column: str,
+    subject: str,
+    template_body: str,
+    uploaded_files: List[Dict[str, Any]],
+    engine: str = "format"
+) -> Dict[str, int]:
+    """Plan every row's send strategy from file sizes; returns strategy counts and wire bytes."""
+    limits = PayloadLimits.from_settings()
+    renderer = compile_subject_body(subject, template_body, df.columns, engine)
+    rendered = renderer.render_frame(df)
+    columns = list(df.columns)
+    # Attachment sets per normalized company name, as the send pipeline groups them
+    group_attachments: Dict[str, List[Any]] = {}
+    plans = []
+    for position, values in enumerate(df.itertuples(index=False, name=None)):
+        try:
+            row = dict(zip(columns, values))
+            sub, body = rendered[position] if rendered is not None else renderer.render(values)
+            company_name = row.get(company_column, "")
+            needle = str(company_name).strip().lower() if pd.notna(company_name) else ""
+            attachments = group_attachments.get(needle)
+            if attachments is None:
+                attachments = group_attachments[needle] = [
+                    f["graph_data"] if "graph_data" in f else _graph_attachment(f)
+                    for f in _row_attachment_files(row, df, company_column, uploaded_files)
+                ]
+            payload = build_message_payload(str(row[email_column]), sub, body, None, _row_cc_emails(row, df))
+            plans.append(plan_message(payload, attachments, limits))
+        except Exception as e:
+            logger.warning(f"Could not plan payload for row: {e}")
+    return summarize_plans(plans)
+
+
+def _graph_attachment(file_info: Dict[str, Any]):
+    """Attachment for send_single_mail: streamed from disk, or a pre-encoded Graph dict."""
+    if getattr(settings, "STREAMING_GRAPH_PAYLOADS", True):
+        return AttachmentSource.from_file_info(file_info)
+    return build_graph_file_attachment(file_info)
+
+
+def _recipient_validator(email_column: str, subject: str, template_body: str, engine: str = "format"):
+    """
+    validate_recipients for each batch of a campaign, or None when
+    MAIL_VALIDATE_RECIPIENTS is off.
+
+    Placeholder columns are only checked for {placeholder} templates; Jinja
+    templates may test for a value with "is defined".
+    """
+    if not getattr(settings, "MAIL_VALIDATE_RECIPIENTS", True):
+        return None
+    fields = template_fields(subject, template_body) if engine == "format" else None
+    return lambda frame: validate_recipients(frame, email_column, fields)
+
+
+def _iter_send_rows(
+    df: pd.DataFrame,
+    company_column: str,
+    row_batches: Optional[Iterable[pd.DataFrame]] = None,
+    renderer=None,
+    validator=None,
+    skipped: Optional[List[Dict[str, Any]]] = None
+) -> Iterator[Dict[str, Any]]:
+    """
+    Pipeline input: each row (as a Series and as a value tuple) with its
+    position in the recipient list, in send order.
+
+    With a renderer whose templates are plain placeholders, each batch's
+    subjects and bodies are rendered column-wise up front. With a validator,
+    rows it marks invalid are not yielded but appended to skipped with their
+    position and reason.
+    """
+    group_by_company = getattr(settings, "MAIL_GROUP_BY_COMPANY", True)
+    offset = 0
+    for frame in (row_batches if row_batches is not None else [df]):
+        batch_offset, batch_len = offset, len(frame)
+        offset += batch_len
+        positions = None
+        if validator is not None:
+            validation: ValidationResult = validator(frame)
+            if validation.invalid.any():
+                for position in validation.invalid.nonzero()[0]:
+                    skipped.append({
+                        "row": frame.iloc[position],
+                        "position": batch_offset + int(position),
+                        "reason": validation.reasons.iat[position],
+                    })
+                # Only valid rows are rendered and sent; keep their batch positions
+                positions = (~validation.invalid).nonzero()[0]
+                frame = frame.iloc[positions]
+        if group_by_company:
+            # Send each company's recipients back to back (within a batch when streaming)
+            send_order = send_order_by_company(frame, company_column)
+        else:
+            send_order = range(len(frame))
+        values = list(frame.itertuples(index=False, name=None))
+        rendered = renderer.render_frame(frame) if renderer is not None else None
+        for position in send_order:
+            batch_position = int(positions[position]) if positions is not None else position
+            item = {"row": frame.iloc[position], "values": values[position], "position": batch_offset + batch_position}
+            if rendered is not None:
+                item["rendered"] = rendered[position]
+            yield item
+
+
 def _send_emails(
     df: pd.DataFrame,
     email_column: str,
@@ -176,125 +453,305 @@ def _send_emails(
     subject: str,
     template_body: str,
     uploaded_files: List[Dict[str, Any]],
-    request: HttpRequest
+    request: HttpRequest,
+    bcc_fanout: bool = False,
+    link_attachments: bool = False,
+    row_batches: Optional[Iterable[pd.DataFrame]] = None,
+    engine: str = "format"
 ) -> tuple[List[str], List[Dict[str, Any]]]:
-    """Send emails and return logs and results."""
+    """
+    Send emails and return logs and results.
+
+    Rows flow through a staged pipeline (render -> match -> encode -> send -> record)
+    with bounded queues between stages, so encoding the next rows overlaps
+    with sending the current one. Rows of the same company are sent back to
+    back and share one attachment set. Results keep the Excel row order.
+
+    With bcc_fanout, rows whose rendered subject, body, CC and attachment set
+    are identical are sent as one message (up to MAIL_BCC_MAX_RECIPIENTS in
+    BCC); every recipient still gets its own report row.
+
+    With link_attachments, each distinct attachment is uploaded once to the
+    sender's OneDrive and messages carry sharing links instead of file content.
+
+    With row_batches, rows are taken from the batches as they are read (df
+    then only supplies the columns), so sending starts before the whole
+    recipient list is parsed.
+
+    Unless MAIL_VALIDATE_RECIPIENTS is off, rows with a missing or malformed
+    address or CC, or without a column for a template placeholder, are not
+    sent; they are reported as SKIPPED with the reason.
+    """
     import random
+    import threading
     import time
     
     logs = []
     results = []
+    # Attachments shared by many recipients are serialized once per campaign
+    fragment_cache = AttachmentFragmentCache(getattr(settings, "GRAPH_FRAGMENT_CACHE_MB", 64) * 1024 * 1024)
+    http_snapshot = get_http_client().snapshot() if getattr(settings, "MAIL_TRANSPORT", "graph") == "graph" else None
+    payload_limits = PayloadLimits.from_settings()
+    user_id = request.user.id
+    send_state = threading.local()
+    # Attachment sets per normalized company name
+    # (built once per key, also when several workers reach a company at once)
+    group_files = KeyedOnce()
+    group_attachments = KeyedOnce()
+    group_rows: Dict[str, int] = {}
+    group_rows_lock = threading.Lock()
+    publisher = None
+    if link_attachments:
+        publisher = DriveLinkPublisher(
+            lambda: acquire_token_silent_or_fail(user_id),
+            folder=getattr(settings, "ONEDRIVE_ATTACHMENT_FOLDER", None),
+            scope=getattr(settings, "ONEDRIVE_LINK_SCOPE", "organization")
+        )
     
-    for index, (_, row) in enumerate(df.iterrows()):
-        try:
-            to_addr = str(row[email_column])
-            sub, body = render_subject_body(subject, template_body, row.to_dict())
-            
-            # Get CC emails if present
-            cc_emails = []
-            if 'cc' in df.columns:
-                cc_value = row.get('cc', '')
-                if pd.notna(cc_value) and str(cc_value).strip():
-                    # Support multiple CC emails separated by semicolon or comma
-                    cc_list = str(cc_value).replace(';', ',').split(',')
-                    cc_emails = [cc.strip() for cc in cc_list if cc.strip()]
-            
-            # Company name matching for attachments
-            company_name = row.get(company_column, "") if company_column in df.columns else ""
-            attachments = []
-            
-            if uploaded_files:
-                logger.debug(f"Processing {len(uploaded_files)} uploaded files for company: {company_name}")
-                if company_column not in df.columns:
-                    # Attach all files
-                    logger.debug("No company column - attaching all files")
-                    for file_info in uploaded_files:
-                        logger.debug(f"Processing file: {file_info['name']}")
-                        if "graph_data" in file_info:
-                            attachments.append(file_info["graph_data"])
-                            logger.debug(f"Added pre-encoded file: {file_info['name']}")
-                        else:
-                            attachment_data = build_graph_file_attachment_from_path(file_info["path"], file_info["content_type"])
-                            attachments.append(attachment_data)
-                            logger.debug(f"Encoded and added file: {file_info['name']}")
-                elif pd.notna(company_name) and str(company_name).strip():
-                    company_lower = str(company_name).strip().lower()
-                    logger.debug(f"Matching files for company: {company_lower}")
-                    for file_info in uploaded_files:
-                        filename_lower = file_info["name"].lower()
-                        logger.debug(f"Checking file: {file_info['name']} (lower: {filename_lower})")
-                        if company_lower in filename_lower:
-                            logger.debug(f"Match found: {file_info['name']} contains {company_lower}")
-                            if "graph_data" in file_info:
-                                attachments.append(file_info["graph_data"])
-                                logger.debug(f"Added pre-encoded file: {file_info['name']}")
-                            else:
-                                attachment_data = build_graph_file_attachment_from_path(file_info["path"], file_info["content_type"])
-                                attachments.append(attachment_data)
-                                logger.debug(f"Encoded and added file: {file_info['name']}")
-                        else:
-                            logger.debug(f"No match: {file_info['name']} does not contain {company_lower}")
-                
-                logger.debug(f"Total attachments prepared: {len(attachments)}")
+    # Templates are parsed once for the campaign's columns; rows with the same
+    # referenced values share one render
+    renderer = compile_subject_body(
+        subject, template_body, df.columns, engine,
+        memoize=True, max_entries=getattr(settings, "TEMPLATE_RENDER_CACHE_ENTRIES", 50000)
+    )
+    
+    def render(item):
+        row = item.data["row"]
+        item.data["to_addr"] = str(row[email_column])
+        rendered = item.data.get("rendered")
+        item.data["subject"], item.data["body"] = rendered or renderer.render(item.data["values"])
+        item.data["cc_emails"] = _row_cc_emails(row, df)
+    
+    def match(item):
+        row = item.data["row"]
+        company_name = row.get(company_column, "") if company_column in df.columns else ""
+        # Cache on the exact matching needle so grouping never changes what matches
+        needle = str(company_name).strip().lower() if pd.notna(company_name) else ""
 
-            # Track result
-            attachment_filenames = []
-            if uploaded_files:
-                if company_column not in df.columns:
-                    attachment_filenames = [f["name"] for f in uploaded_files]
-                elif pd.notna(company_name) and str(company_name).strip():
-                    company_lower = str(company_name).strip().lower()
-                    for file_info in uploaded_files:
-                        filename_lower = file_info["name"].lower()
-                        if company_lower in filename_lower:
-                            attachment_filenames.append(file_info["name"])
-            
-            result_row = {
-                "email": to_addr,
-                "company_name": str(company_name) if company_name else "",
-                "matched_files": "; ".join(attachment_filenames),
-                "sent_with_attachments": len(attachments) > 0,
-                "status": "OK",
-                "error_detail": ""
-            }
+        def match_files():
+            matched = _row_attachment_files(row, df, company_column, uploaded_files)
+            logger.debug(f"Matched {len(matched)} of {len(uploaded_files)} files for company: {company_name}")
+            return matched
 
-            try:
-                # Send email using service with user context
-                send_single_mail(to_addr, sub, body, attachments, cc_emails=cc_emails, timeout=15, user_id=request.user.id)
-                
-                if attachments:
-                    attachment_info = f" (with {len(attachments)} attachments: {'; '.join(attachment_filenames)})"
-                else:
-                    attachment_info = " (no attachment)"
-                
-                cc_info = f" CC: {', '.join(cc_emails)}" if cc_emails else ""
-                logs.append(f"Sent to {to_addr}{attachment_info}{cc_info}")
-                
-            except Exception as e:
-                result_row["status"] = "ERROR"
-                result_row["error_detail"] = str(e)
-                logs.append(f"ERROR sending to {to_addr}: {e}")
-            
-            results.append(result_row)
-            
-            # Add random delay between emails to avoid spam detection (except for the last email)
-            if index < len(df) - 1:  # Don't delay after the last email
-                delay = random.uniform(0.5, 1.0)  # Random delay between 0.5-1 seconds
-                logs.append(f"Waiting {delay:.1f}s before next email...")
-                time.sleep(delay)
-            
+        matched_files = group_files.get(needle, match_files)
+        item.data["company_name"] = company_name
+        item.data["attachment_key"] = needle
+        item.data["matched_files"] = matched_files
+    
+    def encode(item):
+        if publisher is not None:
+            # Files go up once per campaign; every message only carries links
+            sources = [
+                as_source(f["graph_data"]) if "graph_data" in f else AttachmentSource.from_file_info(f)
+                for f in item.data["matched_files"]
+            ]
+            item.data["links"] = publisher.links(sources)
+            item.data["body"] = append_links_html(item.data["body"], item.data["links"])
+            item.data["attachments"] = []
+            item.data["plan"] = None
+            return
+        # A company's attachment set is built once and shared by its rows
+        key = item.data["attachment_key"]
+        attachments = group_attachments.get(key, lambda: [
+            f["graph_data"] if "graph_data" in f else _graph_attachment(f)
+            for f in item.data["matched_files"]
+        ])
+        with group_rows_lock:
+            group_rows[key] = group_rows.get(key, 0) + 1
+            shared = group_rows[key] == 2
+        if shared:
+            # The set goes to several rows: warm the campaign cache here, off
+            # the sending thread (single-use files stream from disk instead)
+            for attachment in attachments:
+                if isinstance(attachment, AttachmentSource):
+                    fragment_cache.get(attachment, shared=True)
+        payload = build_message_payload(
+            item.data["to_addr"], item.data["subject"], item.data["body"], None, item.data["cc_emails"]
+        )
+        item.data["attachments"] = attachments
+        item.data["plan"] = plan_message(payload, attachments, payload_limits) if attachments else None
+    
+    def send(item):
+        # Random delay between emails of a sender to avoid spam detection
+        item.data["delay"] = 0.0
+        if getattr(send_state, "sent", False):
+            item.data["delay"] = random.uniform(0.5, 1.0)
+            time.sleep(item.data["delay"])
+        send_state.sent = True
+        try:
+            # Send email using service with user context
+            send_single_mail(
+                item.data["to_addr"], item.data["subject"], item.data["body"], item.data["attachments"],
+                cc_emails=item.data["cc_emails"], timeout=15, user_id=user_id,
+                fragment_cache=fragment_cache, plan=item.data["plan"]
+            )
+            item.data["send_error"] = None
         except Exception as e:
+            item.data["send_error"] = e
+    
+    def record(item):
+        data = item.data
+        row = data["row"]
+        if item.error is not None:
             company_name = row.get(company_column, "") if company_column in df.columns else ""
-            result_row = {
+            data["result_row"] = {
                 "email": str(row.get(email_column, "unknown")),
                 "company_name": str(company_name) if company_name else "",
                 "matched_files": "",
                 "sent_with_attachments": False,
                 "status": "ERROR",
-                "error_detail": f"Row processing failed: {str(e)}"
+                "error_detail": f"Row processing failed: {str(item.error)}"
             }
-            results.append(result_row)
-            logs.append(f"ERROR preparing row: {e}")
+            data["log_lines"] = [f"ERROR preparing row: {item.error}"]
+            return
+        
+        log_lines = []
+        if data["delay"]:
+            log_lines.append(f"Waiting {data['delay']:.1f}s before next email...")
+        
+        company_name = data["company_name"]
+        attachment_filenames = [f["name"] for f in data["matched_files"]]
+        attachments = data["attachments"]
+        result_row = {
+            "email": data["to_addr"],
+            "company_name": str(company_name) if company_name else "",
+            "matched_files": "; ".join(attachment_filenames),
+            "sent_with_attachments": len(attachments) > 0 or bool(data.get("links")),
+            "status": "OK",
+            "error_detail": ""
+        }
+        send_error = data["send_error"]
+        if send_error is None or isinstance(send_error, PartialDeliveryError):
+            if send_error is not None:
+                # Delivered to the addressee; some CC/BCC recipients were refused
+                result_row["error_detail"] = str(send_error)
+            if data.get("links"):
+                attachment_info = f" (with {len(data['links'])} linked files: {'; '.join(attachment_filenames)})"
+            elif attachments:
+                attachment_info = f" (with {len(attachments)} attachments: {'; '.join(attachment_filenames)})"
+            else:
+                attachment_info = " (no attachment)"
+            cc_info = f" CC: {', '.join(data['cc_emails'])}" if data["cc_emails"] else ""
+            bcc_info = f" BCC group {data['bcc_group']}" if data.get("bcc_group") else ""
+            log_lines.append(f"Sent to {data['to_addr']}{attachment_info}{cc_info}{bcc_info}")
+            if send_error is not None:
+                log_lines.append(f"WARNING for {data['to_addr']}: {send_error}")
+        else:
+            result_row["status"] = "ERROR"
+            result_row["error_detail"] = str(data["send_error"])
+            log_lines.append(f"ERROR sending to {data['to_addr']}: {data['send_error']}")
+        data["result_row"] = result_row
+        data["log_lines"] = log_lines
+    
+    def send_bcc_groups(items) -> List[str]:
+        """Send each set of identical messages once, recipients in BCC; returns group log lines."""
+        groups: Dict[str, List[Any]] = {}
+        for item in items:
+            if item.error is None:
+                data = item.data
+                key = message_fingerprint(data["subject"], data["body"], data["cc_emails"], data["matched_files"])
+                groups.setdefault(key, []).append(item)
+        
+        max_recipients = getattr(settings, "MAIL_BCC_MAX_RECIPIENTS", 500)
+        group_logs = []
+        for key, members in groups.items():
+            for start in range(0, len(members), max_recipients):
+                chunk = members[start:start + max_recipients]
+                lead = chunk[0].data
+                if group_logs:
+                    delay = random.uniform(0.5, 1.0)
+                    group_logs.append(f"Waiting {delay:.1f}s before next email...")
+                    time.sleep(delay)
+                try:
+                    send_single_mail(
+                        None, lead["subject"], lead["body"], lead["attachments"],
+                        cc_emails=lead["cc_emails"], timeout=15, user_id=user_id,
+                        fragment_cache=fragment_cache, bcc_emails=[m.data["to_addr"] for m in chunk]
+                    )
+                    error = None
+                    group_logs.append(f"Sent one message to {len(chunk)} BCC recipients (group {key[:8]})")
+                except PartialDeliveryError as e:
+                    error = e
+                    group_logs.append(f"Sent one message to {len(chunk)} BCC recipients (group {key[:8]}): {e}")
+                except Exception as e:
+                    error = e
+                    group_logs.append(f"ERROR sending to {len(chunk)} BCC recipients (group {key[:8]}): {e}")
+                for member in chunk:
+                    member_error = error
+                    if isinstance(error, PartialDeliveryError):
+                        refused = error.refused.get(member.data["to_addr"])
+                        if refused is not None:
+                            member_error = MailSendError(f"Recipient refused: {refused[0]} {refused[1]!r}")
+                        elif not set(error.refused) & set(lead["cc_emails"]):
+                            # Only other BCC recipients were refused
+                            member_error = None
+                    member.data.update(send_error=member_error, delay=0.0, bcc_group=key[:8])
+        return group_logs
+    
+    workers = getattr(settings, "MAIL_PIPELINE_WORKERS", {})
+    stages = [
+        Stage("render", render, workers.get("render", 1)),
+        Stage("match", match, workers.get("match", 1)),
+        Stage("encode", encode, workers.get("encode", 2)),
+    ]
+    if not bcc_fanout:
+        stages += [
+            # Rows reach the sender in send order however many encode workers finish first
+            Stage("send", send, workers.get("send", 1), ordered=True),
+            Stage("record", record, 1, handles_errors=True),
+        ]
+    pipeline = Pipeline(stages, queue_size=getattr(settings, "MAIL_PIPELINE_QUEUE_SIZE", 8))
+    skipped: List[Dict[str, Any]] = []
+    validator = _recipient_validator(email_column, subject, template_body, engine)
+    items = pipeline.run(_iter_send_rows(df, company_column, row_batches, renderer, validator, skipped))
+    
+    if bcc_fanout:
+        # Identical messages can only be grouped once every row is rendered
+        logs.extend(send_bcc_groups(items))
+        for item in items:
+            record(item)
+    
+    # The log follows the send order; the report keeps the Excel row order
+    for item in items:
+        logs.extend(item.data["log_lines"])
+    report_rows = [(item.data["position"], item.data["result_row"]) for item in items]
+    for entry in skipped:
+        row = entry["row"]
+        email = row.get(email_column, "")
+        company_name = row.get(company_column, "") if company_column in df.columns else ""
+        logs.append(f"SKIPPED {email if pd.notna(email) else ''}: {entry['reason']}")
+        report_rows.append((entry["position"], {
+            "email": str(email) if pd.notna(email) else "",
+            "company_name": str(company_name) if pd.notna(company_name) and company_name else "",
+            "matched_files": "",
+            "sent_with_attachments": False,
+            "status": "SKIPPED",
+            "error_detail": entry["reason"]
+        }))
+    if skipped:
+        logs.append(f"[VALIDATION] {len(skipped)} invalid rows excluded before sending")
+    for _position, result_row in sorted(report_rows, key=lambda entry: entry[0]):
+        results.append(result_row)
+    
+    for line in pipeline.format_stats():
+        logger.info(line)
+    logs.extend(pipeline.format_stats())
+    logger.info(renderer.format_stats())
+    logs.append(renderer.format_stats())
+    if getattr(settings, "MAIL_TRANSPORT", "graph") == "graph":
+        # This campaign's share of the shared Graph HTTP client (HTTP/1.1 pool or HTTP/2)
+        logs.append(format_http_stats(since=http_snapshot))
+    
+    if publisher is not None:
+        drive_stats = publisher.stats()
+        logs.append(
+            f"[ONEDRIVE] {drive_stats['uploads']} files uploaded once ({drive_stats['uploaded_bytes']} bytes), "
+            f"links reused {drive_stats['reused']} times"
+        )
+    
+    cache_stats = fragment_cache.stats()
+    if cache_stats["hits"] or cache_stats["misses"]:
+        logger.info(f"Attachment fragment cache: {cache_stats}")
     
     return logs, results
 
@@ -309,6 +766,15 @@ def _cleanup_session_files(request: HttpRequest) -> None:
         except Exception as e:
             logger.warning(f"Failed to cleanup temp directory {temp_files_dir}: {e}")
     
+    # Library files outlive the campaign: only drop its references
+    campaign_id = request.session.get("attachment_campaign_id")
+    if campaign_id:
+        try:
+            AttachmentLibrary(request.user.id).release(campaign_id)
+        except Exception as e:
+            logger.warning(f"Failed to release library campaign {campaign_id}: {e}")
+        del request.session["attachment_campaign_id"]
+    
     # Clean up session data
     if "uploaded_files" in request.session:
         del request.session["uploaded_files"]
@@ -327,7 +793,10 @@ def mail_automation(request: HttpRequest) -> HttpResponse:
 
 def _mail_automation_impl(request: HttpRequest) -> HttpResponse:
     """Main mail automation logic."""
-    context = {"step": "form"}
+    context = {
+        "step": "form",
+        "attachment_sync": getattr(settings, "ATTACHMENT_LIBRARY_ENABLED", False),
+    }
     
     # Check Microsoft Graph authentication status for current user
     try:
@@ -343,8 +812,9 @@ def _mail_automation_impl(request: HttpRequest) -> HttpResponse:
     # Handle reset flow
     if request.method == "GET" and request.GET.get("reset") == "1":
         try:
-            if request.session.get("mail_excel_b64"):
-                del request.session["mail_excel_b64"]
+            if request.session.get("mail_excel_b64") or request.session.get("mail_dataset_id"):
+                request.session.pop("mail_excel_b64", None)
+                request.session.pop("mail_dataset_id", None)
                 if request.session.get("uploaded_files"):
                     del request.session["uploaded_files"]
                 if request.session.get("temp_files_dir"):
@@ -365,12 +835,8 @@ def _mail_automation_impl(request: HttpRequest) -> HttpResponse:
         form = MailAutomationForm(request.POST, request.FILES, user=request.user)
         if form.is_valid():
             try:
-                # Process Excel file
-                df, email_column = _process_excel_file(request)
+                confirm_send = request.POST.get("confirm_send") == "1"
                 
-                # Process attachments
-                uploaded_files = _process_attachments(request)
-
                 # Get template
                 template_name = form.cleaned_data["template"]
                 user_template_service = TemplateService(user_id=request.user.id)
@@ -378,10 +844,23 @@ def _mail_automation_impl(request: HttpRequest) -> HttpResponse:
                     template_obj = user_template_service.get_template(template_name)
                     subject = template_obj["subject"]
                     template_body = template_obj["body"]
+                    engine = template_obj.get("engine", "format")
                 except TemplateNotFoundError:
                     raise ValueError(f"Template '{template_name}' not found")
+                # Only the columns the template refers to are loaded
+                fields = template_fields(subject, template_body, engine=engine)
                 
-                confirm_send = request.POST.get("confirm_send") == "1"
+                # Process Excel file
+                row_batches = None
+                if confirm_send and request.FILES.get("excel_file"):
+                    # One-shot send of a new upload: rows reach the pipeline while it is read
+                    row_batches, email_column = _stream_excel_file(request, fields)
+                    df = row_batches.header_frame()
+                else:
+                    df, email_column = _process_excel_file(request, fields)
+                
+                # Process attachments
+                uploaded_files = _process_attachments(request)
 
                 # Add attachment preview
                 df_preview = df.head(5).copy()
@@ -411,8 +890,13 @@ def _mail_automation_impl(request: HttpRequest) -> HttpResponse:
                             "attachments": matching_attachments
                         })
                     
+                    validator = _recipient_validator(email_column, subject, template_body, engine)
                     context.update({
                         "preview": preview,
+                        "validation": validator(df).summary() if validator is not None else None,
+                        "payload_plan": _plan_campaign(
+                            df, email_column, company_column, subject, template_body, uploaded_files, engine
+                        ),
                         "total_rows": len(df),
                         "template_name": template_name,
                         "email_preview_list": email_preview_list,
@@ -427,7 +911,11 @@ def _mail_automation_impl(request: HttpRequest) -> HttpResponse:
                     # Actual sending
                     try:
                         logs, results = _send_emails(
-                            df, email_column, company_column, subject, template_body, uploaded_files, request
+                            df, email_column, company_column, subject, template_body, uploaded_files, request,
+                            bcc_fanout=form.cleaned_data.get("bcc_fanout", False),
+                            link_attachments=form.cleaned_data.get("link_attachments", False),
+                            row_batches=row_batches,
+                            engine=engine
                         )
                         
                         # Generate Excel report
@@ -513,7 +1001,8 @@ def _template_manager_impl(request: HttpRequest) -> HttpResponse:
         edit_form = TemplateEditForm(initial={
             'name': edit_template_name,
             'subject': templates[edit_template_name]['subject'],
-            'body': templates[edit_template_name]['body']
+            'body': templates[edit_template_name]['body'],
+            'engine': templates[edit_template_name].get('engine', 'format')
         })
     else:
         edit_form = TemplateEditForm()
@@ -551,7 +1040,9 @@ def _template_manager_impl(request: HttpRequest) -> HttpResponse:
                     subject = form.cleaned_data["subject"]
                     body = form.cleaned_data["body"]
                     logger.info(f"Saving template: {template_name}")
-                    user_template_service.save_template(template_name, subject, body)
+                    user_template_service.save_template(
+                        template_name, subject, body, engine=form.cleaned_data["engine"]
+                    )
                     messages.success(request, f"Template '{template_name}' saved successfully.")
                     return redirect("automation:template_manager")
                 except Exception as e:
@@ -584,7 +1075,8 @@ def template_edit(request: HttpRequest, template_name: str) -> HttpResponse:
                 user_template_service.save_template(
                     template_name,
                     form.cleaned_data["subject"],
-                    form.cleaned_data["body"]
+                    form.cleaned_data["body"],
+                    engine=form.cleaned_data["engine"]
                 )
                 messages.success(request, f"Template '{template_name}' updated successfully.")
                 return redirect("automation:template_manager")
@@ -710,6 +1202,141 @@ def mail_signin_poll(request: HttpRequest) -> HttpResponse:
         logger.error(f"Error polling device code: {e}", exc_info=True)
         return JsonResponse({"status": "error", "detail": str(e)}, status=500)
 
+def _attachment_sync_library(request: HttpRequest):
+    """Return (library, None) for attachment sync requests, or (None, error response)."""
+    from django.http import JsonResponse
+
+    if not request.user.is_authenticated:
+        return None, JsonResponse({"error": "User not authenticated"}, status=401)
+    if request.method != "POST":
+        return None, JsonResponse({"error": "Method not allowed"}, status=405)
+    if not getattr(settings, "ATTACHMENT_LIBRARY_ENABLED", False):
+        return None, JsonResponse({"error": "Attachment library is disabled"}, status=404)
+    return AttachmentLibrary(request.user.id), None
+
+
+def mail_attachment_manifest(request: HttpRequest) -> HttpResponse:
+    """
+    Receive the client's attachment manifest and reply with the blobs we don't have.
+
+    Body: {"files": [{"name": str, "size": int, "sha256": str}, ...]}
+    Response: {"missing": [sha256, ...]}
+    """
+    import json
+    import re
+    from django.http import JsonResponse
+
+    library, error = _attachment_sync_library(request)
+    if error:
+        return error
+
+    try:
+        files = json.loads(request.body or b"{}").get("files", [])
+        manifest = []
+        for item in files:
+            sha256 = str(item["sha256"]).lower()
+            if not re.fullmatch(r"[0-9a-f]{64}", sha256):
+                raise ValueError(f"Invalid SHA-256 for {item.get('name')}")
+            manifest.append({
+                "name": Path(str(item["name"])).name,
+                "size": int(item["size"]),
+                "sha256": sha256,
+            })
+        max_files = getattr(settings, "ARCHIVE_MAX_FILES", 2000)
+        if not manifest or len(manifest) > max_files:
+            raise ValueError(f"Manifest must list between 1 and {max_files} files")
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        return JsonResponse({"error": f"Invalid manifest: {e}"}, status=400)
+
+    missing = library.missing_blobs(item["sha256"] for item in manifest)
+    request.session["attachment_manifest"] = manifest
+    logger.info(f"Attachment manifest for user {request.user.id}: {len(manifest)} files, {len(missing)} missing")
+    return JsonResponse({"missing": missing})
+
+
+def mail_attachment_blob(request: HttpRequest, sha256: str) -> HttpResponse:
+    """Receive the raw content of one blob listed in the session manifest and verify its hash."""
+    from django.http import JsonResponse
+
+    library, error = _attachment_sync_library(request)
+    if error:
+        return error
+
+    item = next((i for i in request.session.get("attachment_manifest", []) if i["sha256"] == sha256), None)
+    if item is None:
+        return JsonResponse({"error": "Blob is not part of the current manifest"}, status=400)
+    if int(request.META.get("CONTENT_LENGTH") or 0) != item["size"]:
+        return JsonResponse({"error": f"Expected {item['size']} bytes for {item['name']}"}, status=400)
+
+    content_type = request.headers.get("X-File-Type") or "application/octet-stream"
+    try:
+        _, stored = library.add_stream(request, item["name"], content_type, expected_sha256=sha256)
+    except ValueError as e:
+        logger.warning(f"Rejected blob upload from user {request.user.id}: {e}")
+        return JsonResponse({"error": str(e)}, status=400)
+    return JsonResponse({"sha256": sha256, "stored": stored})
+
+
+def mail_attachment_commit(request: HttpRequest) -> HttpResponse:
+    """
+    Turn the synced manifest into the campaign's attachments.
+
+    Archives in the manifest are catalogued (ZIPs lazily) and their members
+    imported into the library, so unchanged members are recognised again.
+    """
+    from django.core.files import File
+    from django.http import JsonResponse
+
+    library, error = _attachment_sync_library(request)
+    if error:
+        return error
+
+    manifest = request.session.get("attachment_manifest", [])
+    missing = library.missing_blobs(item["sha256"] for item in manifest)
+    if not manifest or missing:
+        return JsonResponse({"error": "Manifest is incomplete", "missing": missing}, status=409)
+
+    loose_items = []
+    archives = []
+    try:
+        for item in manifest:
+            blob = File(open(library.blob_path(item["sha256"]), "rb"), name=item["name"])
+            if file_processor.is_archive(blob):
+                archives.append(blob)
+            else:
+                blob.close()
+                loose_items.append(item)
+
+        uploaded_files = library.catalogue(
+            [item["sha256"] for item in loose_items],
+            names=[item["name"] for item in loose_items]
+        )
+        if archives:
+            members, temp_files_dir = file_processor.process_uploaded_files(archives, lazy_zip=True)
+            try:
+                library_members, _ = library.import_catalogue(members)
+            finally:
+                file_processor.cleanup_temp_files(temp_files_dir)
+            uploaded_files.extend(library_members)
+    except (FileProcessingError, ValueError) as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    finally:
+        for blob in archives:
+            blob.close()
+
+    previous_campaign = request.session.get("attachment_campaign_id")
+    if previous_campaign:
+        library.release(previous_campaign)
+    campaign_id = library.reference(f["blob_id"] for f in uploaded_files)
+
+    request.session["uploaded_files"] = uploaded_files
+    request.session["attachment_campaign_id"] = campaign_id
+    request.session.pop("temp_files_dir", None)
+    del request.session["attachment_manifest"]
+    logger.info(f"Campaign {campaign_id} committed from manifest: {len(uploaded_files)} files")
+    return JsonResponse({"files": len(uploaded_files)})
+
+
 def delete_template(request: HttpRequest, name: str) -> HttpResponse:
     """Delete a template."""
     try:
@@ -788,12 +1415,9 @@ def _handle_attachment_smoke_test(request: HttpRequest) -> HttpResponse:
         
         # Get test email from session Excel or use default
         test_email = "test@example.com"
-        if request.session.get("mail_excel_b64"):
+        if request.session.get("mail_dataset_id") or request.session.get("mail_excel_b64"):
             try:
-                import pandas as pd
-                from io import BytesIO
-                content = base64.b64decode(request.session["mail_excel_b64"])
-                df = pd.read_excel(BytesIO(content))
+                df, _ = _process_excel_file(request)
                 if len(df) > 0 and 'email' in df.columns:
                     test_email = str(df.iloc[0]['email'])
                     logger.debug(f"Using email from Excel: {test_email}")
@@ -166,6 +166,7 @@ LOGIN_URL = "/login/"
 DATA_UPLOAD_MAX_MEMORY_SIZE = 100 * 1024 * 1024   # 100 MB request cap
 FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024    # >10MB goes to temp file
 FILE_UPLOAD_HANDLERS = [
+    "automation.upload_handlers.CampaignAttachmentUploadHandler",
     "django.core.files.uploadhandler.TemporaryFileUploadHandler",
     "django.core.files.uploadhandler.MemoryFileUploadHandler",
 ]
@@ -179,6 +180,97 @@ except Exception:
     import tempfile
     FILE_UPLOAD_TEMP_DIR = tempfile.gettempdir()
 
+# Catalogue uploaded ZIPs from their central directory and read members on demand
+# instead of extracting every member up front
+LAZY_ZIP_ATTACHMENTS = os.getenv("LAZY_ZIP_ATTACHMENTS", "false").lower() == "true"
+
+# Archive extraction budget: uncompressed total, member count and per-member
+# compression ratio. Exceeding any of them aborts the upload early.
+ARCHIVE_MAX_TOTAL_MB = int(os.getenv("ARCHIVE_MAX_TOTAL_MB", "500"))
+ARCHIVE_MAX_FILES = int(os.getenv("ARCHIVE_MAX_FILES", "2000"))
+ARCHIVE_MAX_RATIO = int(os.getenv("ARCHIVE_MAX_RATIO", "100"))
+# Archives uploaded together are extracted concurrently by this many workers
+ARCHIVE_EXTRACT_WORKERS = int(os.getenv("ARCHIVE_EXTRACT_WORKERS", "4"))
+
+# Write mail attachments straight into the campaign store while the request
+# streams in (see automation.upload_handlers), instead of temp file + copy
+STREAMING_ATTACHMENT_UPLOADS = os.getenv("STREAMING_ATTACHMENT_UPLOADS", "false").lower() == "true"
+
+# Stream sendMail bodies, base64-encoding attachments from disk while sending,
+# instead of building the whole JSON payload in memory
+STREAMING_GRAPH_PAYLOADS = os.getenv("STREAMING_GRAPH_PAYLOADS", "true").lower() == "true"
+# Memory budget for attachment JSON fragments serialized once per campaign
+GRAPH_FRAGMENT_CACHE_MB = int(os.getenv("GRAPH_FRAGMENT_CACHE_MB", "64"))
+
+# Payload planning: sendMail request limit, attachment size that needs an upload
+# session, and largest message the mailbox accepts (larger ones are split)
+GRAPH_INLINE_REQUEST_MB = float(os.getenv("GRAPH_INLINE_REQUEST_MB", "4"))
+GRAPH_UPLOAD_SESSION_MIN_MB = float(os.getenv("GRAPH_UPLOAD_SESSION_MIN_MB", "3"))
+GRAPH_MAX_MESSAGE_MB = float(os.getenv("GRAPH_MAX_MESSAGE_MB", "35"))
+
+# HTTP for Graph calls: keep-alive pool size of the HTTP/1.1 session, or HTTP/2
+# multiplexing (needs httpx[http2]) with connection, concurrent stream and
+# in-flight body limits
+GRAPH_HTTP_POOL_SIZE = int(os.getenv("GRAPH_HTTP_POOL_SIZE", "10"))
+GRAPH_HTTP2 = os.getenv("GRAPH_HTTP2", "false").lower() == "true"
+GRAPH_HTTP2_MAX_CONNECTIONS = int(os.getenv("GRAPH_HTTP2_MAX_CONNECTIONS", "2"))
+GRAPH_HTTP2_MAX_STREAMS = int(os.getenv("GRAPH_HTTP2_MAX_STREAMS", "100"))
+GRAPH_HTTP2_MAX_INFLIGHT_MB = float(os.getenv("GRAPH_HTTP2_MAX_INFLIGHT_MB", "16"))
+
+# Campaign send pipeline: worker threads per stage and the size of the bounded
+# queue between stages. Keep one send worker to preserve the per-send delay.
+MAIL_PIPELINE_WORKERS = {
+    "render": int(os.getenv("MAIL_PIPELINE_RENDER_WORKERS", "1")),
+    "match": int(os.getenv("MAIL_PIPELINE_MATCH_WORKERS", "1")),
+    "encode": int(os.getenv("MAIL_PIPELINE_ENCODE_WORKERS", "2")),
+    "send": int(os.getenv("MAIL_PIPELINE_SEND_WORKERS", "1")),
+}
+MAIL_PIPELINE_QUEUE_SIZE = int(os.getenv("MAIL_PIPELINE_QUEUE_SIZE", "8"))
+# Send each company's rows back to back (grouped on the normalized company name)
+MAIL_GROUP_BY_COMPANY = os.getenv("MAIL_GROUP_BY_COMPANY", "true").lower() == "true"
+# Recipients per message in BCC fan-out mode (Exchange Online allows 500)
+MAIL_BCC_MAX_RECIPIENTS = int(os.getenv("MAIL_BCC_MAX_RECIPIENTS", "500"))
+# Check addresses and template columns of every row before sending; invalid
+# rows are skipped and reported instead of being sent
+MAIL_VALIDATE_RECIPIENTS = os.getenv("MAIL_VALIDATE_RECIPIENTS", "true").lower() == "true"
+
+# Recipient lists are read in batches of RECIPIENT_BATCH_ROWS rows; larger
+# lists than these row / cell budgets are rejected before they are fully read
+RECIPIENT_BATCH_ROWS = int(os.getenv("RECIPIENT_BATCH_ROWS", "5000"))
+RECIPIENT_MAX_ROWS = int(os.getenv("RECIPIENT_MAX_ROWS", "200000"))
+RECIPIENT_MAX_CELLS = int(os.getenv("RECIPIENT_MAX_CELLS", "5000000"))
+# Workbook engine: auto (calamine when python-calamine is installed), calamine or openpyxl
+RECIPIENT_XLSX_ENGINE = os.getenv("RECIPIENT_XLSX_ENGINE", "auto")
+# Rendered (subject, body) pairs kept per campaign, keyed by the values of the
+# columns the template references
+TEMPLATE_RENDER_CACHE_ENTRIES = int(os.getenv("TEMPLATE_RENDER_CACHE_ENTRIES", "50000"))
+
+# Keep campaign attachments in a per-user, SHA-256 keyed library so re-uploaded
+# files are stored once; unreferenced blobs are removed by cleanup_temp_files
+ATTACHMENT_LIBRARY_ENABLED = os.getenv("ATTACHMENT_LIBRARY_ENABLED", "false").lower() == "true"
+
+# "Send as OneDrive links" mode: folder the campaign's files are uploaded to and
+# the sharing link scope: "organization" (only signed-in users of the tenant) by
+# default. Set "anonymous" explicitly to let external recipients open the files;
+# anyone holding such a link can then read them. Needs the Files.ReadWrite
+# scope in GRAPH_SCOPES.
+ONEDRIVE_ATTACHMENT_FOLDER = os.getenv("ONEDRIVE_ATTACHMENT_FOLDER", "Mail Automation")
+ONEDRIVE_LINK_SCOPE = os.getenv("ONEDRIVE_LINK_SCOPE", "organization")
+
+# Mail transport: "graph" (Microsoft Graph), "smtp" (pooled SMTP connections)
+# or "file" (write .eml files to MAIL_FILE_SINK_PATH instead of sending)
+MAIL_TRANSPORT = os.getenv("MAIL_TRANSPORT", "graph").lower()
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.office365.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_USERNAME = os.getenv("SMTP_USERNAME", "")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD", "")
+SMTP_FROM = os.getenv("SMTP_FROM", "")
+SMTP_USE_TLS = os.getenv("SMTP_USE_TLS", "true").lower() == "true"
+SMTP_USE_SSL = os.getenv("SMTP_USE_SSL", "false").lower() == "true"
+# Persistent connections kept open, and messages sent over one before reconnecting
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "2"))
+SMTP_MAX_MESSAGES_PER_CONNECTION = int(os.getenv("SMTP_MAX_MESSAGES_PER_CONNECTION", "100"))
+
 # Logging configuration
 LOGGING = {
     'version': 1,
@@ -200,12 +292,19 @@ LOGGING = {
 # Mail/Graph configuration via environment
 GRAPH_TENANT_ID = os.getenv("GRAPH_TENANT_ID", "common")
 GRAPH_CLIENT_ID = os.getenv("GRAPH_CLIENT_ID", "")
+# Add Mail.ReadWrite to send messages over the 4 MB sendMail limit through
+# upload sessions; with Mail.Send alone they are split into smaller messages
 GRAPH_SCOPES = os.getenv("GRAPH_SCOPES", "Mail.Send")
 
 # Persistent data storage configuration
 DATA_STORAGE_PATH = os.getenv("DATA_STORAGE_PATH", str(BASE_DIR / "persistent_data"))
 EMAIL_TEMPLATES_PATH = os.getenv("EMAIL_TEMPLATES_PATH", str(Path(DATA_STORAGE_PATH) / "email_templates.json"))
 USER_TEMPLATES_PATH = os.getenv("USER_TEMPLATES_PATH", str(Path(DATA_STORAGE_PATH) / "user_templates"))
+ATTACHMENT_LIBRARY_PATH = os.getenv("ATTACHMENT_LIBRARY_PATH", str(Path(DATA_STORAGE_PATH) / "attachment_library"))
+DATASET_CACHE_PATH = os.getenv("DATASET_CACHE_PATH", str(Path(DATA_STORAGE_PATH) / "datasets"))
+MAIL_FILE_SINK_PATH = os.getenv("MAIL_FILE_SINK_PATH", str(Path(DATA_STORAGE_PATH) / "outbox"))
+# Compiled Jinja2 templates (bytecode, keyed by template hash)
+JINJA_BYTECODE_CACHE_PATH = os.getenv("JINJA_BYTECODE_CACHE_PATH", str(Path(DATA_STORAGE_PATH) / "jinja_cache"))
 
 # Ensure persistent data directory exists
 try:
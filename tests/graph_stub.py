@@ -0,0 +1,86 @@
+"""
+Local stand-in for the Microsoft Graph endpoints the mailer uses.
+
+Runs an HTTP server on a background thread and records every request, so
+tests can point graph_client.GRAPH_API_BASE at it and count what went over
+the wire.
+"""
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class GraphStubServer:
+    """Context manager serving sendMail, OneDrive upload sessions and createLink."""
+
+    def __init__(self):
+        self.requests = []
+        self.uploads = {}
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, so clients can reuse connections
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, payload=None):
+                data = json.dumps(payload).encode("utf-8") if payload is not None else b""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                # Shared clients must not carry this between users' calls
+                self.send_header("Set-Cookie", "graph_session=stub; Path=/")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _body(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                with stub._lock:
+                    stub.requests.append((self.command, self.path, body))
+                return body
+
+            def do_POST(self):
+                self._body()
+                if self.path.endswith(":/createUploadSession"):
+                    with stub._lock:
+                        upload_id = str(len(stub.uploads) + 1)
+                        stub.uploads[upload_id] = {"path": self.path, "data": b""}
+                    return self._reply(200, {"uploadUrl": f"{stub.base_url}/upload/{upload_id}"})
+                match = re.match(r"^/v1\.0/me/drive/items/([^/]+)/createLink$", self.path)
+                if match:
+                    return self._reply(201, {"link": {"webUrl": f"{stub.base_url}/s/{match.group(1)}"}})
+                if self.path == "/v1.0/me/sendMail":
+                    return self._reply(202)
+                return self._reply(404, {"error": {"code": "itemNotFound"}})
+
+            def do_PUT(self):
+                body = self._body()
+                upload = stub.uploads.get(self.path.rsplit("/", 1)[-1])
+                if upload is None:
+                    return self._reply(404, {"error": {"code": "itemNotFound"}})
+                upload["data"] += body
+                end, total = re.match(r"bytes \d+-(\d+)/(\d+)", self.headers["Content-Range"]).groups()
+                if int(end) + 1 < int(total):
+                    return self._reply(202, {"nextExpectedRanges": [f"{int(end) + 1}-"]})
+                item_id = f"item{self.path.rsplit('/', 1)[-1]}"
+                return self._reply(201, {"id": item_id, "size": len(upload["data"])})
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        self.graph_base = f"{self.base_url}/v1.0"
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def calls(self, method, suffix):
+        """Recorded (path, body) pairs of requests whose path ends with suffix."""
+        return [(path, body) for m, path, body in self.requests if m == method and path.endswith(suffix)]
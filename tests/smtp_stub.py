@@ -0,0 +1,94 @@
+"""
+Minimal local SMTP server for transport tests.
+
+Speaks just enough ESMTP (no TLS, no AUTH) for smtplib, runs on a
+background thread and records connections and received messages.
+"""
+import socketserver
+import threading
+
+
+class SMTPStubServer:
+    """
+    Context manager; recipients starting with "reject" are refused. A message
+    to a "hangup" recipient is stored, then the connection drops before the
+    reply to DATA. Set drop_next_mail to drop the connection at the next MAIL.
+    """
+
+    def __init__(self):
+        self.connections = 0
+        self.messages = []
+        self.drop_next_mail = False
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line.encode("ascii") + b"\r\n")
+
+            def handle(self):
+                with stub._lock:
+                    stub.connections += 1
+                self.reply("220 stub ESMTP")
+                mail_from, rcpts = None, []
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command = line.decode("ascii").strip()
+                    verb = command.split(" ", 1)[0].split(":", 1)[0].upper()
+                    if verb == "EHLO":
+                        self.reply("250-stub")
+                        self.reply("250 8BITMIME")
+                    elif verb in ("HELO", "NOOP"):
+                        self.reply("250 OK")
+                    elif verb == "MAIL":
+                        with stub._lock:
+                            drop, stub.drop_next_mail = stub.drop_next_mail, False
+                        if drop:
+                            return
+                        mail_from, rcpts = command.split(":", 1)[1].strip(" <>"), []
+                        self.reply("250 OK")
+                    elif verb == "RCPT":
+                        address = command.split(":", 1)[1].strip(" <>")
+                        if address.startswith("reject"):
+                            self.reply("550 No such user")
+                        else:
+                            rcpts.append(address)
+                            self.reply("250 OK")
+                    elif verb == "DATA":
+                        self.reply("354 End data with <CR><LF>.<CR><LF>")
+                        lines = []
+                        while True:
+                            data_line = self.rfile.readline()
+                            if data_line in (b".\r\n", b""):
+                                break
+                            lines.append(data_line[1:] if data_line.startswith(b"..") else data_line)
+                        with stub._lock:
+                            stub.messages.append({"from": mail_from, "rcpts": rcpts, "data": b"".join(lines)})
+                        if any(r.startswith("hangup") for r in rcpts):
+                            return
+                        self.reply("250 OK queued")
+                    elif verb == "RSET":
+                        mail_from, rcpts = None, []
+                        self.reply("250 OK")
+                    elif verb == "QUIT":
+                        self.reply("221 Bye")
+                        return
+                    else:
+                        self.reply("502 Command not implemented")
+
+        class Server(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self._server = Server(("127.0.0.1", 0), Handler)
+        self.host, self.port = self._server.server_address
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
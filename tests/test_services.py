@@ -54,6 +54,157 @@ class TestTemplateService(TestCase):
         self.assertEqual(subject, "Hello John")
         self.assertEqual(body, "Dear John, welcome!")
     
+    def test_compiled_template_matches_render_text(self):
+        """Test compiled templates render value tuples exactly like render_subject_body, fallbacks included."""
+        import numpy as np
+        from automation.services.template_render import CompiledSubjectBody, render_subject_body
+
+        df = pd.DataFrame({
+            "email": ["a@x.com", "b@x.com", "c@x.com"],
+            "name": ["Ali", "Ve\nli", None],
+            "amount": [10, 2.5, np.nan],
+            "Upper": ["U", "V", "W"],
+        })
+        templates = [
+            ("Fatura {name}", "Sayın {name},\r\nTutar {amount:>8} {amount!r} {missing} {missing!r:>12} {Upper} {upper}\nSaygılar"),
+            ("{{literal}} {email!s}", "\r{name}\n"),
+            ("{name.title}", "{0}"),
+            ("{amount:.2f}", "{name"),
+        ]
+        for subject, body in templates:
+            renderer = CompiledSubjectBody(subject, body, df.columns)
+            for (_, row), values in zip(df.iterrows(), df.itertuples(index=False, name=None)):
+                try:
+                    expected = render_subject_body(subject, body, row.to_dict())
+                except Exception as e:
+                    expected = repr(e)
+                try:
+                    rendered = renderer.render(values)
+                except Exception as e:
+                    rendered = repr(e)
+                self.assertEqual(rendered, expected)
+        self.assertTrue(CompiledSubjectBody(*templates[0], df.columns).body.compiled)
+        self.assertFalse(CompiledSubjectBody(*templates[2], df.columns).subject.compiled)
+
+    def test_bulk_render_matches_per_row(self):
+        """Test plain-placeholder templates render column-wise like per row; others fall back."""
+        import numpy as np
+        from automation.services.template_render import CompiledSubjectBody, render_subject_body
+
+        df = pd.DataFrame({
+            "name": ["Ali", "Ve\r\nli", None],
+            "amount": [10, 2.5, np.nan],
+            "count": [1, 2, 3],
+            "note": ["a", "b\r", "c"],
+            "date": [pd.Timestamp("2024-01-01"), None, pd.Timestamp("2024-02-03")],
+        })
+        subject, body = "Fatura {count}", "Sayın {name},\r\n{amount} {missing} {missing!r:>12} {note}\n{date}"
+        renderer = CompiledSubjectBody(subject, body, df.columns)
+        # With and without line breaks in the values
+        for frame in (df, df.drop(index=1), df.iloc[:0]):
+            self.assertEqual(
+                renderer.render_frame(frame),
+                [render_subject_body(subject, body, row.to_dict()) for _, row in frame.iterrows()]
+            )
+        self.assertIsNone(CompiledSubjectBody(subject, "{amount:.2f}", df.columns).render_frame(df))
+
+    def test_rows_with_same_referenced_values_render_once(self):
+        """Test memoization keys on referenced columns only and reports its hit rate."""
+        from automation.services.template_render import CompiledSubjectBody, compile_subject_body
+
+        df = pd.DataFrame({
+            "email": [f"user{n}@x.com" for n in range(6)],
+            "companyname": ["Acme", "Acme", "Acme", "Globex", "Globex", "Acme"],
+            "amount": [10.0, 10.0, 10.0, 20.0, 20.0, 30.0],
+        })
+        subject, body = "{companyname} faturası", "Tutar: {amount:.2f} TL"
+        renderer = compile_subject_body(subject, body, df.columns, memoize=True)
+        with patch.object(CompiledSubjectBody, "render", autospec=True, side_effect=CompiledSubjectBody.render) as render:
+            rendered = [renderer.render(values) for values in df.itertuples(index=False, name=None)]
+
+        self.assertEqual(render.call_count, 3)
+        self.assertEqual(rendered[1], ("Acme faturası", "Tutar: 10.00 TL"))
+        self.assertEqual(rendered[5], ("Acme faturası", "Tutar: 30.00 TL"))
+        self.assertEqual(renderer.stats()["hit_rate"], 0.5)
+        self.assertIn("hit rate 50%", renderer.format_stats())
+
+        # Equal values of different types (1 == 1.0 == True) are rendered separately
+        renderer = compile_subject_body("Hi {n}", "", ["n"], memoize=True)
+        rendered = [renderer.render((value,))[0] for value in (1, 1.0, True, 1)]
+        self.assertEqual(rendered, ["Hi 1", "Hi 1.0", "Hi True", "Hi 1"])
+        self.assertEqual(renderer.stats()["hits"], 1)
+
+    def test_template_engine_saved_and_validated(self):
+        """Test the engine is stored with Jinja templates only and the form rejects unusable Jinja templates."""
+        import tempfile
+        from django.test import override_settings
+        from automation.forms import TemplateEditForm
+        from automation.services import jinja_render
+        from automation.services.template_render import template_fields
+        from automation.services.templates import TemplateService
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                override_settings(USER_TEMPLATES_PATH=tmp, JINJA_BYTECODE_CACHE_PATH=tmp), \
+                patch.object(TemplateService, "_create_automatic_backup"):
+            service = TemplateService(user_id=1)
+            service.save_template("plain", "Fatura {name}", "Merhaba {name}")
+            service.save_template("jinja", "Fatura", "{% if vip %}Sayın{% endif %} {{ name }}", engine="jinja")
+            service.clear_cache()
+            self.assertNotIn("engine", service.get_template("plain"))
+            self.assertEqual(service.get_template("jinja")["engine"], "jinja")
+
+            jinja_render.reset_environment()
+            try:
+                data = {"name": "t", "subject": "", "body": "{% if x %}a", "engine": "jinja"}
+                self.assertFalse(TemplateEditForm(data).is_valid())
+                with patch.object(jinja_render, "JINJA_SUPPORT", False):
+                    data["body"] = "{% if x %}a{% endif %}"
+                    self.assertFalse(TemplateEditForm(data).is_valid())
+                    # Without jinja2 every column is kept instead of failing the request
+                    self.assertIsNone(template_fields("", data["body"], engine="jinja"))
+                self.assertTrue(TemplateEditForm({"name": "t", "body": "{x}"}).is_valid())
+            finally:
+                jinja_render.reset_environment()
+
+    def test_jinja_templates_render_sandboxed_and_compile_once(self):
+        """Test conditionals and loops render, the sandbox blocks internals and bytecode is cached by hash."""
+        import os
+        import tempfile
+        from django.test import override_settings
+        from automation.services import jinja_render
+
+        if not jinja_render.JINJA_SUPPORT:
+            self.skipTest("jinja2 not installed")
+        import jinja2.sandbox
+
+        with tempfile.TemporaryDirectory() as tmp, override_settings(JINJA_BYTECODE_CACHE_PATH=tmp):
+            jinja_render.reset_environment()
+            try:
+                # Block tags on lines of their own (indented or not) leave no empty <br>
+                body = "{% if amount|float > 100 %}\nSayın {{ name }}\n{% else %}\nMerhaba\n{% endif %}\n" \
+                       "  {% for part in items.split(';') %}\n- {{ part }}\n  {% endfor %}\n"
+                renderer = jinja_render.JinjaSubjectBody("Fatura {{ Name }}", body, ["Name", "Amount", "Items"])
+                self.assertEqual(
+                    renderer.render(("Ali", "250", "a;b")),
+                    ("Fatura Ali", "Sayın Ali<br>- a<br>- b<br>")
+                )
+                self.assertEqual(renderer.render(("Veli", "5", "c"))[1], "Merhaba<br>- c<br>")
+                self.assertTrue(os.listdir(tmp))
+
+                with patch.object(jinja2.sandbox.SandboxedEnvironment, "_compile", side_effect=AssertionError):
+                    # Same source: served from the memory cache, never recompiled
+                    jinja_render.compile_jinja(body)
+                with self.assertRaises(jinja2.exceptions.SecurityError):
+                    jinja_render.JinjaSubjectBody("", "{{ name.__class__.__mro__ }}", ["name"]).render(("x",))
+
+                # Registered sources are bounded like the compiled-template cache
+                with patch.object(jinja_render.get_environment().loader, "max_sources", 2):
+                    for i in range(5):
+                        self.assertEqual(jinja_render.compile_jinja(f"{{{{ n }}}}-{i}").render(n=i), f"{i}-{i}")
+                    self.assertEqual(len(jinja_render.get_environment().loader.sources), 2)
+            finally:
+                jinja_render.reset_environment()
+
     def test_export_import_templates(self):
         """Test template export and import."""
         # Create test template
@@ -128,6 +279,196 @@ class TestFileProcessorService(TestCase):
         self.assertIn("contentBytes", attachment)
         self.assertEqual(attachment["@odata.type"], "#microsoft.graph.fileAttachment")
     
+    def test_lazy_zip_catalogue(self):
+        """Test ZIP members are catalogued without extraction and read on demand."""
+        import base64
+        import io
+        import tempfile
+        import zipfile
+        from pathlib import Path
+
+        buff = io.BytesIO()
+        with zipfile.ZipFile(buff, "w", zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("invoices/acme_invoice.pdf", b"%PDF acme")
+            zf.writestr("globex_invoice.pdf", b"%PDF globex")
+        uploaded_file = SimpleUploadedFile("invoices.zip", buff.getvalue(), content_type="application/zip")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            processor = type(file_processor)(base_temp_dir=Path(tmp))
+            files, temp_dir = processor.process_uploaded_files([uploaded_file], lazy_zip=True)
+
+            self.assertEqual(sorted(f["name"] for f in files), ["acme_invoice.pdf", "globex_invoice.pdf"])
+            # Only the archive itself was written
+            self.assertEqual([p.name for p in Path(temp_dir).iterdir()], ["invoices.zip"])
+
+            matched, _ = processor.find_matching_files("ACME", files)
+            attachments = processor.build_attachments(matched)
+            self.assertEqual(len(attachments), 1)
+            self.assertEqual(base64.b64decode(attachments[0]["contentBytes"]), b"%PDF acme")
+            processor.cleanup_temp_files(temp_dir)
+
+    def test_zip_handles_closed_on_eviction_and_cleanup(self):
+        """Test cached archive handles are closed when evicted and only for the cleaned-up directory."""
+        import os
+        import tempfile
+        import threading
+        import time
+        import zipfile
+        from automation.services.attach_matcher import ZipHandleCache
+
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for campaign in ("one", "two", "three"):
+                os.makedirs(os.path.join(tmp, campaign))
+                paths.append(os.path.join(tmp, campaign, "files.zip"))
+                with zipfile.ZipFile(paths[-1], "w") as zf:
+                    zf.writestr("acme.pdf", b"acme")
+
+            cache = ZipHandleCache(max_handles=2)
+            first = cache.get(paths[0])
+            stream = first.open("acme.pdf")
+            self.assertIs(cache.get(paths[0]), first)
+            second, third = cache.get(paths[1]), cache.get(paths[2])
+            # The least recently used handle is closed; its open stream stays readable
+            self.assertIsNone(first.fp)
+            self.assertEqual(stream.read(), b"acme")
+            stream.close()
+
+            self.assertEqual(cache.close_under(os.path.join(tmp, "two")), 1)
+            self.assertIsNone(second.fp)
+            self.assertIsNotNone(third.fp)
+            self.assertEqual(len(cache), 1)
+            cache.close_under(tmp)
+
+            # An eviction from another thread waits until open() has the member stream
+            cache = ZipHandleCache(max_handles=1)
+            opening = threading.Event()
+            real_open = zipfile.ZipFile.open
+
+            def slow_open(zf, *args, **kwargs):
+                opening.set()
+                time.sleep(0.05)
+                return real_open(zf, *args, **kwargs)
+
+            streams = []
+            with patch.object(zipfile.ZipFile, "open", slow_open):
+                reader = threading.Thread(target=lambda: streams.append(cache.open(paths[0], "acme.pdf")))
+                reader.start()
+                opening.wait()
+                cache.get(paths[1])
+                reader.join()
+            with streams[0] as stream:
+                self.assertEqual(stream.read(), b"acme")
+            cache.close_under(tmp)
+
+    def test_extraction_budget(self):
+        """Test oversized members are skipped and zip bombs rejected before extraction."""
+        import io
+        import tempfile
+        import zipfile
+        from pathlib import Path
+        from automation.exceptions import ArchiveLimitError
+        from automation.services.attach_matcher import ExtractionBudget, collect_files_from_upload
+
+        buff = io.BytesIO()
+        with zipfile.ZipFile(buff, "w", zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("acme_small.pdf", b"acme")
+            zf.writestr("acme_huge.bin", b"\0" * (3 * 1024 * 1024))
+        upload = SimpleUploadedFile("invoices.zip", buff.getvalue())
+
+        with tempfile.TemporaryDirectory() as tmp:
+            budget = ExtractionBudget(max_file_bytes=2 * 1024 * 1024, max_ratio=100_000)
+            files, temp_dir = collect_files_from_upload([upload], Path(tmp), budget=budget)
+            self.assertEqual([f["name"] for f in files], ["acme_small.pdf"])
+            self.assertEqual(len(budget.skipped), 1)
+
+            upload.seek(0)
+            with self.assertRaises(ArchiveLimitError):
+                collect_files_from_upload([upload], Path(tmp), budget=ExtractionBudget(max_ratio=100))
+            # The aborted upload leaves nothing behind
+            self.assertEqual([p.name for p in Path(tmp).iterdir()], [Path(temp_dir).name])
+
+    def test_archives_detected_by_magic_and_extracted_concurrently(self):
+        """Test archives need an archive extension and matching magic bytes, and are extracted concurrently."""
+        import io
+        import tarfile
+        import tempfile
+        import zipfile
+        from pathlib import Path
+        from automation.services.attach_matcher import collect_files_from_upload
+
+        zip_buff = io.BytesIO()
+        with zipfile.ZipFile(zip_buff, "w") as zf:
+            zf.writestr("acme.pdf", b"acme")
+        tar_buff = io.BytesIO()
+        with tarfile.open(fileobj=tar_buff, mode="w:gz") as tf:
+            info = tarfile.TarInfo("docs/globex.pdf")
+            info.size = 6
+            tf.addfile(info, io.BytesIO(b"globex"))
+
+        uploads = [
+            SimpleUploadedFile("first.zip", zip_buff.getvalue()),
+            SimpleUploadedFile("second.tar.gz", tar_buff.getvalue()),
+            SimpleUploadedFile("notes.txt", b"plain"),
+            SimpleUploadedFile("bundle.bin", zip_buff.getvalue()),
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            files, _ = collect_files_from_upload(uploads, Path(tmp), max_workers=2)
+            self.assertEqual(sorted(f["name"] for f in files), ["acme.pdf", "bundle.bin", "globex.pdf", "notes.txt"])
+            self.assertEqual(Path(next(f["path"] for f in files if f["name"] == "globex.pdf")).read_bytes(), b"globex")
+
+            with self.assertRaises(ValueError):
+                collect_files_from_upload([SimpleUploadedFile("fake.zip", b"not an archive")], Path(tmp))
+
+    def test_documents_and_compressed_files_attached_as_is(self):
+        """Test .docx containers and a gzipped CSV are attached whole, not extracted."""
+        import gzip
+        import io
+        import tempfile
+        import zipfile
+        from pathlib import Path
+        from automation.services.attach_matcher import collect_files_from_upload
+
+        docx = io.BytesIO()
+        with zipfile.ZipFile(docx, "w") as zf:
+            zf.writestr("[Content_Types].xml", "<Types/>")
+            zf.writestr("word/document.xml", "<w:document/>")
+        csv_gz = gzip.compress(b"company,amount\nacme,10\n" * 50)
+        uploads = [
+            SimpleUploadedFile("contract_acme.docx", docx.getvalue()),
+            # A document renamed to .zip is still a document
+            SimpleUploadedFile("contract_globex.zip", docx.getvalue()),
+            SimpleUploadedFile("report.csv.gz", csv_gz),
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            files, _ = collect_files_from_upload(uploads, Path(tmp))
+            self.assertEqual(
+                sorted(f["name"] for f in files), ["contract_acme.docx", "contract_globex.zip", "report.csv.gz"]
+            )
+            report = next(f for f in files if f["name"] == "report.csv.gz")
+            self.assertEqual(Path(report["path"]).read_bytes(), csv_gz)
+            self.assertFalse(file_processor.is_archive(uploads[0]))
+
+    def test_members_sharing_a_name_are_all_extracted(self):
+        """Test members with the same base name in different folders don't overwrite each other."""
+        import io
+        import tarfile
+        import tempfile
+        from pathlib import Path
+        from automation.services.attach_matcher import collect_files_from_upload
+
+        tar_buff = io.BytesIO()
+        with tarfile.open(fileobj=tar_buff, mode="w:gz") as tf:
+            for folder, content in (("january", b"jan"), ("february", b"feb")):
+                info = tarfile.TarInfo(f"{folder}/acme_invoice.pdf")
+                info.size = len(content)
+                tf.addfile(info, io.BytesIO(content))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            files, _ = collect_files_from_upload([SimpleUploadedFile("invoices.tgz", tar_buff.getvalue())], Path(tmp))
+            self.assertEqual([f["name"] for f in files], ["acme_invoice.pdf", "acme_invoice.pdf"])
+            self.assertEqual(sorted(Path(f["path"]).read_bytes() for f in files), [b"feb", b"jan"])
+
     def test_cleanup_temp_files(self):
         """Test cleanup of temporary files."""
         # Test with non-existent directory
@@ -135,6 +476,633 @@ class TestFileProcessorService(TestCase):
         self.assertTrue(result)  # Should return True even if directory doesn't exist
 
 
+class TestCampaignUploadHandler(TestCase):
+    """Test attachments are stored and catalogued while the upload streams in."""
+
+    def test_zip_is_stored_once_and_catalogued(self):
+        """Test a ZIP upload lands in the campaign store with a ready catalogue."""
+        import io
+        import tempfile
+        import zipfile
+        from pathlib import Path
+        from django.test import RequestFactory, override_settings
+
+        buff = io.BytesIO()
+        with zipfile.ZipFile(buff, "w") as zf:
+            zf.writestr("acme.pdf", b"acme")
+            zf.writestr("globex.pdf", b"globex")
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                override_settings(STREAMING_ATTACHMENT_UPLOADS=True, FILE_UPLOAD_TEMP_DIR=tmp):
+            request = RequestFactory().post("/mail/", {
+                "attachment": SimpleUploadedFile("invoices.zip", buff.getvalue()),
+                "excel_file": SimpleUploadedFile("list.xlsx", b"not handled here"),
+            })
+            stored = request.FILES["attachment"]
+            other = request.FILES["excel_file"]
+
+            self.assertEqual(sorted(f["name"] for f in stored.catalogue), ["acme.pdf", "globex.pdf"])
+            self.assertEqual(len(stored.sha256), 64)
+            self.assertEqual([p.name for p in Path(stored.store_dir).iterdir()], ["invoices.zip"])
+            # Other fields keep going through the default handlers
+            self.assertFalse(hasattr(other, "catalogue"))
+            stored.close()
+            other.close()
+
+
+class TestAttachmentLibrary(TestCase):
+    """Test the per-user content-addressed attachment library."""
+
+    def test_reupload_is_deduplicated_and_gc_respects_references(self):
+        """Test identical files are stored once and only unreferenced blobs are collected."""
+        import tempfile
+        from pathlib import Path
+        from automation.services.attachment_library import AttachmentLibrary
+
+        with tempfile.TemporaryDirectory() as tmp:
+            library = AttachmentLibrary(user_id=1, root=Path(tmp) / "library")
+
+            def upload(month):
+                src = Path(tmp) / month
+                src.mkdir()
+                (src / "acme.pdf").write_bytes(b"acme invoice")
+                (src / "globex.pdf").write_bytes(b"globex " + month.encode())
+                return [
+                    {"name": p.name, "path": str(p), "size": p.stat().st_size, "content_type": "application/pdf"}
+                    for p in sorted(src.iterdir())
+                ]
+
+            january, stored = library.import_catalogue(upload("january"))
+            self.assertEqual(stored, 2)
+            february, stored = library.import_catalogue(upload("february"))
+            self.assertEqual(stored, 1)
+            self.assertEqual(january[0]["blob_id"], february[0]["blob_id"])
+            self.assertEqual(Path(february[0]["path"]).read_bytes(), b"acme invoice")
+
+            campaign = library.reference(f["blob_id"] for f in february)
+            deleted, _ = library.collect_garbage(min_age_hours=0)
+            self.assertEqual(deleted, 1)  # January's globex invoice
+            self.assertTrue(all(Path(f["path"]).exists() for f in february))
+
+            library.release(campaign)
+            deleted, _ = library.collect_garbage(min_age_hours=0, dry_run=True)
+            self.assertEqual(deleted, 2)
+            self.assertTrue(all(Path(f["path"]).exists() for f in february))
+
+    def test_zip_member_fingerprint_confirmed_by_content(self):
+        """Test a member matching a fingerprint but not the content (CRC-32 collision) gets its own blob."""
+        import io
+        import tempfile
+        import zipfile
+        from pathlib import Path
+        from automation.services.attachment_library import AttachmentLibrary
+        from automation.services.extractors import ExtractionBudget, ZipExtractor
+
+        with tempfile.TemporaryDirectory() as tmp:
+            library = AttachmentLibrary(user_id=1, root=Path(tmp) / "library")
+            archive = Path(tmp) / "invoices.zip"
+            with zipfile.ZipFile(archive, "w") as zf:
+                zf.writestr("acme.pdf", b"acme march")
+            members = ZipExtractor().catalogue(archive, ExtractionBudget())
+
+            first, stored = library.import_catalogue(members)
+            self.assertEqual(stored, 1)
+            again, stored = library.import_catalogue(members)
+            self.assertEqual((stored, again[0]["blob_id"]), (0, first[0]["blob_id"]))
+
+            # Another file that happens to share name, size and CRC-32
+            other, _ = library.add_stream(io.BytesIO(b"globex mar"), "acme.pdf", "application/pdf")
+            fingerprint = f"acme.pdf:{members[0]['size']}:{members[0]['crc']:08x}"
+            with library._locked_index() as index:
+                index["fingerprints"][fingerprint] = [other["blob_id"]]
+            imported, stored = library.import_catalogue(members)
+            self.assertEqual(imported[0]["blob_id"], first[0]["blob_id"])
+            self.assertEqual(Path(imported[0]["path"]).read_bytes(), b"acme march")
+
+
+class TestDatasetStore(TestCase):
+    """Test the parsed recipient dataset cache."""
+
+    def test_upload_parsed_once_and_loaded_by_id(self):
+        """Test identical uploads are parsed once, loaded by ID and garbage-collected when stale."""
+        import os
+        import tempfile
+        from automation.services.datasets import DatasetStore
+
+        parsed = []
+
+        def parser(content):
+            parsed.append(content)
+            return pd.DataFrame({"email": ["a@x.com", "b@x.com"], "count": [1, "two"]})
+
+        with tempfile.TemporaryDirectory() as tmp:
+            store = DatasetStore(1, root=tmp)
+            dataset_id, df = store.put(b"workbook", parser, "list.xlsx")
+            same_id, _ = store.put(b"workbook", parser, "list.xlsx")
+
+            self.assertEqual((dataset_id, len(parsed)), (same_id, 1))
+            other_reader, _ = store.put(b"workbook", parser, "list.xlsx", options={"reader": "CalamineBatchReader"})
+            self.assertNotEqual(other_reader, dataset_id)
+            self.assertEqual(len(parsed), 2)
+            pd.testing.assert_frame_equal(store.load(dataset_id), df)
+            self.assertEqual(store.meta(dataset_id)["rows"], 2)
+            self.assertFalse(store.exists("../../etc/passwd"))
+            with self.assertRaises(FileNotFoundError):
+                store.load("f" * 64)
+
+            data_path = os.path.join(store.root, store.meta(dataset_id)["file"])
+            os.utime(data_path, (0, 0))
+            self.assertEqual(store.collect_garbage(min_age_hours=1)[0], 1)
+            self.assertFalse(store.exists(dataset_id))
+
+
+class TestRecipientReader(TestCase):
+    """Test the streaming recipient workbook reader."""
+
+    def _workbook(self, rows):
+        import io
+        from openpyxl import Workbook
+
+        wb = Workbook()
+        for row in rows:
+            wb.active.append(row)
+        buff = io.BytesIO()
+        wb.save(buff)
+        return buff.getvalue()
+
+    def test_batches_match_read_excel_and_budget_aborts_early(self):
+        """Test batched reads equal pd.read_excel with normalized columns, and oversized sheets are rejected."""
+        import io
+        from automation.exceptions import RecipientListLimitError
+        from automation.services.recipient_reader import ReadBudget, XlsxBatchReader, normalize_columns, read_xlsx
+
+        content = self._workbook([
+            [" Email", "Name", "Name", None, "Amount"],
+            ["a@x.com", "Ali", "A", None, 10],
+            [None, None, None, None, None],
+            ["b@x.com", "Veli", None, "note", None],
+            ["c@x.com", "Ayşe", "C", None, 30],
+            [None, None, None, None, None],
+        ])
+        expected = pd.read_excel(io.BytesIO(content))
+        expected.columns = expected.columns.str.strip().str.lower()
+        pd.testing.assert_frame_equal(read_xlsx(io.BytesIO(content), batch_size=2), expected)
+
+        reader = XlsxBatchReader(io.BytesIO(content), batch_size=2)
+        self.assertEqual(reader.columns, ["email", "name", "name.1", "unnamed: 3", "amount"])
+        self.assertEqual([len(batch) for batch in reader], [2, 2])
+
+        # Headers differing only in case are still distinct columns
+        self.assertEqual(
+            normalize_columns(["Email", "email", "EMAIL.1", None]),
+            ["email", "email.1", "email.1.1", "unnamed: 3"]
+        )
+
+        with patch.object(XlsxBatchReader, "close", autospec=True, side_effect=XlsxBatchReader.close) as close:
+            with self.assertRaises(RecipientListLimitError):
+                XlsxBatchReader(io.BytesIO(content), budget=ReadBudget(max_rows=3))
+            with self.assertRaises(RecipientListLimitError):
+                XlsxBatchReader(io.BytesIO(content), budget=ReadBudget(max_cells=10))
+        # The workbook is closed when the declared size is over budget
+        self.assertEqual(close.call_count, 2)
+
+    def test_csv_and_parquet_read_like_workbooks(self):
+        """Test CSV (sniffed delimiter and encoding) and Parquet give the workbook's columns and rows."""
+        import io
+        from automation.exceptions import FileProcessingError, RecipientListLimitError
+        from automation.services import recipient_reader
+        from automation.services.recipient_reader import ReadBudget, open_recipient_reader, read_recipients
+
+        rows = [[" Email", "Name", "Name"], ["a@x.com", "Ali", "A"], ["b@x.com", "Şükrü", None], ["c@x.com", "Ayşe", "C"]]
+        from_xlsx = read_recipients(io.BytesIO(self._workbook(rows)), "list.xlsx")
+
+        csv_text = "\n".join(";".join(v or "" for v in row) for row in rows)
+        for encoding in ("utf-8-sig", "cp1254"):
+            from_csv = read_recipients(io.BytesIO(csv_text.encode(encoding)), "list.csv", batch_size=2)
+            pd.testing.assert_frame_equal(from_csv, from_xlsx)
+
+        reader = open_recipient_reader(io.BytesIO(csv_text.encode()), "list.csv", batch_size=2)
+        self.assertEqual(reader.columns, ["email", "name", "name.1"])
+        self.assertEqual([len(batch) for batch in reader], [2, 1])
+        with self.assertRaises(RecipientListLimitError):
+            list(open_recipient_reader(io.BytesIO(csv_text.encode()), "list.csv", budget=ReadBudget(max_rows=2)))
+        with self.assertRaises(FileProcessingError):
+            open_recipient_reader(io.BytesIO(b"not a workbook"), "list.xlsx")
+
+        # Headers differing only in case, and a Windows-1254 row after the sniffed UTF-8 head
+        late_cp1254 = "Email;email\n".encode() + b"a@x.com;x\n" * 10 + "b@x.com;Şükrü\n".encode("cp1254")
+        with patch.object(recipient_reader, "CSV_SNIFF_BYTES", 32):
+            mixed = read_recipients(io.BytesIO(late_cp1254), "list.csv", batch_size=4)
+        self.assertEqual(list(mixed.columns), ["email", "email.1"])
+        self.assertEqual(mixed["email.1"].iloc[-1], "Şükrü")
+
+        if recipient_reader.PARQUET_SUPPORT:
+            buff = io.BytesIO()
+            pd.DataFrame(rows[1:], columns=rows[0]).to_parquet(buff, index=False)
+            buff.seek(0)
+            pd.testing.assert_frame_equal(read_recipients(buff, "list.parquet", batch_size=2), from_xlsx)
+
+    def test_only_template_columns_are_loaded(self):
+        """Test placeholders select the loaded columns, with "" for empty cells, for streamed and cached lists."""
+        import io
+        import tempfile
+        from django.test import override_settings
+        from automation import views
+        from automation.services.recipient_reader import open_recipient_reader
+        from automation.services.template_render import template_fields
+
+        fields = template_fields("Fatura {Name}", "Tutar: {amount:>{width}} {row.x} {{literal}}")
+        self.assertEqual(fields, {"Name", "amount", "width", "row"})
+        self.assertIsNone(template_fields("Merhaba {name"))
+
+        rows = [["Email", "Name", "Amount", "Notes", "CC", "CompanyName"],
+                ["a@x.com", "Ali", 10, "x" * 50, None, "Acme"],
+                ["b@x.com", None, 2.5, "y", "c@x.com", None]]
+        content = self._workbook(rows)
+        expected = pd.DataFrame(
+            {"email": ["a@x.com", "b@x.com"], "amount": [10, 2.5], "cc": ["", "c@x.com"],
+             "companyname": ["Acme", ""]},
+            dtype=object
+        )
+
+        reader = open_recipient_reader(io.BytesIO(content), "list.xlsx")
+        reader.select(views._recipient_columns(reader.columns, {"amount"}))
+        pd.testing.assert_frame_equal(pd.concat(list(reader), ignore_index=True), expected)
+
+        csv = "\n".join(",".join("" if v is None else str(v) for v in row) for row in rows).encode()
+        reader = open_recipient_reader(io.BytesIO(csv), "list.csv")
+        reader.select(views._recipient_columns(reader.columns, {"amount"}))
+        # CSV cells are text
+        pd.testing.assert_frame_equal(
+            pd.concat(list(reader), ignore_index=True), expected.assign(amount=["10", "2.5"])
+        )
+
+        with tempfile.TemporaryDirectory() as tmp, override_settings(DATASET_CACHE_PATH=tmp):
+            request = Mock()
+            request.user.id = 1
+            request.session = {}
+            request.FILES = {"excel_file": SimpleUploadedFile("list.xlsx", content)}
+            df, email_column = views._process_excel_file(request, {"amount"})
+            pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+            self.assertEqual(df["amount"].dtype.kind, "f")
+
+            request.FILES = {}
+            df, _ = views._process_excel_file(request, {"amount"})
+            pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+            self.assertEqual(len(views._process_excel_file(request)[0].columns), 6)
+
+    @patch('time.sleep')
+    @patch('automation.views.send_single_mail')
+    def test_numeric_placeholders_keep_their_format_spec(self, mock_send, mock_sleep):
+        """Test {amount:.2f} renders numbers from a cached workbook and leaves empty cells out."""
+        import tempfile
+        from django.test import override_settings
+        from automation import views
+        from automation.services.template_render import template_fields
+
+        content = self._workbook([
+            ["Email", "Amount", "Note"],
+            ["a@x.com", 1500, None],
+            ["b@x.com", 2.5, "ok"],
+        ])
+        subject, body = "Fatura", "Tutar: {amount:.2f} {note}"
+        with tempfile.TemporaryDirectory() as tmp, override_settings(DATASET_CACHE_PATH=tmp):
+            request = Mock()
+            request.user.id = 1
+            request.session = {}
+            request.FILES = {"excel_file": SimpleUploadedFile("list.xlsx", content)}
+            df, email_column = views._process_excel_file(request, template_fields(subject, body))
+            logs, results = views._send_emails(df, email_column, "companyname", subject, body, [], request)
+
+        self.assertEqual([r["status"] for r in results], ["OK", "OK"])
+        self.assertEqual(
+            [c.args[2] for c in mock_send.call_args_list], ["Tutar: 1500.00 ", "Tutar: 2.50 ok"]
+        )
+
+    def test_xlsx_engines_read_identically(self):
+        """Test engine selection falls back to openpyxl and calamine reads like openpyxl."""
+        import io
+        from automation.services import recipient_reader
+        from automation.services.recipient_reader import XlsxBatchReader, get_xlsx_reader_class, read_xlsx
+
+        self.assertIs(get_xlsx_reader_class("openpyxl"), XlsxBatchReader)
+        with patch.object(recipient_reader, "CALAMINE_SUPPORT", False):
+            self.assertIs(get_xlsx_reader_class("calamine"), XlsxBatchReader)
+            self.assertIs(get_xlsx_reader_class("auto"), XlsxBatchReader)
+        with self.assertRaises(ValueError):
+            get_xlsx_reader_class("xlrd")
+
+        if not recipient_reader.CALAMINE_SUPPORT:
+            self.skipTest("python-calamine not installed")
+        content = self._workbook([
+            [" Email", "Name", "Name", None, "Amount"],
+            ["a@x.com", "Ali", "A", None, 10],
+            [None, None, None, None, None],
+            ["b@x.com", "Veli", None, "note", 2.5],
+            [None, None, None, None, None],
+        ])
+        pd.testing.assert_frame_equal(
+            read_xlsx(io.BytesIO(content), batch_size=2, engine="calamine"),
+            read_xlsx(io.BytesIO(content), batch_size=2, engine="openpyxl"),
+        )
+
+    @patch('time.sleep')
+    @patch('automation.views.send_single_mail')
+    def test_sending_starts_before_list_is_read(self, mock_send, mock_sleep):
+        """Test rows from the first batch are sent before the next batch is read."""
+        import threading
+        from automation import views
+
+        df = pd.DataFrame({"email": [f"user{n}@x.com" for n in range(4)]})
+        sent = threading.Event()
+        mock_send.side_effect = lambda *args, **kwargs: sent.set()
+        sent_before_second_batch = []
+
+        def batches():
+            yield df.iloc[:2]
+            sent_before_second_batch.append(sent.wait(5))
+            yield df.iloc[2:]
+
+        request = Mock()
+        request.user.id = 1
+        logs, results = views._send_emails(
+            df.iloc[:0], "email", "companyname", "Hi", "Body", [], request, row_batches=batches()
+        )
+
+        self.assertEqual(sent_before_second_batch, [True])
+        self.assertEqual([r["email"] for r in results], list(df["email"]))
+        self.assertEqual(mock_send.call_count, 4)
+
+
+class TestPipeline(TestCase):
+    """Test the staged send pipeline."""
+
+    def test_stages_overlap_keep_order_and_bound_queues(self):
+        """Test items come back in order, failures skip to the recorder and queues stay bounded."""
+        import time
+        from automation.services.pipeline import Pipeline, Stage
+
+        def encode(item):
+            if item.index == 3:
+                raise ValueError("bad row")
+            item.data["encoded"] = item.data["n"] * 2
+
+        def send(item):
+            time.sleep(0.01)
+            item.data["sent"] = True
+
+        def record(item):
+            item.data["status"] = "ERROR" if item.error else "OK"
+
+        pipeline = Pipeline(
+            [Stage("encode", encode, workers=3), Stage("send", send, workers=2), Stage("record", record, handles_errors=True)],
+            queue_size=2
+        )
+        start = time.perf_counter()
+        items = pipeline.run({"n": n} for n in range(20))
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual([item.index for item in items], list(range(20)))
+        self.assertEqual(items[3].data["status"], "ERROR")
+        self.assertNotIn("sent", items[3].data)
+        self.assertTrue(all(item.data["sent"] for item in items if item.index != 3))
+        self.assertLess(elapsed, 19 * 0.01)  # two senders overlap
+
+        stats = {s["stage"]: s for s in pipeline.stats()}
+        self.assertTrue(all(s["max_queue_depth"] <= 2 for s in stats.values()))
+        self.assertEqual((stats["encode"]["errors"], stats["send"]["items"]), (1, 19))
+        self.assertIn("[PIPELINE] send", "\n".join(pipeline.format_stats()))
+
+    def test_ordered_stage_receives_items_in_input_order(self):
+        """Test an ordered stage sees items in input order behind out-of-order parallel workers."""
+        import time
+        from automation.services.pipeline import Pipeline, Stage
+
+        received = []
+
+        def encode(item):
+            # Later items finish first
+            time.sleep(0.002 * (item.index % 4 == 0))
+
+        pipeline = Pipeline(
+            [Stage("encode", encode, workers=4), Stage("send", lambda item: received.append(item.index), ordered=True)],
+            queue_size=2
+        )
+        pipeline.run({} for _ in range(40))
+        self.assertEqual(received, list(range(40)))
+
+    def test_keyed_values_built_once_across_workers(self):
+        """Test workers asking for the same key at once share one build."""
+        import threading
+        import time
+        from automation.services.pipeline import KeyedOnce, Pipeline, Stage
+
+        shared = KeyedOnce()
+        builds = []
+        lock = threading.Lock()
+
+        def build(key):
+            with lock:
+                builds.append(key)
+            # Hold the build open so other workers arrive meanwhile
+            time.sleep(0.01)
+            return [key]
+
+        def encode(item):
+            key = item.index % 2
+            item.data["value"] = shared.get(key, lambda: build(key))
+
+        items = Pipeline([Stage("encode", encode, workers=4)]).run({} for _ in range(8))
+        self.assertEqual(sorted(builds), [0, 1])
+        self.assertTrue(all(item.data["value"] is items[item.index % 2].data["value"] for item in items))
+
+
+    @patch('time.sleep')
+    @patch('automation.views.send_single_mail')
+    def test_rows_grouped_by_company_report_keeps_order(self, mock_send, mock_sleep):
+        """Test a company's rows are sent back to back with one attachment set, report in Excel order."""
+        import os
+        import tempfile
+        from automation import views
+        from automation.services.payload_planner import send_order_by_company
+
+        df = pd.DataFrame({
+            "email": ["a1@acme.com", "g1@globex.com", "a2@acme.com", "n@none.com", "g2@globex.com"],
+            "companyname": ["Acme", "Globex", " ACME", None, "globex"],
+        })
+        self.assertEqual(send_order_by_company(df, "companyname"), [0, 2, 1, 4, 3])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            files = []
+            for name in ("acme_invoice.pdf", "globex_invoice.pdf"):
+                path = os.path.join(tmp, name)
+                with open(path, "wb") as f:
+                    f.write(b"%PDF")
+                files.append({"name": name, "path": path, "size": 4, "content_type": "application/pdf"})
+
+            request = Mock()
+            request.user.id = 1
+            logs, results = views._send_emails(df, "email", "companyname", "Hi", "Body", files, request)
+
+        sent_to = [c.args[0] for c in mock_send.call_args_list]
+        self.assertEqual(sent_to, ["a1@acme.com", "a2@acme.com", "g1@globex.com", "g2@globex.com", "n@none.com"])
+        acme_attachments = [c.args[3] for c in mock_send.call_args_list[:2]]
+        self.assertIs(acme_attachments[0], acme_attachments[1])
+        self.assertEqual([r["email"] for r in results], list(df["email"]))
+        self.assertEqual(results[2]["matched_files"], "acme_invoice.pdf")
+
+
+    @patch('time.sleep')
+    @patch('automation.views.send_single_mail')
+    def test_refused_cc_reported_on_delivered_row(self, mock_send, mock_sleep):
+        """Test a row delivered with a refused CC stays OK and carries the refusal in the report."""
+        from automation import views
+        from automation.exceptions import MailSendError, PartialDeliveryError
+
+        mock_send.side_effect = [
+            PartialDeliveryError("Delivered, but the server refused bad@x.com", {"bad@x.com": (550, b"No")}),
+            MailSendError("Failed to send mail: refused"),
+        ]
+        df = pd.DataFrame({"email": ["a@x.com", "b@x.com"], "cc": ["bad@x.com", ""]})
+        request = Mock()
+        request.user.id = 1
+        logs, results = views._send_emails(df, "email", "companyname", "Hi", "Body", [], request)
+
+        self.assertEqual([r["status"] for r in results], ["OK", "ERROR"])
+        self.assertIn("bad@x.com", results[0]["error_detail"])
+
+    @patch('time.sleep')
+    @patch('automation.views.send_single_mail')
+    def test_bcc_fanout_groups_identical_messages(self, mock_send, mock_sleep):
+        """Test identical rendered messages go out once per BCC chunk, with a report row per recipient."""
+        from django.test import override_settings
+        from automation import views
+
+        df = pd.DataFrame({
+            "email": ["a@x.com", "b@x.com", "c@x.com", "d@x.com"],
+            "name": ["Ali", "Ali", "Veli", "Ali"],
+        })
+        request = Mock()
+        request.user.id = 1
+        mock_send.side_effect = [True, Exception("throttled"), True]
+
+        with override_settings(MAIL_BCC_MAX_RECIPIENTS=2):
+            logs, results = views._send_emails(
+                df, "email", "companyname", "Merhaba {name}", "Body", [], request, bcc_fanout=True
+            )
+
+        bcc_lists = [c.kwargs["bcc_emails"] for c in mock_send.call_args_list]
+        self.assertEqual(bcc_lists, [["a@x.com", "b@x.com"], ["d@x.com"], ["c@x.com"]])
+        self.assertTrue(all(c.args[0] is None for c in mock_send.call_args_list))
+        self.assertEqual([r["email"] for r in results], list(df["email"]))
+        self.assertEqual([r["status"] for r in results], ["OK", "OK", "OK", "ERROR"])
+
+
+    @patch('time.sleep')
+    @patch('automation.services.mailer.acquire_token_silent_or_fail', return_value="token")
+    @patch('automation.views.acquire_token_silent_or_fail', return_value="token")
+    def test_link_attachments_upload_each_file_once(self, mock_view_token, mock_mail_token, mock_sleep):
+        """Test OneDrive link mode uploads distinct files once and sends links instead of contentBytes."""
+        import json
+        import os
+        import tempfile
+        from automation import views
+        from tests.graph_stub import GraphStubServer
+
+        df = pd.DataFrame({
+            "email": ["a1@acme.com", "a2@acme.com", "g@globex.com", "a3@acme.com"],
+            "companyname": ["Acme", "Acme", "Globex", "acme"],
+        })
+        with tempfile.TemporaryDirectory() as tmp, GraphStubServer() as graph, \
+                patch('automation.services.graph_client.GRAPH_API_BASE', graph.graph_base):
+            files = []
+            for name, content in (("acme_brochure.pdf", b"A" * 5000), ("globex_brochure.pdf", b"G" * 700)):
+                path = os.path.join(tmp, name)
+                with open(path, "wb") as f:
+                    f.write(content)
+                files.append({"name": name, "path": path, "size": len(content), "content_type": "application/pdf"})
+
+            logs, results = views._send_emails(
+                df, "email", "companyname", "Hi", "Body", files, Mock(user=Mock(id=1)), link_attachments=True
+            )
+
+        self.assertEqual([r["status"] for r in results], ["OK"] * 4)
+        self.assertTrue(all(r["sent_with_attachments"] for r in results))
+        sessions = graph.calls("POST", ":/createUploadSession")
+        self.assertEqual(len(sessions), 2)
+        self.assertIn("acme_brochure.pdf", sessions[0][0])
+        self.assertEqual(sorted(len(u["data"]) for u in graph.uploads.values()), [700, 5000])
+        links = graph.calls("POST", "/createLink")
+        self.assertEqual(len(links), 2)
+        # Links stay inside the organization unless anonymous links are opted into
+        self.assertEqual({json.loads(body)["scope"] for _, body in links}, {"organization"})
+
+        mails = [json.loads(body)["message"] for _, body in graph.calls("POST", "/me/sendMail")]
+        self.assertEqual(len(mails), 4)
+        self.assertTrue(all("attachments" not in m for m in mails))
+        acme_link = f"{graph.base_url}/s/item1"
+        self.assertIn(acme_link, mails[0]["body"]["content"])
+        self.assertIn("[ONEDRIVE] 2 files uploaded once (5700 bytes), links reused 2 times", logs)
+
+
+class TestRecipientValidation(TestCase):
+    """Test the pre-send recipient validation."""
+
+    def test_invalid_rows_flagged_with_reasons(self):
+        """Test empty and malformed addresses, bad CC entries and missing placeholder columns."""
+        from automation.services.recipient_validation import validate_recipients
+
+        df = pd.DataFrame({
+            "email": ["a@x.com", " b@y.com.tr ", None, "bad@", "c@x.com"],
+            "cc": ["d@x.com; e@x.com", "", None, "", "ok@x.com, nope"],
+            "name": ["A", "B", "C", "D", "E"],
+        }, index=[10, 11, 12, 13, 14])
+
+        result = validate_recipients(df, "email", {"name"})
+        self.assertEqual(result.invalid.tolist(), [False, False, True, True, True])
+        self.assertEqual(result.reasons.tolist(), [
+            "", "", "Empty email address", "Invalid email address: bad@", "Invalid CC address: nope"
+        ])
+        self.assertEqual(result.summary(), {
+            "valid": 2, "invalid": 3, "missing_columns": "",
+            "empty_email": 1, "invalid_email": 1, "invalid_cc": 1,
+        })
+
+        result = validate_recipients(df, "email", {"name", "amount"})
+        self.assertTrue(result.invalid.all())
+        self.assertEqual(result.missing_columns, ["amount"])
+        self.assertEqual(result.reasons.iat[0], "No column for placeholder(s) {amount}")
+
+    @patch('time.sleep')
+    @patch('automation.views.send_single_mail')
+    def test_invalid_rows_skipped_and_reported_in_order(self, mock_send, mock_sleep):
+        """Test invalid rows of every batch are not sent but keep their place in the report."""
+        from django.test import override_settings
+        from automation import views
+
+        df = pd.DataFrame({
+            "email": ["a@x.com", "", "b@x.com", "not-an-address", "c@x.com"],
+            "companyname": ["Acme", "Acme", "Globex", "Globex", "Acme"],
+        })
+        request = Mock()
+        request.user.id = 1
+        logs, results = views._send_emails(
+            df.iloc[:0], "email", "companyname", "Hi", "Body", [], request,
+            row_batches=iter([df.iloc[:2], df.iloc[2:]])
+        )
+
+        self.assertEqual(sorted(c.args[0] for c in mock_send.call_args_list), ["a@x.com", "b@x.com", "c@x.com"])
+        self.assertEqual([r["email"] for r in results], list(df["email"]))
+        self.assertEqual([r["status"] for r in results], ["OK", "SKIPPED", "OK", "SKIPPED", "OK"])
+        self.assertEqual(results[3]["error_detail"], "Invalid email address: not-an-address")
+        self.assertIn("[VALIDATION] 2 invalid rows excluded before sending", logs)
+
+        mock_send.reset_mock()
+        with override_settings(MAIL_VALIDATE_RECIPIENTS=False):
+            views._send_emails(df, "email", "companyname", "Hi", "Body", [], request)
+        self.assertEqual(mock_send.call_count, 5)
+
+
 class TestMailService(TestCase):
     """Test mail service functionality."""
     
@@ -158,6 +1126,149 @@ class TestMailService(TestCase):
         self.assertTrue(result)
         mock_send.assert_called_once()
     
+    @patch('automation.services.mailer.acquire_token_silent_or_fail')
+    @patch('automation.services.mailer.send_mail_streaming')
+    def test_streaming_send_mail_body(self, mock_stream, mock_token):
+        """Test file-backed attachments stream as the same JSON with an exact length."""
+        import base64
+        import io
+        import json
+        import os
+        import tempfile
+        from automation.services.graph_payload import AttachmentSource, iter_base64
+        from automation.services.mailer import build_message_payload, send_single_mail
+
+        mock_token.return_value = "test_token"
+        mock_stream.return_value = True
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "acme.pdf")
+            content = os.urandom(200_003)
+            with open(path, "wb") as f:
+                f.write(content)
+            inline = {"@odata.type": "#microsoft.graph.fileAttachment", "name": "x.txt",
+                      "contentType": "text/plain", "contentBytes": "eA=="}
+
+            send_single_mail("test@example.com", "Şubat", "Body", [AttachmentSource.from_path(path), inline],
+                             cc_emails=["cc@example.com"])
+            body = mock_stream.call_args[0][1]
+            raw = b"".join(body)
+
+            self.assertEqual(len(body), len(raw))
+            expected = build_message_payload("test@example.com", "Şubat", "Body", None, ["cc@example.com"])
+            expected["attachments"] = [
+                {"@odata.type": "#microsoft.graph.fileAttachment", "name": "acme.pdf",
+                 "contentType": "application/pdf", "contentBytes": base64.b64encode(content).decode()},
+                inline,
+            ]
+            self.assertEqual(json.loads(raw), {"message": expected, "saveToSentItems": True})
+
+        # Short reads are realigned to 3-byte boundaries
+        class Trickle(io.BytesIO):
+            def read(self, size=-1):
+                return super().read(min(size, 7))
+
+        self.assertEqual(b"".join(iter_base64(Trickle(content[:1000]), chunk_size=6)), base64.b64encode(content[:1000]))
+    
+    def test_attachment_fragments_serialized_once_per_campaign(self):
+        """Test shared attachments are encoded once and spliced into every body."""
+        import json
+        import os
+        import tempfile
+        from automation.services.graph_payload import AttachmentFragmentCache, AttachmentSource, SendMailBody
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "price_list.pdf")
+            with open(path, "wb") as f:
+                f.write(os.urandom(30_000))
+            cache = AttachmentFragmentCache(max_bytes=1024 * 1024)
+
+            with patch.object(AttachmentSource, "open", autospec=True, side_effect=lambda s: open(path, "rb")) as opened:
+                bodies = [
+                    SendMailBody({"subject": f"Hi {i}"}, [AttachmentSource.from_path(path)], fragment_cache=cache)
+                    for i in range(3)
+                ]
+                raws = [b"".join(body) for body in bodies]
+            # The first body streams the file; the second use builds the fragment, the third reuses it
+            self.assertEqual(opened.call_count, 2)
+            self.assertEqual(cache.stats()["hits"], 1)
+            self.assertEqual([len(b) for b in bodies], [len(r) for r in raws])
+            uncached = b"".join(SendMailBody({"subject": "Hi 0"}, [AttachmentSource.from_path(path)]))
+            self.assertEqual(json.loads(raws[0]), json.loads(uncached))
+
+            # A file used once is never held in memory, unless the caller knows it is shared
+            once = AttachmentFragmentCache(max_bytes=1024 * 1024)
+            b"".join(SendMailBody({"subject": "Hi"}, [AttachmentSource.from_path(path)], fragment_cache=once))
+            self.assertEqual((once.stats()["entries"], once.stats()["first_uses"]), (0, 1))
+            shared = AttachmentFragmentCache(max_bytes=1024 * 1024)
+            self.assertIsNotNone(shared.get(AttachmentSource.from_path(path), shared=True))
+
+            # Fragments larger than the budget are streamed instead
+            small = AttachmentFragmentCache(max_bytes=1024)
+            self.assertIsNone(small.get(AttachmentSource.from_path(path)))
+            self.assertEqual(small.stats()["bypassed"], 1)
+    
+    @patch('automation.services.mailer.acquire_token_silent_or_fail')
+    @patch('automation.services.mailer.send_draft_message')
+    @patch('automation.services.mailer.upload_draft_attachment')
+    @patch('automation.services.mailer.add_draft_attachment')
+    @patch('automation.services.mailer.create_draft_message')
+    def test_payload_planner_strategies(self, mock_draft, mock_add, mock_upload, mock_send, mock_token):
+        """Test messages are planned inline, via upload session or split from file sizes."""
+        import io
+        from automation.services.graph_payload import AttachmentSource, SendMailBody
+        from automation.services import payload_planner
+        from automation.services.mailer import build_message_payload, send_single_mail
+
+        def source(name, size):
+            return AttachmentSource(name, "application/pdf", size, lambda: io.BytesIO(b"x" * size), key=name)
+
+        limits = payload_planner.PayloadLimits(
+            inline_request_bytes=10_000, upload_session_min_bytes=6_000, max_message_bytes=40_000
+        )
+        payload = build_message_payload("a@example.com", "Fatura", "Body")
+
+        small = [source("a.pdf", 3_000)]
+        plan = payload_planner.plan_message(payload, small, limits)
+        self.assertEqual(plan.strategy, payload_planner.INLINE)
+        self.assertEqual(plan.wire_bytes, len(b"".join(SendMailBody(payload, small))))
+
+        large = [source("a.pdf", 3_000), source("b.pdf", 20_000)]
+        self.assertEqual(payload_planner.plan_message(payload, large, limits).strategy, payload_planner.UPLOAD_SESSION)
+
+        huge = [source(f"{i}.pdf", 20_000) for i in range(3)]
+        plan = payload_planner.plan_message(payload, huge, limits)
+        self.assertEqual(plan.strategy, payload_planner.SPLIT)
+        self.assertEqual([len(p.attachments) for p in plan.parts], [1, 1, 1])
+        summary = payload_planner.summarize_plans([plan, payload_planner.plan_message(payload, small, limits)])
+        self.assertEqual((summary["split"], summary["inline"], summary["messages"]), (1, 1, 4))
+
+        # Without Mail.ReadWrite, messages over the request limit are split into parts that fit it
+        mail_send_only = payload_planner.PayloadLimits(
+            inline_request_bytes=10_000, upload_session_min_bytes=6_000, max_message_bytes=40_000,
+            upload_sessions=False
+        )
+        mixed = [source("a.pdf", 3_000), source("b.pdf", 3_000), source("c.pdf", 3_000)]
+        plan = payload_planner.plan_message(payload, mixed, mail_send_only)
+        self.assertEqual(plan.strategy, payload_planner.SPLIT)
+        self.assertEqual([len(p.attachments) for p in plan.parts], [2, 1])
+        self.assertTrue(all(p.strategy == payload_planner.INLINE for p in plan.parts))
+        self.assertTrue(all(p.wire_bytes <= 10_000 for p in plan.parts))
+        self.assertEqual(payload_planner.plan_message(payload, mixed, limits).strategy, payload_planner.UPLOAD_SESSION)
+        with self.settings(GRAPH_SCOPES="Mail.Send"):
+            self.assertFalse(payload_planner.PayloadLimits.from_settings().upload_sessions)
+        with self.settings(GRAPH_SCOPES="Mail.Send Mail.ReadWrite"):
+            self.assertTrue(payload_planner.PayloadLimits.from_settings().upload_sessions)
+
+        # Upload session: the small file goes in as JSON, the large one in ranges
+        mock_token.return_value = "test_token"
+        mock_draft.return_value = "draft-1"
+        with patch.object(payload_planner.PayloadLimits, "from_settings", return_value=limits):
+            send_single_mail("a@example.com", "Fatura", "Body", large)
+        self.assertEqual(mock_add.call_count, 1)
+        self.assertEqual(mock_upload.call_args[0][2]["AttachmentItem"]["size"], 20_000)
+        mock_send.assert_called_once_with("test_token", "draft-1", 15)
+    
     @patch('automation.services.mailer.acquire_token_silent_or_fail')
     def test_send_single_mail_auth_error(self, mock_token):
         """Test sending mail with authentication error."""
@@ -168,6 +1279,136 @@ class TestMailService(TestCase):
         with self.assertRaises(NeedsLoginError):
             send_single_mail("test@example.com", "Test Subject", "Test Body")
 
+    def test_graph_http_client_reuses_connections_and_limits_streams(self):
+        """Test Graph calls reuse a keep-alive connection and the stream limiter bounds requests in flight."""
+        import json
+        import threading
+        from automation.services.graph_client import send_mail, send_mail_streaming
+        from automation.services.graph_http import PooledHttpClient, StreamLimiter, format_http_stats
+        from automation.services.graph_payload import SendMailBody
+        from tests.graph_stub import GraphStubServer
+
+        limiter = StreamLimiter(max_streams=2, max_inflight_bytes=100)
+        limiter.acquire(60)
+        second = threading.Event()
+        waiter = threading.Thread(target=lambda: (limiter.acquire(60), second.set()))
+        waiter.start()
+        self.assertFalse(second.wait(0.1))  # over the byte budget
+        limiter.release(60)
+        self.assertTrue(second.wait(1))
+        waiter.join()
+
+        client = PooledHttpClient(pool_size=2)
+        payload = {"subject": "S", "body": {"contentType": "HTML", "content": "B"}, "toRecipients": []}
+        with GraphStubServer() as graph, \
+                patch('automation.services.graph_client.GRAPH_API_BASE', graph.graph_base), \
+                patch('automation.services.graph_client.get_http_client', return_value=client):
+            for _ in range(4):
+                send_mail("token", payload)
+            # A campaign only reports the requests made after its snapshot
+            snapshot = client.snapshot()
+            send_mail_streaming("token", SendMailBody(payload, []))
+        stats = client.stats()
+        campaign_stats = client.stats(since=snapshot)
+        client.close()
+
+        self.assertEqual((stats["connections"], stats["requests"], stats["errors"]), (1, 5, 0))
+        self.assertEqual((campaign_stats["connections"], campaign_stats["requests"]), (0, 1))
+        self.assertIn("1 requests", format_http_stats(campaign_stats))
+        self.assertGreater(stats["max_ms"], 0)
+        self.assertEqual(len(client.session.cookies), 0)
+        self.assertEqual(json.loads(graph.requests[-1][2])["message"]["subject"], "S")
+
+    def test_http2_client_sends_streaming_bodies(self):
+        """Test the httpx client sends iterable bodies with their exact length and records stats."""
+        import json
+        import unittest
+        from automation.services import graph_http
+        from automation.services.graph_client import send_mail_streaming
+        from automation.services.graph_payload import SendMailBody
+        from tests.graph_stub import GraphStubServer
+
+        if not graph_http.HTTP2_SUPPORT:
+            raise unittest.SkipTest("httpx[http2] not installed")
+
+        client = graph_http.Http2HttpClient(max_connections=1)
+        payload = {"subject": "S", "body": {"contentType": "HTML", "content": "B"}, "toRecipients": []}
+        with GraphStubServer() as graph, \
+                patch('automation.services.graph_client.GRAPH_API_BASE', graph.graph_base), \
+                patch('automation.services.graph_client.get_http_client', return_value=client):
+            for _ in range(3):
+                send_mail_streaming("token", SendMailBody(payload, []))
+        client.close()
+
+        stats = client.stats()
+        self.assertEqual((stats["connections"], stats["requests"]), (1, 3))
+        self.assertEqual(json.loads(graph.requests[-1][2])["message"]["subject"], "S")
+
+    def test_smtp_transport_pools_connections_and_streams_mime(self):
+        """Test SMTP sends reuse one pooled session and deliver valid MIME; the file sink writes .eml files."""
+        import email
+        import email.policy
+        import os
+        import tempfile
+        from automation.services.graph_payload import AttachmentSource
+        from automation.services.mailer import send_bulk_mails, send_single_mail
+        from automation.exceptions import DeliveryUnknownError, MailSendError, PartialDeliveryError
+        from automation.services.transports import FileSinkTransport, SMTPTransport
+        from tests.smtp_stub import SMTPStubServer
+
+        with tempfile.TemporaryDirectory() as tmp, SMTPStubServer() as server:
+            path = os.path.join(tmp, "fatura_şubat.pdf")
+            content = os.urandom(100_000) + b"\r\n.\r\n"
+            with open(path, "wb") as f:
+                f.write(content)
+
+            transport = SMTPTransport(server.host, server.port, from_addr="sender@example.com", use_tls=False, pool_size=1)
+            with patch('automation.services.mailer.get_transport', return_value=transport):
+                for n in range(3):
+                    # Delivered, but the refused CC is reported
+                    with self.assertRaises(PartialDeliveryError) as caught:
+                        send_single_mail(
+                            f"user{n}@example.com", "Şubat faturası", "<p>.Merhaba</p>",
+                            [AttachmentSource.from_path(path, "application/pdf")],
+                            cc_emails=["reject@example.com", "cc@example.com"], bcc_emails=["audit@example.com"],
+                            timeout=5
+                        )
+                    self.assertEqual(list(caught.exception.refused), ["reject@example.com"])
+                # A refused addressee fails the message and nothing is sent
+                with self.assertRaises(MailSendError):
+                    send_single_mail("reject-me@example.com", "S", "B", cc_emails=["cc@example.com"])
+                results = send_bulk_mails([{"email": "bulk@example.com", "subject": "S", "body": "B"}])
+            transport.close()
+            pooled_connections = server.connections
+
+            # A session dropped before DATA is retried on a fresh one; a drop during DATA is not resent
+            retrying = SMTPTransport(server.host, server.port, from_addr="sender@example.com", use_tls=False)
+            with patch('automation.services.mailer.get_transport', return_value=retrying):
+                server.drop_next_mail = True
+                self.assertTrue(send_single_mail("retry@example.com", "S", "B"))
+                with self.assertRaises(DeliveryUnknownError):
+                    send_single_mail("hangup@example.com", "S", "B")
+            retrying.close()
+            sent_to = [m["rcpts"] for m in server.messages[4:]]
+            self.assertEqual(sent_to, [["retry@example.com"], ["hangup@example.com"]])
+
+            sink = FileSinkTransport(os.path.join(tmp, "outbox"))
+            sink.send({"subject": "S", "body": {"contentType": "HTML", "content": "B"}, "toRecipients": []})
+            self.assertEqual(len(os.listdir(os.path.join(tmp, "outbox"))), 1)
+
+        self.assertEqual(results[0]["status"], "OK")
+        self.assertEqual(pooled_connections, 1)
+        self.assertEqual(transport.stats()["messages_sent"], 4)
+        first = server.messages[0]
+        self.assertEqual(first["rcpts"], ["user0@example.com", "cc@example.com", "audit@example.com"])
+        message = email.message_from_bytes(first["data"], policy=email.policy.default)
+        self.assertEqual(str(message["Subject"]), "Şubat faturası")
+        self.assertIsNone(message["Bcc"])
+        self.assertEqual(message.get_body().get_content(), "<p>.Merhaba</p>")
+        attachment = next(message.iter_attachments())
+        self.assertEqual(attachment.get_filename(), "fatura_şubat.pdf")
+        self.assertEqual(attachment.get_content(), content)
+
 
 class TestIntegration(TestCase):
     """Integration tests to ensure services work together."""
@@ -172,6 +172,7 @@ class TestViewSmokeTests(TestCase):
         # Set some session data
         session = self.client.session
         session['mail_excel_b64'] = 'test_data'
+        session['mail_dataset_id'] = '0' * 64
         session.save()
         
         # Test reset
@@ -181,6 +182,46 @@ class TestViewSmokeTests(TestCase):
         # Session should be cleared
         session = self.client.session
         self.assertNotIn('mail_excel_b64', session)
+        self.assertNotIn('mail_dataset_id', session)
+    
+    def test_attachment_manifest_sync(self):
+        """Test only blobs missing from the library are uploaded before the campaign is committed."""
+        import hashlib
+        import tempfile
+        from django.test import override_settings
+
+        acme, globex = b"acme invoice", b"globex invoice"
+        manifest = {"files": [
+            {"name": "acme.pdf", "size": len(acme), "sha256": hashlib.sha256(acme).hexdigest()},
+            {"name": "globex.pdf", "size": len(globex), "sha256": hashlib.sha256(globex).hexdigest()},
+        ]}
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                override_settings(ATTACHMENT_LIBRARY_ENABLED=True, ATTACHMENT_LIBRARY_PATH=tmp):
+            response = self.client.post('/mail/attachments/manifest/', manifest, content_type='application/json')
+            missing = response.json()["missing"]
+            self.assertEqual(len(missing), 2)
+
+            url = f'/mail/attachments/blob/{missing[0]}/'
+            response = self.client.post(url, globex, content_type='application/octet-stream')
+            self.assertEqual(response.status_code, 400)  # wrong content for this hash
+            for content in (acme, globex):
+                response = self.client.post(
+                    f'/mail/attachments/blob/{hashlib.sha256(content).hexdigest()}/',
+                    content, content_type='application/octet-stream'
+                )
+                self.assertEqual(response.status_code, 200)
+
+            response = self.client.post('/mail/attachments/commit/')
+            self.assertEqual(response.json(), {"files": 2})
+            self.assertEqual(
+                sorted(f["name"] for f in self.client.session["uploaded_files"]), ["acme.pdf", "globex.pdf"]
+            )
+
+            # Next month only the changed file is requested
+            manifest["files"][1].update(size=7, sha256=hashlib.sha256(b"globex2").hexdigest())
+            response = self.client.post('/mail/attachments/manifest/', manifest, content_type='application/json')
+            self.assertEqual(response.json()["missing"], [manifest["files"][1]["sha256"]])
     
     def test_report_download_no_data(self):
         """Test report download with no data."""